@@ -0,0 +1,93 @@
+"""Count the Notion requests a repeat scan of an unchanged workspace makes with
+and without the block tree cache (see lib/block_tree_cache.py)
+
+Every variant starts by scanning the workspace once, and then scans it again:
+  - "rescan": the usual incremental scan, where the pages with SRS blocks
+    that haven't been processed yet are searched again
+  - "rescan, new scan index": the scan index was deleted (or the scan is
+    pointed at a different one), so every page is searched again
+
+Run it with `python -m benchmarks.bench_block_tree_cache`
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from .stub_notion import StubNotionServer, make_synthetic_workspace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-pages", type=int, default=50)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=5)
+    parser.add_argument("--mention-probability", type=float, default=0.05)
+    args = parser.parse_args()
+
+    workspace = make_synthetic_workspace(
+        args.num_pages, args.depth, args.fanout, args.mention_probability
+    )
+    # the workspace hasn't been edited since yesterday
+    last_edited_time = (
+        (datetime.now(timezone.utc) - timedelta(days=1))
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+    for page in workspace.pages:
+        page["last_edited_time"] = last_edited_time
+    for children in workspace.children_by_id.values():
+        for block in children:
+            block["last_edited_time"] = last_edited_time
+
+    with StubNotionServer(workspace) as notion_stub:
+        os.environ["NOTION_BASE_URL"] = notion_stub.base_url
+        os.environ.setdefault("NOTION_KEY", "secret_stub")
+        from lib import notion_api
+        from lib.block_tree_cache import BlockTreeCache
+        from lib.scan_index import ScanIndex
+
+        notion_api.rate_limiter = notion_api.TokenBucket(1000, 1000)
+
+        def scan(scan_index_filepath: str) -> int:
+            """Scan the workspace, returning the number of Notion requests made"""
+            notion_stub.reset_counters()
+            scan_index = ScanIndex(scan_index_filepath)
+            with contextlib.redirect_stdout(io.StringIO()):
+                notion_api.find_srs_blocks(scan_index=scan_index)
+            scan_index.commit()
+            scan_index.close()
+            return notion_stub.num_requests
+
+        print(
+            f"{len(workspace.pages)} pages, {workspace.num_blocks} blocks\n\n"
+            f"{'':<24} {'first scan':>11} {'no cache':>9} {'cache':>6}"
+        )
+        for variant in ["rescan", "rescan, new scan index"]:
+            requests_by_cache = {}
+            for use_cache in [False, True]:
+                with tempfile.TemporaryDirectory() as directory:
+                    cache = None
+                    if use_cache:
+                        cache = BlockTreeCache(os.path.join(directory, "cache.sqlite3"))
+                    notion_api.use_block_tree_cache(cache)
+                    first_scan_requests = scan(os.path.join(directory, "index.sqlite3"))
+                    scan_index_filepath = os.path.join(
+                        directory,
+                        "index.sqlite3" if variant == "rescan" else "new.sqlite3",
+                    )
+                    requests_by_cache[use_cache] = scan(scan_index_filepath)
+                    if cache is not None:
+                        cache.close()
+            print(
+                f"{variant:<24} {first_scan_requests:>11} "
+                f"{requests_by_cache[False]:>9} {requests_by_cache[True]:>6}"
+            )
+        notion_api.use_block_tree_cache(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Compare how much space a card takes with its raw Notion block (as in the
+old *.pkl card files) and with the block snapshot the card store keeps
+
+Run it with `python -m benchmarks.bench_card_size`
+"""
+
+import argparse
+import json
+import os
+import pickle
+import tempfile
+
+
+def make_raw_notion_block(i: int):
+    """A block the way the Notion API returns it, with a sentence of text and
+    an srs-item mention. Like a parsed response, it shares no objects with
+    other blocks, which pickle would otherwise only store once"""
+    from .stub_notion import make_rich_text
+
+    block = {
+        "object": "block",
+        "id": f"2f1e4d3c-0b8a-4f6e-9d7c-{i:012d}",
+        "parent": {
+            "type": "page_id",
+            "page_id": "9c1b7e2a-5d4f-4a3b-8e6d-1f0a2b3c4d5e",
+        },
+        "created_time": "2024-03-01T12:34:00.000Z",
+        "last_edited_time": "2024-03-02T08:15:00.000Z",
+        "created_by": {"object": "user", "id": "7a6b5c4d-3e2f-4a1b-9c8d-7e6f5a4b3c2d"},
+        "last_edited_by": {
+            "object": "user",
+            "id": "7a6b5c4d-3e2f-4a1b-9c8d-7e6f5a4b3c2d",
+        },
+        "has_children": False,
+        "archived": False,
+        "in_trash": False,
+        "type": "paragraph",
+        "paragraph": {
+            "color": "default",
+            "rich_text": [
+                make_rich_text(
+                    f"Fact {i}: power plants that can be started quickly are "
+                    "better suited to handle changes in demand "
+                ),
+                make_rich_text("srs-item", is_mention=True),
+            ],
+        },
+    }
+    return json.loads(json.dumps(block))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-cards", type=int, default=10_000)
+    args = parser.parse_args()
+
+    from lib.anki_utils import AnkiCard, make_block_snapshot
+    from lib.card_store import CardStore
+
+    texts_and_blocks = [
+        (f"Fact {i} is about {{{{c1::power plants}}}}", make_raw_notion_block(i))
+        for i in range(args.num_cards)
+    ]
+    raw_pickle_size = len(pickle.dumps(texts_and_blocks))
+    raw_json_size = sum(len(json.dumps(block)) for _, block in texts_and_blocks)
+    snapshot_json_size = sum(
+        len(json.dumps(make_block_snapshot(block))) for _, block in texts_and_blocks
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "cards.sqlite3")
+        card_store = CardStore(filepath)
+        card_store.add_cards(
+            AnkiCard(text, block, "Science and Technology")
+            for text, block in texts_and_blocks
+        )
+        card_store.close()
+        card_store_size = os.path.getsize(filepath)
+
+    print(f"{'':<32} {'bytes/card':>10}")
+    for name, size in [
+        ("pickled raw blocks (cards.pkl)", raw_pickle_size),
+        ("raw block JSON", raw_json_size),
+        ("block snapshot JSON", snapshot_json_size),
+        ("card store file", card_store_size),
+    ]:
+        print(f"{name:<32} {size / args.num_cards:>10.0f}")
+    print(
+        f"\nblock snapshots are {raw_json_size / snapshot_json_size:.1f}x smaller "
+        "than raw blocks"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Show that merging cards into the card store scales linearly with the number
+of cards, including dedup by Notion block id and by card text fingerprint
+
+Run it with `python -m benchmarks.bench_card_store_merge`
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+
+def make_anki_cards(start: int, stop: int):
+    """Lazily generate synthetic cards, where every 10th card has the same text
+    as the card before it"""
+    from lib.anki_utils import AnkiCard
+
+    for i in range(start, stop):
+        text_id = i - 1 if i % 10 == 0 else i
+        yield AnkiCard(
+            f"Fact {text_id} is about {{{{c1::topic {text_id}}}}}",
+            {"id": f"block-{i}", "type": "paragraph", "paragraph": {"rich_text": []}},
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    args = parser.parse_args()
+
+    from lib.card_store import CardStore
+
+    print(
+        f"{'cards':>8} {'initial merge':>14} {'us/card':>8} "
+        f"{'50% overlap merge':>18} {'us/card':>8} {'text dups':>10}"
+    )
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            card_store = CardStore(os.path.join(directory, "cards.sqlite3"))
+
+            start = time.perf_counter()
+            card_store.add_cards(make_anki_cards(0, size))
+            initial_elapsed = time.perf_counter() - start
+
+            # half of these cards are already in the store
+            start = time.perf_counter()
+            merge_result = card_store.add_cards(
+                make_anki_cards(size // 2, size + size // 2)
+            )
+            overlap_elapsed = time.perf_counter() - start
+            card_store.close()
+
+        print(
+            f"{size:>8} {initial_elapsed:>13.3f}s {initial_elapsed / size * 1e6:>8.1f} "
+            f"{overlap_elapsed:>17.3f}s {overlap_elapsed / size * 1e6:>8.1f} "
+            f"{len(merge_result.duplicate_texts):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
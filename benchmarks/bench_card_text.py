@@ -0,0 +1,105 @@
+"""Measure the throughput of post-processing and validating the card text the
+LLM generates, on a large synthetic corpus of model outputs, compared to the
+old one-card-at-a-time fix-up
+
+The corpus mixes well-formed cards with the mistakes GPT-3.5 makes: quoted
+output, single curly braces, missing or misnumbered cloze deletions, stray
+braces and empty completions.
+
+Run it with `python -m benchmarks.bench_card_text`
+"""
+
+import argparse
+import random
+import re
+import time
+from collections import Counter
+from typing import List
+
+SENTENCE = "power plants that can be started quickly are better suited to handle changes in demand"
+
+
+def make_model_output(rng: random.Random) -> str:
+    words = SENTENCE.split()
+    i, j = sorted(rng.sample(range(len(words)), 2))
+    roll = rng.random()
+    if roll < 0.6:
+        words[i] = "{{c1::" + words[i] + "}}"
+        words[j] = "{{c2::" + words[j] + "}}"
+    elif roll < 0.7:
+        words[i] = '"{{c1::' + words[i] + "}}"
+        words[-1] = words[-1] + '"'
+    elif roll < 0.8:
+        words[i] = "{c1::" + words[i] + "}"
+    elif roll < 0.85:
+        pass
+    elif roll < 0.9:
+        words[i] = "{{c2::" + words[i] + "}}"
+    elif roll < 0.95:
+        words[i] = "{{c1::" + words[i] + "}"
+    else:
+        return ""
+    return " ".join(words)
+
+
+def legacy_validate_and_fix_card_text(anki_card_text: str) -> str:
+    """The fix-up cards used to get, which raised an IndexError on empty text
+    and turned any text in single curly braces into a broken cloze"""
+    if anki_card_text[0] == '"':
+        anki_card_text = anki_card_text[1:]
+    if anki_card_text[-1] == '"':
+        anki_card_text = anki_card_text[:-1]
+    return re.sub(
+        r"\{(.*?)\}", lambda match: "{{" + match.group(1) + "}}", anki_card_text
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-outputs", type=int, default=200_000)
+    args = parser.parse_args()
+
+    from lib.card_text import post_process_card_texts
+
+    rng = random.Random(0)
+    outputs = [make_model_output(rng) for _ in range(args.num_outputs)]
+
+    start = time.perf_counter()
+    legacy_texts: List[str] = []
+    num_crashes = 0
+    for output in outputs:
+        try:
+            legacy_texts.append(legacy_validate_and_fix_card_text(output))
+        except IndexError:
+            num_crashes += 1
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    card_texts = post_process_card_texts(outputs)
+    seconds = time.perf_counter() - start
+
+    # the legacy fix-up didn't validate anything, so count how many of the
+    # texts it would have stored are malformed
+    num_legacy_malformed = len(
+        [
+            card_text
+            for card_text in post_process_card_texts(legacy_texts)
+            if card_text.problem is not None
+        ]
+    )
+    problems = Counter(card_text.problem for card_text in card_texts)
+    print(f"{args.num_outputs} model outputs\n")
+    print(f"{'':<8} {'cards/s':>10} {'crashed':>8} {'stored malformed':>17}")
+    print(
+        f"{'legacy':<8} {len(outputs) / legacy_seconds:>10.0f} {num_crashes:>8} "
+        f"{num_legacy_malformed:>17}"
+    )
+    print(f"{'new':<8} {len(outputs) / seconds:>10.0f} {0:>8} {0:>17}\n")
+    print("sent back to the LLM:")
+    for problem, count in problems.most_common():
+        if problem is not None:
+            print(f"  {problem:<20} {count:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Run the scan_notion and generate_cards commands end to end against local
+stand-ins for Notion, OpenAI and Anki Connect, and report the throughput, the
+p50/p99 latency of each stage's API calls and the API calls made per card
+
+The Notion stand-in serves a synthetic workspace of configurable size and
+depth, or a workspace replayed from a JSON fixture (see --save-fixture and
+--fixture). --profile picks the latency and 429 behaviour of the stand-ins.
+
+Run it with `python -m benchmarks.bench_end_to_end`
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+from .stub_anki_connect import StubAnkiConnectServer
+from .stub_notion import StubNotionServer, StubWorkspace, make_synthetic_workspace
+from .stub_openai import StubOpenAIServer
+
+# The StubServer settings of each stand-in, for each profile:
+#   - "instant": no latency, to measure our own overhead
+#   - "realistic": roughly the latencies we see from the real APIs
+#   - "throttled": realistic, and 5% of Notion and OpenAI requests get a 429
+PROFILES: Dict[str, Dict[str, Dict]] = {
+    "instant": {"notion": {}, "openai": {}, "anki": {}},
+    "realistic": {
+        "notion": {"latency_seconds": 0.1, "jitter_seconds": 0.15},
+        "openai": {"latency_seconds": 0.4, "jitter_seconds": 0.8},
+        "anki": {"latency_seconds": 0.005},
+    },
+    "throttled": {
+        "notion": {
+            "latency_seconds": 0.1,
+            "jitter_seconds": 0.15,
+            "rate_limit_probability": 0.05,
+            "retry_after_seconds": 0.5,
+        },
+        "openai": {
+            "latency_seconds": 0.4,
+            "jitter_seconds": 0.8,
+            "rate_limit_probability": 0.05,
+            "retry_after_seconds": 0.5,
+        },
+        "anki": {"latency_seconds": 0.005},
+    },
+}
+
+
+class CallTimer:
+    """Wraps the functions that call each API, so that every call is timed under
+    the command that's running and the API it went to"""
+
+    def __init__(self):
+        self.stage = "setup"
+        self.latencies_by_stage: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, api: str, function: Callable) -> Callable:
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.latencies_by_stage.setdefault(
+                        f"{self.stage} {api}", []
+                    ).append(elapsed)
+
+        return timed_function
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method="inclusive")[int(p) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-pages", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=5)
+    parser.add_argument("--mention-probability", type=float, default=0.1)
+    parser.add_argument("--fixture", type=str, help="Replay this workspace fixture")
+    parser.add_argument(
+        "--save-fixture", type=str, help="Save the synthetic workspace here"
+    )
+    parser.add_argument("--profile", choices=list(PROFILES), default="instant")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    parser.add_argument("--generation-mode", type=str, default="two_call")
+    parser.add_argument("--anki-chunk-size", type=int, default=50)
+    # the real 3 requests per second would make the crawl take minutes, and
+    # we're benchmarking our code rather than Notion's rate limit
+    parser.add_argument("--notion-requests-per-second", type=float, default=1000)
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the commands' own output"
+    )
+    args = parser.parse_args()
+
+    if args.fixture:
+        workspace = StubWorkspace.load(args.fixture)
+    else:
+        workspace = make_synthetic_workspace(
+            args.num_pages, args.depth, args.fanout, args.mention_probability
+        )
+    if args.save_fixture:
+        workspace.save(args.save_fixture)
+
+    profile = PROFILES[args.profile]
+    with (
+        StubNotionServer(workspace, **profile["notion"]) as notion_stub,
+        StubOpenAIServer(
+            **{"latency_seconds": 0.0, **profile["openai"]}
+        ) as openai_stub,
+        StubAnkiConnectServer(
+            **{"latency_seconds": 0.0, **profile["anki"]}
+        ) as anki_stub,
+    ):
+        # the clients in lib/clients.py read these when they are first used
+        os.environ["NOTION_BASE_URL"] = notion_stub.base_url
+        os.environ["OPENAI_BASE_URL"] = openai_stub.base_url
+        os.environ["ANKI_CONNECT_URL"] = anki_stub.url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        os.environ.setdefault("NOTION_KEY", "secret_stub")
+        os.environ.setdefault("DECK_NAME", "Stub Deck")
+        import main as cli
+        from lib import anki_utils, intelligence, notion_api
+        from lib.card_store import CardStore
+
+        notion_api.rate_limiter = notion_api.TokenBucket(
+            args.notion_requests_per_second, args.notion_requests_per_second
+        )
+        timer = CallTimer()
+        notion_api.call_notion_api = timer.wrap("notion", notion_api.call_notion_api)
+        intelligence.create_chat_completion = timer.wrap(
+            "openai", intelligence.create_chat_completion
+        )
+        anki_utils.anki_call = timer.wrap("anki", anki_utils.anki_call)
+
+        print(
+            f"{len(workspace.pages)} pages, {workspace.num_blocks} blocks, "
+            f"{args.profile} profile, {args.generation_mode} generation\n"
+        )
+        output = sys.stdout if args.verbose else io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            card_store_filepath = os.path.join(directory, "cards.sqlite3")
+
+            start = time.perf_counter()
+            timer.stage = "scan_notion"
+            with contextlib.redirect_stdout(output):
+                cli.find_srs_blocks_and_create_anki_cards(
+                    card_store_filepath,
+                    args.concurrency,
+                    os.path.join(directory, "scan_index.sqlite3"),
+                    True,
+                    args.llm_concurrency,
+                    args.generation_mode,
+                )
+            scan_elapsed = time.perf_counter() - start
+
+            # stand in for the interactive review by accepting every card
+            card_store = CardStore(card_store_filepath)
+            cards = card_store.get_cards("pending")
+            for card in cards:
+                card_store.set_status(card, "accepted")
+            card_store.close()
+            num_cards = max(len(cards), 1)
+
+            start = time.perf_counter()
+            timer.stage = "generate_cards"
+            with contextlib.redirect_stdout(output):
+                cli.generate_anki_card_and_mark_as_processed(
+                    card_store_filepath,
+                    args.anki_chunk_size,
+                    os.path.join(directory, "writeback_queue.sqlite3"),
+                    args.concurrency,
+                )
+            generate_elapsed = time.perf_counter() - start
+
+        print(f"{'command':<16} {'wall time':>10} {'cards/s':>9}")
+        for command, elapsed in [
+            ("scan_notion", scan_elapsed),
+            ("generate_cards", generate_elapsed),
+        ]:
+            print(f"{command:<16} {elapsed:>9.2f}s {len(cards) / elapsed:>9.1f}")
+
+        print(
+            f"\n{'stage':<30} {'calls':>7} {'calls/card':>11} "
+            f"{'p50 ms':>8} {'p99 ms':>8}"
+        )
+        for stage, latencies in timer.latencies_by_stage.items():
+            print(
+                f"{stage:<30} {len(latencies):>7} {len(latencies) / num_cards:>11.2f} "
+                f"{percentile(latencies, 50) * 1000:>8.1f} "
+                f"{percentile(latencies, 99) * 1000:>8.1f}"
+            )
+
+        print(f"\n{'stand-in':<10} {'requests':>9} {'429s':>6} {'requests/card':>14}")
+        for name, stub in [
+            ("notion", notion_stub),
+            ("openai", openai_stub),
+            ("anki", anki_stub),
+        ]:
+            print(
+                f"{name:<10} {stub.num_requests:>9} {stub.num_rate_limited:>6} "
+                f"{stub.num_requests / num_cards:>14.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Compare the wall time, requests and tokens per card of each of the card
+generation modes in lib/intelligence.py, against a local stub of the OpenAI API
+
+Run it with `python -m benchmarks.bench_generation_modes`
+"""
+
+import argparse
+import os
+import time
+
+from .stub_openai import StubOpenAIServer
+
+
+def make_srs_block(i: int) -> dict:
+    text = (
+        f"Fact number {i}: power plants that can be started quickly, such as "
+        "natural gas-fired plants, are better suited to handle fluctuations in "
+        "demand than plants that take longer to start. "
+    )
+    return {
+        "id": f"block-{i}",
+        "type": "paragraph",
+        "paragraph": {
+            "rich_text": [
+                {"plain_text": text, "annotations": {"strikethrough": False}},
+                {"plain_text": "@srs-item", "annotations": {"strikethrough": False}},
+            ]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-blocks", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    with StubOpenAIServer(latency_seconds=args.latency_ms / 1000) as stub:
+        # the OpenAI client reads these when it's first used
+        os.environ["OPENAI_BASE_URL"] = stub.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        from lib.intelligence import GENERATION_MODES, create_anki_cards_from_srs_blocks
+
+        srs_blocks = [make_srs_block(i) for i in range(args.num_blocks)]
+        print(
+            f"{args.num_blocks} blocks, {args.latency_ms:.0f}ms stub latency, "
+            f"concurrency {args.concurrency}\n"
+        )
+        print(
+            f"{'mode':<12} {'wall time':>10} {'requests/card':>14} "
+            f"{'prompt tok/card':>16} {'compl. tok/card':>16}"
+        )
+        for generation_mode in GENERATION_MODES:
+            stub.reset_counters()
+            start = time.perf_counter()
+            create_anki_cards_from_srs_blocks(
+                srs_blocks, args.concurrency, generation_mode
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f"{generation_mode:<12} {elapsed:>9.2f}s "
+                f"{stub.num_requests / args.num_blocks:>14.2f} "
+                f"{stub.prompt_tokens / args.num_blocks:>16.1f} "
+                f"{stub.completion_tokens / args.num_blocks:>16.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
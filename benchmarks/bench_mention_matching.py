@@ -0,0 +1,146 @@
+"""Measure the cost per block of finding SRS mentions in a large synthetic
+page tree, compared to the old substring scan of every rich_text section
+
+The tree is handed to `search_page_for_blocks_containing_mention` as
+`children_by_id`, so no Notion API calls are made and only the matching is timed.
+
+Run it with `python -m benchmarks.bench_mention_matching`
+"""
+
+import argparse
+import os
+import random
+import time
+from typing import Dict, List
+
+MENTION_PAGE_ID = "03485757-2395-4eac-83cf-072ec2119d64"
+
+
+def make_section(text: str, mention: bool = False, strikethrough: bool = False) -> Dict:
+    section = {
+        "annotations": {"strikethrough": strikethrough},
+        "plain_text": text,
+        "type": "text",
+        "text": {"content": text, "link": None},
+    }
+    if mention:
+        section["type"] = "mention"
+        section["mention"] = {"type": "page", "page": {"id": MENTION_PAGE_ID}}
+        del section["text"]
+    return section
+
+
+def make_block_tree(
+    num_blocks: int, sections_per_block: int, seed: int = 0
+) -> Dict[str, List[Dict]]:
+    """Build a `children_by_id` tree rooted at "page" with `num_blocks` blocks,
+    where ~10% of blocks have an srs-item mention (some of them twice) and ~5%
+    have one that has already been struck through"""
+    rng = random.Random(seed)
+    children_by_id: Dict[str, List[Dict]] = {"page": []}
+    parent_ids = ["page"]
+    for i in range(num_blocks):
+        sections = [
+            make_section(f"some words in section {j} of block {i} ")
+            for j in range(sections_per_block)
+        ]
+        roll = rng.random()
+        if roll < 0.1:
+            sections.insert(1, make_section("srs-item", mention=True))
+            if roll < 0.03:
+                sections.append(make_section("srs-item", mention=True))
+        elif roll < 0.15:
+            sections.insert(
+                1, make_section("srs-item", mention=True, strikethrough=True)
+            )
+
+        block_id = f"block-{i}"
+        has_children = rng.random() < 0.2
+        block = {
+            "id": block_id,
+            "type": "paragraph",
+            "has_children": has_children,
+            "last_edited_time": "2024-03-26T10:58:00.000Z",
+            "paragraph": {"rich_text": sections},
+        }
+        children_by_id[rng.choice(parent_ids)].append(block)
+        if has_children:
+            children_by_id[block_id] = []
+            parent_ids.append(block_id)
+    return children_by_id
+
+
+def search_with_substring_scan(
+    block_id: str, mention_text: str, children_by_id: Dict[str, List[Dict]]
+) -> List[Dict]:
+    """The matching `search_page_for_blocks_containing_mention` used to do,
+    which adds a block once for every section that matches"""
+    blocks_with_mentions: List[Dict] = []
+    for block in children_by_id[block_id]:
+        for content_section in block[block["type"]]["rich_text"]:
+            if (
+                mention_text in content_section["plain_text"]
+                and not content_section["annotations"]["strikethrough"]
+            ):
+                blocks_with_mentions.append(block)
+        if block["has_children"]:
+            blocks_with_mentions.extend(
+                search_with_substring_scan(block["id"], mention_text, children_by_id)
+            )
+    return blocks_with_mentions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    parser.add_argument("--sections-per-block", type=int, default=6)
+    args = parser.parse_args()
+
+    import lib.notion_api as notion_api
+
+    print(f"{'blocks':>8} {'matcher':>12} {'us/block':>9} {'found':>7} {'unique':>7}")
+    for size in args.sizes:
+        children_by_id = make_block_tree(size, args.sections_per_block)
+        matchers = [
+            (
+                "substring",
+                lambda: search_with_substring_scan(
+                    "page", notion_api.MENTION_TEXT, children_by_id
+                ),
+            ),
+            (
+                "text",
+                lambda: notion_api.search_page_for_blocks_containing_mention(
+                    "page", notion_api.MENTION_TEXT, children_by_id
+                ),
+            ),
+        ]
+        for name, search in matchers:
+            start = time.perf_counter()
+            blocks = search()
+            elapsed = time.perf_counter() - start
+            print(
+                f"{size:>8} {name:>12} {elapsed / size * 1e6:>9.2f} "
+                f"{len(blocks):>7} {len({block['id'] for block in blocks}):>7}"
+            )
+
+        # match on the mentioned page's id instead of its title
+        os.environ["SRS_MENTION_IDS"] = MENTION_PAGE_ID
+        notion_api.get_srs_mention_ids.cache_clear()
+        start = time.perf_counter()
+        blocks = notion_api.search_page_for_blocks_containing_mention(
+            "page", notion_api.MENTION_TEXT, children_by_id
+        )
+        elapsed = time.perf_counter() - start
+        os.environ["SRS_MENTION_IDS"] = ""
+        notion_api.get_srs_mention_ids.cache_clear()
+        print(
+            f"{size:>8} {'mention id':>12} {elapsed / size * 1e6:>9.2f} "
+            f"{len(blocks):>7} {len({block['id'] for block in blocks}):>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
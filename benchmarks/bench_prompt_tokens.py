@@ -0,0 +1,94 @@
+"""Compare the prompt tokens spent per card with and without trimming long
+blocks (scan_notion --max-block-tokens), and how many requests a cheap model
+would take (--cheap-model), against a local stub of the OpenAI API
+
+Run it with `python -m benchmarks.bench_prompt_tokens`
+"""
+
+import argparse
+import os
+import random
+import time
+
+from .stub_openai import StubOpenAIServer
+
+SENTENCE = (
+    "Power plants that can be started quickly, such as natural gas-fired "
+    "plants, are better suited to handle fluctuations in demand than plants "
+    "that take longer to start. "
+)
+
+
+def make_srs_block(i: int, num_sentences: int) -> dict:
+    # blocks pasted from elsewhere often carry line breaks and indentation
+    text = f"Fact number {i}:\n\n    " + SENTENCE * num_sentences
+    return {
+        "id": f"block-{i}",
+        "type": "paragraph",
+        "paragraph": {
+            "rich_text": [
+                {"plain_text": text, "annotations": {"strikethrough": False}},
+                {"plain_text": "@srs-item", "annotations": {"strikethrough": False}},
+            ]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-blocks", type=int, default=100)
+    # the share of blocks that are whole pasted paragraphs rather than a
+    # sentence or two
+    parser.add_argument("--long-block-probability", type=float, default=0.3)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    srs_blocks = [
+        make_srs_block(
+            i, rng.randint(20, 60) if rng.random() < args.long_block_probability else 1
+        )
+        for i in range(args.num_blocks)
+    ]
+    with StubOpenAIServer(latency_seconds=args.latency_ms / 1000) as stub:
+        # the OpenAI client reads these when it's first used
+        os.environ["OPENAI_BASE_URL"] = stub.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        from lib import intelligence
+        from lib.metrics import metrics
+        from lib.prompts import DEFAULT_MAX_BLOCK_TOKENS, ModelRouting
+
+        intelligence.use_llm_cache(None)
+        intelligence.use_model_routing(
+            ModelRouting(intelligence.MODEL_VERSION, "cheap-model")
+        )
+        print(
+            f"{args.num_blocks} blocks, {args.long_block_probability:.0%} of them "
+            f"long, {args.latency_ms:.0f}ms stub latency\n"
+        )
+        print(
+            f"{'max block tokens':<18} {'wall time':>10} {'prompt tok/card':>16} "
+            f"{'cheap requests':>15}"
+        )
+        for max_block_tokens in [None, DEFAULT_MAX_BLOCK_TOKENS, 100]:
+            intelligence.use_max_block_tokens(max_block_tokens)
+            metrics.reset()
+            stub.reset_counters()
+            start = time.perf_counter()
+            intelligence.create_anki_cards_from_srs_blocks(
+                srs_blocks, args.concurrency, "two_call"
+            )
+            elapsed = time.perf_counter() - start
+            num_cheap_requests = metrics.get_counter(
+                "llm_requests_total", model="cheap-model"
+            )
+            print(
+                f"{str(max_block_tokens or 'no trimming'):<18} {elapsed:>9.2f}s "
+                f"{stub.prompt_tokens / args.num_blocks:>16.1f} "
+                f"{num_cheap_requests / stub.num_requests:>15.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measure how long the CLI takes to start, and check that starting it doesn't
+import any of the heavy SDKs, which should only be imported once a client is
+actually needed (see lib/clients.py)
+
+Each command is run in a fresh interpreter with `python -X importtime`. The
+script exits with an error if a heavy SDK is imported or if the median
+startup time is over --max-ms, so it can be used as a check before merging.
+
+Run it with `python -m benchmarks.bench_startup`
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+# The SDKs that make up most of the CLI's startup time when they're imported
+HEAVY_MODULES = ["openai", "notion_client", "structlog", "requests", "httpx"]
+
+# What we start the CLI with. `import main` is everything the CLI imports
+# before it parses its arguments
+COMMANDS = {
+    "import main": ["-c", "import main"],
+    "main.py --help": ["main.py", "--help"],
+    "generate_cards --help": ["main.py", "generate_cards", "--help"],
+}
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_with_importtime(args: List[str]) -> Tuple[float, Dict[str, int]]:
+    """Run python with `args`, returning the wall time in seconds and the
+    cumulative import time in microseconds of each top-level package"""
+    # none of the API keys should be needed just to start the CLI
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("NOTION_KEY", "OPENAI_API_KEY", "DECK_NAME")
+    }
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=REPO_DIRECTORY,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    import_times: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # e.g. "import time:       711 |    1315045 | main"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        import_times[package] = max(
+            import_times.get(package, 0), int(cumulative.strip())
+        )
+    return elapsed, import_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=300,
+        help="Fail if any command's median startup time is over this",
+    )
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    failures: List[str] = []
+    print(f"{'command':<24} {'median ms':>10} {'max ms':>8}  slowest imports")
+    for command, command_args in COMMANDS.items():
+        elapsed_times = []
+        for _ in range(args.runs):
+            elapsed, import_times = run_with_importtime(command_args)
+            elapsed_times.append(elapsed * 1000)
+        median_ms = statistics.median(elapsed_times)
+
+        slowest = sorted(import_times.items(), key=lambda item: -item[1])
+        print(
+            f"{command:<24} {median_ms:>10.0f} {max(elapsed_times):>8.0f}  "
+            + ", ".join(
+                f"{name} {micros / 1000:.0f}ms" for name, micros in slowest[: args.top]
+            )
+        )
+
+        heavy_imports = [name for name in HEAVY_MODULES if name in import_times]
+        if heavy_imports:
+            failures.append(f"{command} imports {', '.join(heavy_imports)}")
+        if median_ms > args.max_ms:
+            failures.append(
+                f"{command} took {median_ms:.0f}ms, over the {args.max_ms:.0f}ms budget"
+            )
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Compare scanning several tenants' Notion workspaces one after another (as
+separate scan_notion runs would) with scanning them all at once with
+scan_notion --tenants-config, against local stand-ins for Notion and OpenAI
+
+Each tenant has their own Notion integration key, so each is throttled by its
+own rate limiter, and all of them share the LLM workers.
+
+Run it with `python -m benchmarks.bench_tenants`
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from .stub_notion import StubNotionServer, make_synthetic_workspace
+from .stub_openai import StubOpenAIServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-tenants", type=int, default=4)
+    parser.add_argument("--num-pages", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--mention-probability", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    # a faster rate limit than Notion's real 3 requests per second, so that
+    # the benchmark doesn't take minutes
+    parser.add_argument("--notion-requests-per-second", type=float, default=20)
+    args = parser.parse_args()
+
+    workspace = make_synthetic_workspace(
+        args.num_pages, args.depth, args.fanout, args.mention_probability
+    )
+    with (
+        StubNotionServer(workspace, latency_seconds=0.05) as notion_stub,
+        StubOpenAIServer(latency_seconds=0.2, jitter_seconds=0.2) as openai_stub,
+    ):
+        os.environ["NOTION_BASE_URL"] = notion_stub.base_url
+        os.environ["OPENAI_BASE_URL"] = openai_stub.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        for i in range(args.num_tenants):
+            os.environ[f"TENANT_{i}_NOTION_KEY"] = f"secret_stub_{i}"
+        import main as cli
+        from lib import notion_api
+        from lib.intelligence import use_llm_cache
+        from lib.tenants import Tenant
+
+        notion_api.rate_limiter = notion_api.TokenBucket(
+            args.notion_requests_per_second, args.notion_requests_per_second
+        )
+        use_llm_cache(None)
+        notion_api.use_block_tree_cache(None)
+
+        def scan(tenants, one_at_a_time: bool) -> float:
+            """Scan the tenants, returning how many seconds it took"""
+            # each run starts with empty rate limiters
+            notion_api.rate_limiters_by_key.clear()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if one_at_a_time:
+                    for tenant in tenants:
+                        cli.scan_tenants(
+                            [tenant], args.concurrency, True, args.llm_concurrency
+                        )
+                else:
+                    cli.scan_tenants(
+                        tenants, args.concurrency, True, args.llm_concurrency
+                    )
+            return time.perf_counter() - start
+
+        print(
+            f"{args.num_tenants} tenants, {len(workspace.pages)} pages and "
+            f"{workspace.num_blocks} blocks each, "
+            f"{args.notion_requests_per_second:g} Notion requests/s per tenant\n"
+        )
+        print(f"{'':<16} {'wall time':>10} {'notion req/s':>13} {'llm req/s':>10}")
+        for name, one_at_a_time in [("one at a time", True), ("all at once", False)]:
+            with tempfile.TemporaryDirectory() as directory:
+                tenants = [
+                    Tenant(
+                        f"tenant-{i}",
+                        f"Deck {i}",
+                        f"TENANT_{i}_NOTION_KEY",
+                        directory=os.path.join(directory, f"tenant-{i}"),
+                    )
+                    for i in range(args.num_tenants)
+                ]
+                notion_stub.reset_counters()
+                openai_stub.reset_counters()
+                elapsed = scan(tenants, one_at_a_time)
+            print(
+                f"{name:<16} {elapsed:>9.2f}s "
+                f"{notion_stub.num_requests / elapsed:>13.1f} "
+                f"{openai_stub.num_requests / elapsed:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
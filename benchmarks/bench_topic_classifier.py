@@ -0,0 +1,112 @@
+"""Compare picking blocks' topics with the local topic classifier (scan_notion
+--topic-classifier local) against picking them with an LLM request each, on a
+synthetic set of labeled blocks and a local stub of the OpenAI API
+
+Run it with `python -m benchmarks.bench_topic_classifier`
+"""
+
+import argparse
+import os
+import random
+import time
+
+from .stub_openai import StubOpenAIServer
+
+# a few words that only come up in blocks about each topic
+TOPIC_WORDS = {
+    "World History": "empire dynasty revolution treaty medieval colonial war king pharaoh renaissance",
+    "Science and Technology": "software computer algorithm internet semiconductor engineer chip network robot laser",
+    "Geography and Cultures": "river mountain continent language festival cuisine capital island desert tribe",
+    "Arts and Literature": "novel poem painter sculpture author opera symphony theatre sonnet gallery",
+    "Biology and Medicine": "cell protein gene virus enzyme organ disease vaccine neuron bacteria",
+    "Environmental Science and Ecology": "climate species habitat carbon forest ecosystem pollution coral drought wetland",
+    "Philosophy and Religion": "ethics god virtue metaphysics soul buddhism kant scripture morality stoic",
+    "Economics and Business": "market inflation price demand supply company profit tax investor trade",
+    "Political Science and Law": "court constitution election parliament statute judge democracy senate rights policy",
+    "Mathematics and Physics": "theorem equation prime integral quantum energy particle vector gravity proof",
+}
+
+# words that come up in blocks about any topic
+SHARED_WORDS = (
+    "first large important early new small modern known called often many".split()
+)
+
+
+def make_labeled_texts(num_texts: int, rng: random.Random):
+    topics = list(TOPIC_WORDS)
+    texts, labels = [], []
+    for _ in range(num_texts):
+        topic = rng.choice(topics)
+        other_topic = rng.choice(topics)
+        words = (
+            rng.sample(TOPIC_WORDS[topic].split(), rng.randint(1, 4))
+            + rng.sample(TOPIC_WORDS[other_topic].split(), 1)
+            + rng.sample(SHARED_WORDS, 4)
+        )
+        rng.shuffle(words)
+        texts.append("The " + " ".join(words) + ".")
+        labels.append(topic)
+    return texts, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-training-cards", type=int, default=500)
+    parser.add_argument("--num-blocks", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    training_texts, training_topics = make_labeled_texts(args.num_training_cards, rng)
+    texts, topics = make_labeled_texts(args.num_blocks, rng)
+
+    with StubOpenAIServer(latency_seconds=args.latency_ms / 1000) as stub:
+        # the OpenAI client reads these when it's first used
+        os.environ["OPENAI_BASE_URL"] = stub.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        from lib import intelligence
+        from lib.topic_classifier import TopicClassifier
+
+        intelligence.use_llm_cache(None)
+
+        start = time.perf_counter()
+        classifier = TopicClassifier.train(training_texts, training_topics)
+        training_seconds = time.perf_counter() - start
+        print(
+            f"trained on {args.num_training_cards} cards in "
+            f"{training_seconds * 1000:.1f}ms, classifying {args.num_blocks} blocks\n"
+        )
+
+        start = time.perf_counter()
+        predictions = classifier.predict(texts)
+        local_seconds = time.perf_counter() - start
+        # a handful of blocks is enough to time the LLM, since every request
+        # takes about the stub's latency
+        num_llm_blocks = 10
+        start = time.perf_counter()
+        for text in texts[:num_llm_blocks]:
+            intelligence.get_topic_from_text(text)
+        llm_seconds = (time.perf_counter() - start) / num_llm_blocks * args.num_blocks
+
+        print(f"{'':<8} {'time/block':>12}")
+        print(f"{'local':<8} {local_seconds / args.num_blocks * 1e6:>10.1f}us")
+        print(f"{'llm':<8} {llm_seconds / args.num_blocks * 1e6:>10.1f}us\n")
+
+        print(f"{'min confidence':<15} {'local share':>12} {'local accuracy':>15}")
+        for min_confidence in [0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
+            confident = [
+                (predicted_topic, topic)
+                for (predicted_topic, probability), topic in zip(predictions, topics)
+                if probability >= min_confidence
+            ]
+            num_correct = len(
+                [1 for predicted, actual in confident if predicted == actual]
+            )
+            print(
+                f"{min_confidence:<15} {len(confident) / len(topics):>12.0%} "
+                f"{num_correct / max(1, len(confident)):>15.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from typing import Dict, List, Optional, Tuple
+
+from .stub_server import StubServer
+
+
+class StubAnkiConnectServer(StubServer):
+    """A local stand-in for the Anki Connect addon's HTTP API
+
+    It supports the `addNote` and `multi` actions, rejecting notes whose text
+    is already in the stub's deck as duplicates, the same way Anki Connect does.
+
+    Use it as a context manager, and point lib/anki_utils.py at `url` by
+    setting the ANKI_CONNECT_URL environment variable
+    """
+
+    def __init__(self, latency_seconds: float = 0.001, **kwargs):
+        super().__init__(latency_seconds, **kwargs)
+        self.notes: dict = {}
+
+    @property
+    def url(self) -> str:
+        return self.address
+
+    def handle_action(self, action: str, params: dict) -> dict:
+        """Run a single Anki Connect action, returning its {result, error} response"""
+        if action == "multi":
+            return {
+                "result": [
+                    self.handle_action(a["action"], a.get("params", {}))
+                    for a in params["actions"]
+                ],
+                "error": None,
+            }
+        if action == "addNote":
+            text = params["note"]["fields"]["Text"]
+            with self._lock:
+                if text in self.notes.values():
+                    return {
+                        "result": None,
+                        "error": "cannot create note because it is a duplicate",
+                    }
+                note_id = len(self.notes) + 1
+                self.notes[note_id] = text
+            return {"result": note_id, "error": None}
+        return {"result": None, "error": f"unsupported action {action}"}
+
+    def handle_request(
+        self, method: str, path: str, query: Dict[str, List[str]], body: Optional[Dict]
+    ) -> Tuple[int, Dict]:
+        return 200, self.handle_action(body["action"], body.get("params", {}))
+
+    def make_rate_limit_response(self) -> Dict:
+        # Anki Connect runs locally and never rate limits, but this keeps the
+        # response shape right if a profile asks for it
+        return {"result": None, "error": "rate limited"}
@@ -0,0 +1,210 @@
+import json
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .stub_server import StubServer
+
+# The number of results the stub returns per page of a paginated endpoint,
+# the same as Notion's default page size
+STUB_PAGE_SIZE = 100
+
+STUB_LAST_EDITED_TIME = "2099-01-01T00:00:00.000Z"
+
+BLOCK_CHILDREN_PATH = re.compile(r"^/v1/blocks/([^/]+)/children$")
+BLOCK_PATH = re.compile(r"^/v1/blocks/([^/]+)$")
+PAGE_PATH = re.compile(r"^/v1/pages/([^/]+)$")
+DATABASE_QUERY_PATH = re.compile(r"^/v1/databases/([^/]+)/query$")
+
+
+@dataclass
+class StubWorkspace:
+    """The pages and block trees a StubNotionServer serves
+
+    `children_by_id` maps a page/block id to its list of child blocks, the same
+    shape that `lib.notion_api.iterate_block_trees` builds. A workspace can be
+    saved to and loaded from a JSON fixture, so the same workspace can be
+    replayed across benchmark runs.
+    """
+
+    pages: List[Dict] = field(default_factory=list)
+    children_by_id: Dict[str, List[Dict]] = field(default_factory=dict)
+
+    @property
+    def num_blocks(self) -> int:
+        return sum(len(children) for children in self.children_by_id.values())
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "w") as f:
+            json.dump({"pages": self.pages, "children_by_id": self.children_by_id}, f)
+
+    @staticmethod
+    def load(filepath: str) -> "StubWorkspace":
+        with open(filepath) as f:
+            fixture = json.load(f)
+        return StubWorkspace(fixture["pages"], fixture["children_by_id"])
+
+
+def make_rich_text(text: str, is_mention: bool = False) -> Dict:
+    section = {
+        "annotations": {
+            "bold": False,
+            "code": False,
+            "color": "default",
+            "italic": False,
+            "strikethrough": False,
+            "underline": False,
+        },
+        "href": None,
+        "plain_text": text,
+        "type": "text",
+        "text": {"content": text, "link": None},
+    }
+    if is_mention:
+        section["type"] = "mention"
+        section["mention"] = {"type": "page", "page": {"id": "stub-srs-item-page"}}
+        del section["text"]
+    return section
+
+
+def make_synthetic_workspace(
+    num_pages: int = 20,
+    depth: int = 3,
+    fanout: int = 5,
+    mention_probability: float = 0.1,
+    seed: int = 0,
+) -> StubWorkspace:
+    """Build a workspace of `num_pages` pages, each with a tree of paragraphs
+    up to `depth` levels deep and `fanout` blocks wide. About half of the
+    blocks above the bottom level have children, and `mention_probability`
+    of the blocks have an srs-item mention"""
+    rng = random.Random(seed)
+    workspace = StubWorkspace()
+
+    def add_children(parent_id: str, level: int) -> None:
+        children = []
+        for _ in range(fanout):
+            block_id = f"block-{workspace.num_blocks + len(children)}"
+            rich_text = [
+                make_rich_text(
+                    f"{block_id} says that power plants that can be started "
+                    "quickly are better suited to handle changes in demand "
+                )
+            ]
+            if rng.random() < mention_probability:
+                rich_text.append(make_rich_text("srs-item", is_mention=True))
+            children.append(
+                {
+                    "object": "block",
+                    "id": block_id,
+                    "type": "paragraph",
+                    "has_children": level < depth and rng.random() < 0.5,
+                    "last_edited_time": STUB_LAST_EDITED_TIME,
+                    "parent": {"type": "block_id", "block_id": parent_id},
+                    "paragraph": {"color": "default", "rich_text": rich_text},
+                }
+            )
+        workspace.children_by_id[parent_id] = children
+        for child in children:
+            if child["has_children"]:
+                add_children(child["id"], level + 1)
+
+    for i in range(num_pages):
+        page_id = f"page-{i}"
+        workspace.pages.append(
+            {
+                "object": "page",
+                "id": page_id,
+                "last_edited_time": STUB_LAST_EDITED_TIME,
+                "parent": {"type": "workspace", "workspace": True},
+                "properties": {},
+            }
+        )
+        add_children(page_id, 1)
+    return workspace
+
+
+def paginate(results: List[Dict], start_cursor: Optional[str]) -> Dict:
+    """Return one page of `results` in the shape of a Notion list response,
+    using the index of the next result as the cursor"""
+    start = int(start_cursor or 0)
+    end = start + STUB_PAGE_SIZE
+    has_more = end < len(results)
+    return {
+        "object": "list",
+        "results": results[start:end],
+        "has_more": has_more,
+        "next_cursor": str(end) if has_more else None,
+    }
+
+
+class StubNotionServer(StubServer):
+    """A local stand-in for the parts of the Notion API that lib/notion_api.py
+    uses: search, databases.query, pages.retrieve, blocks.children.list and
+    blocks.update, serving a StubWorkspace
+
+    Every page is in the workspace and in a single stub database, so database
+    scopes can be benchmarked too. Updated blocks are written back to the
+    workspace.
+
+    Use it as a context manager, and point lib/notion_api.py at `base_url`
+    with the NOTION_BASE_URL environment variable
+    """
+
+    def __init__(
+        self, workspace: StubWorkspace, latency_seconds: float = 0.0, **kwargs
+    ):
+        super().__init__(latency_seconds, **kwargs)
+        self.workspace = workspace
+        self.blocks_by_id = {
+            block["id"]: block
+            for children in workspace.children_by_id.values()
+            for block in children
+        }
+        self.pages_by_id = {page["id"]: page for page in workspace.pages}
+
+    @property
+    def base_url(self) -> str:
+        return self.address
+
+    def handle_request(
+        self, method: str, path: str, query: Dict[str, List[str]], body: Optional[Dict]
+    ) -> Tuple[int, Dict]:
+        body = body or {}
+        if method == "POST" and path == "/v1/search":
+            return 200, paginate(self.workspace.pages, body.get("start_cursor"))
+        if method == "POST" and DATABASE_QUERY_PATH.match(path):
+            return 200, paginate(self.workspace.pages, body.get("start_cursor"))
+
+        match = BLOCK_CHILDREN_PATH.match(path)
+        if method == "GET" and match:
+            children = self.workspace.children_by_id.get(match.group(1), [])
+            start_cursor = query.get("start_cursor", [None])[0]
+            return 200, paginate(children, start_cursor)
+
+        match = PAGE_PATH.match(path)
+        if method == "GET" and match and match.group(1) in self.pages_by_id:
+            return 200, self.pages_by_id[match.group(1)]
+
+        match = BLOCK_PATH.match(path)
+        if method == "PATCH" and match and match.group(1) in self.blocks_by_id:
+            block = self.blocks_by_id[match.group(1)]
+            with self._lock:
+                block[block["type"]].update(body.get(block["type"], {}))
+            return 200, block
+
+        return 404, {
+            "object": "error",
+            "status": 404,
+            "code": "object_not_found",
+            "message": f"Could not find {path}",
+        }
+
+    def make_rate_limit_response(self) -> Dict:
+        return {
+            "object": "error",
+            "status": 429,
+            "code": "rate_limited",
+            "message": "You have been rate limited. Please try again in a few minutes.",
+        }
@@ -0,0 +1,97 @@
+import json
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .stub_server import StubServer
+
+# A very rough token estimate, good enough for comparing prompt sizes
+CHARS_PER_TOKEN = 4
+
+STUB_TOPIC = "Economics and Business"
+STUB_CARD_TEXT = "A natural gas plant takes about {{c1::10 minutes}} to start"
+
+
+class StubOpenAIServer(StubServer):
+    """A local stand-in for the OpenAI chat completions endpoint
+
+    Every request returns a canned response shaped like the one the prompt
+    asked for. On top of the request counters of StubServer, the server counts
+    the (estimated) tokens it would have billed for.
+
+    Use it as a context manager, and point the OpenAI client at `base_url`
+    (e.g. with the OPENAI_BASE_URL environment variable)
+    """
+
+    def __init__(self, latency_seconds: float = 0.05, **kwargs):
+        super().__init__(latency_seconds, **kwargs)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.address}/v1"
+
+    def reset_counters(self) -> None:
+        super().reset_counters()
+        with self._lock:
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def respond(self, request: dict) -> str:
+        """Build the content of the stub's response to a chat completion request"""
+        user_prompt = request["messages"][-1]["content"]
+        if request.get("response_format", {}).get("type") == "json_object":
+            indices = re.findall(r"\*\*Input Paragraph (\d+):\*\*", user_prompt)
+            if indices:
+                cards = [
+                    {"index": int(i), "topic": STUB_TOPIC, "card": STUB_CARD_TEXT}
+                    for i in indices
+                ]
+                return json.dumps({"cards": cards})
+            return json.dumps({"topic": STUB_TOPIC, "card": STUB_CARD_TEXT})
+        if "categorize" in user_prompt:
+            return STUB_TOPIC
+        return STUB_CARD_TEXT
+
+    def handle_request(
+        self, method: str, path: str, query: Dict[str, List[str]], body: Optional[Dict]
+    ) -> Tuple[int, Dict]:
+        content = self.respond(body)
+        prompt_tokens = (
+            sum(len(message["content"]) for message in body["messages"])
+            // CHARS_PER_TOKEN
+        )
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+        return 200, {
+            "id": f"chatcmpl-stub-{self.num_requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def make_rate_limit_response(self) -> Dict:
+        return {
+            "error": {
+                "message": "Rate limit reached for requests",
+                "type": "requests",
+                "param": None,
+                "code": "rate_limit_exceeded",
+            }
+        }
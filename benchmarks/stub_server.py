@@ -0,0 +1,135 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 connections makes concurrent clients wait ~1s
+    # for a SYN retry, which would show up as latency that isn't ours
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubServer:
+    """A local HTTP server that stands in for one of the APIs we talk to
+
+    Every request sleeps for `latency_seconds` plus up to `jitter_seconds` of
+    random extra latency. A `rate_limit_probability` fraction of requests are
+    rejected with a 429 and a Retry-After of `retry_after_seconds`, so that
+    the rate limit handling of the code under test is exercised too. The
+    server counts the requests it serves in `num_requests` and the ones it
+    rate limited in `num_rate_limited`, and remembers how long each request
+    took to serve in `latencies`.
+
+    Subclasses implement `handle_request` and `make_rate_limit_response`. Use
+    it as a context manager.
+    """
+
+    def __init__(
+        self,
+        latency_seconds: float = 0.0,
+        jitter_seconds: float = 0.0,
+        rate_limit_probability: float = 0.0,
+        retry_after_seconds: float = 1.0,
+        port: int = 0,
+        seed: int = 0,
+    ):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after_seconds = retry_after_seconds
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.latencies: List[float] = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = StubHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "StubServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.num_requests = 0
+            self.num_rate_limited = 0
+            self.latencies = []
+
+    def handle_request(
+        self, method: str, path: str, query: Dict[str, List[str]], body: Optional[Dict]
+    ) -> Tuple[int, Dict]:
+        """Return the (status code, JSON body) response to a request"""
+        raise NotImplementedError
+
+    def make_rate_limit_response(self) -> Dict:
+        """The JSON body of a 429 response, in the shape the real API uses"""
+        raise NotImplementedError
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                self.respond("GET")
+
+            def do_POST(self) -> None:
+                self.respond("POST")
+
+            def do_PATCH(self) -> None:
+                self.respond("PATCH")
+
+            def respond(self, method: str) -> None:
+                start = time.perf_counter()
+                length = int(self.headers.get("content-length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                with stub._lock:
+                    latency = stub.latency_seconds + stub._random.uniform(
+                        0, stub.jitter_seconds
+                    )
+                    is_rate_limited = (
+                        stub._random.random() < stub.rate_limit_probability
+                    )
+                time.sleep(latency)
+
+                headers = {"content-type": "application/json"}
+                if is_rate_limited:
+                    status = 429
+                    response = stub.make_rate_limit_response()
+                    headers["retry-after"] = str(stub.retry_after_seconds)
+                else:
+                    url = urlparse(self.path)
+                    status, response = stub.handle_request(
+                        method, url.path, parse_qs(url.query), body
+                    )
+
+                with stub._lock:
+                    stub.num_requests += 1
+                    stub.num_rate_limited += int(is_rate_limited)
+                    stub.latencies.append(time.perf_counter() - start)
+
+                encoded = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("content-length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+        return Handler
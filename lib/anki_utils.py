@@ -1,20 +1,100 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from dataclasses import dataclass
 import json
-import requests
-import os
-from dotenv import load_dotenv
+from .clients import get_anki_connect_url, get_anki_session, get_deck_name
+from .metrics import metrics
+
+# The default number of notes we add to Anki in a single Anki Connect request
+DEFAULT_ANKI_CHUNK_SIZE = 50
+
+# The error Anki Connect responds with when a note is already in the deck
+DUPLICATE_NOTE_ERROR = "cannot create note because it is a duplicate"
+
+# The fields of a Notion rich text section that we keep in a block snapshot,
+# which are what we need to write the section back with a strikethrough, and
+# its text
+RICH_TEXT_SECTION_FIELDS = [
+    "type",
+    "text",
+    "mention",
+    "equation",
+    "annotations",
+    "href",
+    "plain_text",
+]
+
+# The annotations Notion gives plain text, which we leave out of block
+# snapshots since Notion fills them in again when the block is updated
+DEFAULT_ANNOTATIONS = {
+    "bold": False,
+    "italic": False,
+    "strikethrough": False,
+    "underline": False,
+    "code": False,
+    "color": "default",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class AnkiCard:
+    text: str
+    # a snapshot of the Notion block the card was generated from, see
+    # `make_block_snapshot`
+    notion_block: Dict
+    # one of intelligence.TOPICS, or None for cards generated before topics
+    # were kept
+    topic: Optional[str] = None
+    # who picked the topic, one of card_store.TOPIC_SOURCES, or None if
+    # that wasn't kept
+    topic_source: Optional[str] = None
+
+
+def make_block_snapshot(block: Dict) -> Dict:
+    """Keep only the parts of a raw Notion block that a card needs: its id, its
+    type and its rich text, without the annotations and links that are unset
+
+    A raw block also has its parent, its timestamps, who created and last
+    edited it and so on, which make up most of its size and which we never
+    use once the card is generated. Taking the snapshot of a snapshot returns
+    the same snapshot
+    """
+    block_type = block["type"]
+    rich_text = []
+    for section in block.get(block_type, {}).get("rich_text", []):
+        slim_section = {
+            field: section[field]
+            for field in RICH_TEXT_SECTION_FIELDS
+            if section.get(field) is not None
+        }
+        if "text" in slim_section:
+            slim_section["text"] = {
+                name: value
+                for name, value in slim_section["text"].items()
+                if value is not None
+            }
+        annotations = {
+            name: value
+            for name, value in slim_section.pop("annotations", {}).items()
+            if DEFAULT_ANNOTATIONS.get(name) != value
+        }
+        if annotations:
+            slim_section["annotations"] = annotations
+        rich_text.append(slim_section)
+    return {"id": block["id"], "type": block_type, block_type: {"rich_text": rich_text}}
 
-load_dotenv()  # take environment variables from .env.
 
-# This is the deck that you want to add cards to
-DECK_NAME = os.environ["DECK_NAME"]
+@dataclass(frozen=True)
+class AddNoteResult:
+    """The outcome of adding a single card to the deck in `add_anki_cards_to_deck`.
+    Exactly one of `note_id` and `error` is set"""
 
+    card: AnkiCard
+    note_id: Optional[int]
+    error: Optional[str]
 
-@dataclass(frozen=True)
-class AnkiCard:
-    text: str
-    notion_block: Dict
+    @property
+    def is_duplicate(self) -> bool:
+        return self.error is not None and DUPLICATE_NOTE_ERROR in self.error
 
 
 def build_anki_connect_request(action, **params):
@@ -33,9 +113,9 @@ def anki_call(action: str, **params: Any) -> Dict:
     """
     request_json = json.dumps(build_anki_connect_request(action, **params))
 
-    # We assume that Anki has been setup with the Anki Connect addon, and is
-    # currently running
-    response = requests.post("http://127.0.0.1:8765", data=request_json)
+    metrics.increment("anki_requests_total", action=action)
+    with metrics.time("anki_request_seconds", action=action):
+        response = get_anki_session().post(get_anki_connect_url(), data=request_json)
     response.raise_for_status()
     response_data = response.json()  # Parse JSON directly
 
@@ -51,21 +131,55 @@ def anki_call(action: str, **params: Any) -> Dict:
     return response_data["result"]
 
 
-def add_anki_card_to_deck(card: AnkiCard) -> None:
-    """Adds an Anki card to the deck specified in the .env using Anki Connect"""
-    note_params = {
-        "deckName": DECK_NAME,
+def add_anki_cards_to_deck(
+    cards: List[AnkiCard], chunk_size: int = DEFAULT_ANKI_CHUNK_SIZE
+) -> List[AddNoteResult]:
+    """Adds many Anki cards to the deck specified in the .env using Anki Connect
+
+    Rather than making one request per card, we send `chunk_size` addNote
+    actions at a time in a single `multi` request. Unlike `addNotes`, `multi`
+    reports an error for each individual action, so a duplicate or otherwise
+    invalid card doesn't stop the rest of its chunk from being added.
+
+    Returns an AddNoteResult for each card, in the same order as `cards`
+    """
+    results: List[AddNoteResult] = []
+    for start in range(0, len(cards), chunk_size):
+        chunk = cards[start : start + chunk_size]
+        actions = [
+            build_anki_connect_request("addNote", note=build_note_params(card))
+            for card in chunk
+        ]
+        action_responses = anki_call("multi", actions=actions)
+        if len(action_responses) != len(chunk):
+            raise Exception("multi response has an unexpected number of results")
+
+        for card, action_response in zip(chunk, action_responses):
+            # with version 6 of the API, each action's response has the same
+            # {"result": ..., "error": ...} shape as a regular response
+            error = action_response.get("error")
+            if error is not None:
+                results.append(AddNoteResult(card, None, str(error)))
+            else:
+                results.append(AddNoteResult(card, action_response["result"], None))
+
+    return results
+
+
+def build_note_params(card: AnkiCard) -> Dict:
+    """Build the Anki Connect note parameters for adding a card to our deck"""
+    deck_name = get_deck_name()
+    return {
+        "deckName": deck_name,
         "modelName": "Cloze",
         "fields": {"Text": card.text},
         "options": {
             "allowDuplicate": False,
             "duplicateScope": "deck",
             "duplicateScopeOptions": {
-                "deckName": DECK_NAME,
+                "deckName": deck_name,
                 "checkChildren": False,
                 "checkAllModels": False,
             },
         },
     }
-
-    anki_call("addNote", note=note_params)
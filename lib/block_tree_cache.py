@@ -0,0 +1,176 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from .metrics import metrics
+from .scan_index import LAST_EDITED_TIME_RESOLUTION_SECONDS
+
+# default filepath of the SQLite database that caches the block trees of pages
+BLOCK_TREE_CACHE_FILEPATH = "out/block_tree_cache.sqlite3"
+
+# The max number of page trees we keep in memory, in front of the on-disk
+# cache. When there are more than this, the least recently used are dropped
+BLOCK_TREE_CACHE_MAX_MEMORY_ENTRIES = 256
+
+# The max number of page trees we keep on disk. When there are more than this,
+# the least recently used are evicted first
+BLOCK_TREE_CACHE_MAX_ENTRIES = 5_000
+
+# How many trees are written between evictions, so that a long-running
+# `watch` stays under BLOCK_TREE_CACHE_MAX_ENTRIES (give or take this many)
+# without paying for an eviction on every write
+BLOCK_TREE_CACHE_WRITES_PER_EVICTION = 100
+
+# (the page's last_edited_time, when the tree was fetched, children_by_id)
+CachedTree = Tuple[str, float, Dict[str, List[Dict]]]
+
+
+class BlockTreeCache:
+    """A two-tier cache of the block trees beneath Notion pages, an in-memory
+    LRU in front of a SQLite file
+
+    Each entry is a page's `children_by_id` (see
+    `notion_api.iterate_block_trees`) along with the page's `last_edited_time`
+    when the tree was fetched, which works like an ETag: Notion bumps a
+    page's timestamp on any edit anywhere in the page, so while the timestamp
+    hasn't moved the cached tree is still what Notion would send back. A
+    block's own timestamp isn't enough for this, since editing a child block
+    doesn't bump its parent's. Trees fetched within
+    LAST_EDITED_TIME_RESOLUTION_SECONDS of the page's timestamp may be missing
+    an edit made in the same minute, so they're never served.
+
+    The cache is shared between the crawl threads, so every access goes
+    through a lock. Lookups are counted in the block_tree_cache_lookups_total
+    metric, labelled with whether they hit memory, hit disk, were stale or
+    missed.
+    """
+
+    def __init__(
+        self,
+        filepath: str = BLOCK_TREE_CACHE_FILEPATH,
+        max_memory_entries: int = BLOCK_TREE_CACHE_MAX_MEMORY_ENTRIES,
+        max_entries: int = BLOCK_TREE_CACHE_MAX_ENTRIES,
+        writes_per_eviction: int = BLOCK_TREE_CACHE_WRITES_PER_EVICTION,
+    ):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_memory_entries = max_memory_entries
+        self.max_entries = max_entries
+        self.writes_per_eviction = writes_per_eviction
+        self.num_writes_since_eviction = 0
+        self.memory: "OrderedDict[str, CachedTree]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS block_trees (
+                page_id TEXT PRIMARY KEY,
+                last_edited_time TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                children_by_id TEXT NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+            """)
+        self.connection.commit()
+        self.evict()
+
+    def get(self, page: Dict) -> Optional[Dict[str, List[Dict]]]:
+        """The cached block tree of `page`, if the page hasn't changed since it
+        was fetched"""
+        with self._lock:
+            cached_tree = self.memory.get(page["id"])
+            result = "memory_hit"
+            if cached_tree is not None:
+                self.memory.move_to_end(page["id"])
+            else:
+                cached_tree = self._get_from_disk(page["id"])
+                result = "disk_hit"
+            if cached_tree is None:
+                result = "miss"
+            elif not is_fresh(cached_tree, page["last_edited_time"]):
+                result = "stale"
+
+        metrics.increment("block_tree_cache_lookups_total", result=result)
+        if result in ("miss", "stale"):
+            return None
+        return cached_tree[2]
+
+    def set(self, page: Dict, children_by_id: Dict[str, List[Dict]]) -> None:
+        now = time.time()
+        cached_tree = (page["last_edited_time"], now, children_by_id)
+        with self._lock:
+            self._remember(page["id"], cached_tree)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO block_trees (page_id, last_edited_time, fetched_at, children_by_id, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    page["id"],
+                    page["last_edited_time"],
+                    now,
+                    json.dumps(children_by_id),
+                    now,
+                ),
+            )
+            self.connection.commit()
+            self.num_writes_since_eviction += 1
+            if self.num_writes_since_eviction >= self.writes_per_eviction:
+                self._evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used trees until we're back under `max_entries`"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        self.connection.execute(
+            """
+            DELETE FROM block_trees WHERE page_id NOT IN (
+                SELECT page_id FROM block_trees ORDER BY last_used_at DESC LIMIT ?
+            )
+            """,
+            (self.max_entries,),
+        )
+        self.connection.commit()
+        self.num_writes_since_eviction = 0
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _get_from_disk(self, page_id: str) -> Optional[CachedTree]:
+        row = self.connection.execute(
+            "SELECT last_edited_time, fetched_at, children_by_id FROM block_trees WHERE page_id = ?",
+            (page_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE block_trees SET last_used_at = ? WHERE page_id = ?",
+            (time.time(), page_id),
+        )
+        self.connection.commit()
+        last_edited_time, fetched_at, children_by_id = row
+        cached_tree = (last_edited_time, fetched_at, json.loads(children_by_id))
+        self._remember(page_id, cached_tree)
+        return cached_tree
+
+    def _remember(self, page_id: str, cached_tree: CachedTree) -> None:
+        self.memory[page_id] = cached_tree
+        self.memory.move_to_end(page_id)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+
+def is_fresh(cached_tree: CachedTree, last_edited_time: str) -> bool:
+    """Whether a cached tree is still what Notion would send back for a page
+    whose `last_edited_time` is the given one"""
+    cached_last_edited_time, fetched_at, _ = cached_tree
+    if cached_last_edited_time != last_edited_time:
+        return False
+    return (
+        fetched_at
+        >= datetime.fromisoformat(last_edited_time).timestamp()
+        + LAST_EDITED_TIME_RESOLUTION_SECONDS
+    )
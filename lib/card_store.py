@@ -0,0 +1,331 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+from .anki_utils import AnkiCard, make_block_snapshot
+
+# default filepath of the SQLite database that stores the generated card text
+CARD_STORE_FILEPATH = "out/cards.sqlite3"
+
+# The lifecycle of a card in the store:
+#   - "pending": generated by scan_notion and waiting to be reviewed
+#   - "accepted": accepted during review, but not yet added to Anki
+#   - "rejected": rejected during review
+#   - "synced": added to Anki (or was already in the deck)
+CARD_STATUSES = ["pending", "accepted", "rejected", "synced"]
+
+# Who picked a card's topic:
+#   - "llm": the LLM, when the card was generated
+#   - "classifier": the local topic classifier, when the card was generated
+#   - "reviewer": the reviewer, who changed it during review
+# Only the topics picked by the LLM or the reviewer are used to train the
+# topic classifier, so that it never learns from its own guesses
+TOPIC_SOURCES = ["llm", "classifier", "reviewer"]
+
+# Everything that isn't a letter or a digit, which we ignore when comparing
+# card text for duplicates
+NON_ALPHANUMERIC_PATTERN = re.compile(r"[\W_]+")
+
+# The version of the format of the rows in the card store, kept in SQLite's
+# user_version. Version 1 stores block snapshots (see
+# `anki_utils.make_block_snapshot`) instead of raw Notion blocks
+CARD_STORE_VERSION = 1
+
+# The only class allowed in a *.pkl card file, which older versions of
+# scan_notion wrote as a list of AnkiCards
+LEGACY_PICKLE_CLASS = ("lib.anki_utils", "AnkiCard")
+
+
+@dataclass(frozen=True)
+class MergeResult:
+    """The outcome of merging new cards into the card store"""
+
+    num_added: int
+    # (new card's block id, existing card's block id) pairs for every new card
+    # whose text is the same as a card already in the store
+    duplicate_texts: List[Tuple[str, str]]
+
+
+class LegacyAnkiCard:
+    """What an AnkiCard pickled by an older version of scan_notion is loaded as,
+    before it's converted to an AnkiCard. Older AnkiCards were plain frozen
+    dataclasses, whose pickled state is their __dict__"""
+
+    text: str
+    notion_block: Dict
+
+
+class LegacyCardUnpickler(pickle.Unpickler):
+    """Unpickles a *.pkl card file without letting it construct anything other
+    than the AnkiCards it should contain, so loading a file from an older
+    version can't run arbitrary code"""
+
+    def find_class(self, module: str, name: str):
+        if (module, name) != LEGACY_PICKLE_CLASS:
+            raise pickle.UnpicklingError(
+                f"{module}.{name} is not allowed in a card pickle file"
+            )
+        return LegacyAnkiCard
+
+
+def load_legacy_pickle_file(pickle_filepath: str) -> List[AnkiCard]:
+    """Load the cards from a *.pkl file written by an older version of
+    scan_notion, keeping only a snapshot of each card's Notion block"""
+    with open(pickle_filepath, "rb") as f:
+        legacy_cards = LegacyCardUnpickler(f).load()
+    anki_cards = []
+    for card in legacy_cards:
+        topic = getattr(card, "topic", None)
+        # every topic was picked by the LLM before there was a topic classifier
+        topic_source = "llm" if topic is not None else None
+        anki_cards.append(
+            AnkiCard(
+                card.text, make_block_snapshot(card.notion_block), topic, topic_source
+            )
+        )
+    return anki_cards
+
+
+def fingerprint_card_text(text: str) -> str:
+    """Hash a card's text, ignoring case, whitespace and punctuation, so that
+    two blocks that produced the same cloze card can be detected"""
+    normalized_text = NON_ALPHANUMERIC_PATTERN.sub(" ", text.lower()).strip()
+    return hashlib.sha1(normalized_text.encode("utf-8")).hexdigest()
+
+
+class CardStore:
+    """A SQLite store of the Anki cards generated from Notion blocks
+
+    Cards are keyed on their Notion block id, so adding a card for a block
+    that's already in the store is a no-op, and adding new cards only costs
+    as much as the new cards themselves. Each card has a status (see
+    CARD_STATUSES) which is updated as soon as the card is reviewed, so a
+    review session that's interrupted picks up where it left off. Cards are
+    also indexed on a fingerprint of their text, so that new cards with the
+    same text as an existing card can be flagged. Each card keeps a snapshot
+    of its Notion block rather than the raw block, which is all we need to
+    mark the block as processed later.
+    """
+
+    def __init__(self, filepath: str = CARD_STORE_FILEPATH):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS cards (
+                block_id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                notion_block TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                fingerprint TEXT,
+                topic TEXT,
+                topic_source TEXT
+            )
+            """)
+        # card stores created before fingerprints were added need the column
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(cards)")
+        ]
+        if "fingerprint" not in columns:
+            self.connection.execute("ALTER TABLE cards ADD COLUMN fingerprint TEXT")
+            for block_id, text in self.connection.execute(
+                "SELECT block_id, text FROM cards"
+            ).fetchall():
+                self.connection.execute(
+                    "UPDATE cards SET fingerprint = ? WHERE block_id = ?",
+                    (fingerprint_card_text(text), block_id),
+                )
+        # and so do card stores created before topics were kept, whose cards
+        # are left without a topic
+        if "topic" not in columns:
+            self.connection.execute("ALTER TABLE cards ADD COLUMN topic TEXT")
+        # and before topics' sources were kept. We can't tell which of their
+        # topics the classifier picked, so they're left without a source and
+        # aren't trained on
+        if "topic_source" not in columns:
+            self.connection.execute("ALTER TABLE cards ADD COLUMN topic_source TEXT")
+        self.migrate_to_block_snapshots()
+        # the blocks that were left without a card because the LLM kept
+        # generating something invalid for them, at the timestamp they had
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS skipped_blocks (
+                block_id TEXT PRIMARY KEY,
+                last_edited_time TEXT NOT NULL,
+                skipped_at REAL NOT NULL
+            )
+            """)
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cards_status ON cards (status)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cards_fingerprint ON cards (fingerprint)"
+        )
+        self.connection.commit()
+
+    def migrate_to_block_snapshots(self) -> None:
+        """Replace the raw Notion blocks stored by card stores older than version
+        1 with block snapshots, and give the space they took back to the OS"""
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version >= 1:
+            return
+        rows = self.connection.execute(
+            "SELECT block_id, notion_block FROM cards"
+        ).fetchall()
+        self.connection.executemany(
+            "UPDATE cards SET notion_block = ? WHERE block_id = ?",
+            [
+                (json.dumps(make_block_snapshot(json.loads(notion_block))), block_id)
+                for block_id, notion_block in rows
+            ],
+        )
+        self.connection.execute(f"PRAGMA user_version = {CARD_STORE_VERSION}")
+        self.connection.commit()
+        if len(rows) > 0:
+            self.connection.execute("VACUUM")
+
+    def add_cards(self, anki_cards: Iterable[AnkiCard]) -> MergeResult:
+        """Merge new pending cards into the store, ignoring any card whose Notion
+        block is already in the store and flagging any card whose text is the
+        same as another card's
+
+        `anki_cards` is consumed one card at a time, so it can be a generator,
+        and every lookup goes through an index, so merging n cards is O(n)
+        regardless of how many cards are already in the store
+        """
+        now = time.time()
+        num_added = 0
+        duplicate_texts: List[Tuple[str, str]] = []
+        for card in anki_cards:
+            block_id = card.notion_block["id"]
+            fingerprint = fingerprint_card_text(card.text)
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO cards (block_id, text, notion_block, status, created_at, updated_at, fingerprint, topic, topic_source) VALUES (?, ?, ?, 'pending', ?, ?, ?, ?, ?)",
+                (
+                    block_id,
+                    card.text,
+                    json.dumps(make_block_snapshot(card.notion_block)),
+                    now,
+                    now,
+                    fingerprint,
+                    card.topic,
+                    card.topic_source,
+                ),
+            )
+            if cursor.rowcount == 0:
+                continue
+            num_added += 1
+
+            duplicate_row = self.connection.execute(
+                "SELECT block_id FROM cards WHERE fingerprint = ? AND block_id != ? LIMIT 1",
+                (fingerprint, block_id),
+            ).fetchone()
+            if duplicate_row is not None:
+                duplicate_texts.append((block_id, duplicate_row[0]))
+
+        self.connection.commit()
+        return MergeResult(num_added, duplicate_texts)
+
+    def has_card(self, block_id: str) -> bool:
+        """Whether there's already a card for this Notion block, in any status"""
+        row = self.connection.execute(
+            "SELECT 1 FROM cards WHERE block_id = ?", (block_id,)
+        ).fetchone()
+        return row is not None
+
+    def add_skipped_blocks(self, blocks: Iterable[Dict]) -> None:
+        """Remember the raw Notion blocks that were left without a card, so
+        that we don't pay for them again until they're edited"""
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO skipped_blocks (block_id, last_edited_time, skipped_at) VALUES (?, ?, ?)",
+            [(block["id"], block["last_edited_time"], now) for block in blocks],
+        )
+        self.connection.commit()
+
+    def was_skipped(self, block: Dict) -> bool:
+        """Whether a raw Notion block was left without a card, and hasn't been
+        edited since"""
+        row = self.connection.execute(
+            "SELECT last_edited_time FROM skipped_blocks WHERE block_id = ?",
+            (block["id"],),
+        ).fetchone()
+        return row is not None and row[0] == block["last_edited_time"]
+
+    def get_cards(self, status: str) -> List[AnkiCard]:
+        """Get all of the cards with the given status, oldest first"""
+        rows = self.connection.execute(
+            "SELECT text, notion_block, topic, topic_source FROM cards WHERE status = ? ORDER BY rowid",
+            (status,),
+        ).fetchall()
+        return [
+            AnkiCard(text, json.loads(notion_block), topic, topic_source)
+            for text, notion_block, topic, topic_source in rows
+        ]
+
+    def get_topic_examples(self) -> List[Tuple[Dict, str]]:
+        """Get the Notion block snapshot and topic of every card whose topic
+        was picked by the LLM or the reviewer, in any status, which is what
+        the local topic classifier is trained on"""
+        rows = self.connection.execute(
+            "SELECT notion_block, topic FROM cards WHERE topic IS NOT NULL AND topic_source IN ('llm', 'reviewer') ORDER BY rowid"
+        ).fetchall()
+        return [(json.loads(notion_block), topic) for notion_block, topic in rows]
+
+    def set_status(self, anki_card: AnkiCard, status: str) -> None:
+        self.set_statuses([anki_card], status)
+
+    def set_statuses(self, anki_cards: Iterable[AnkiCard], status: str) -> None:
+        """Set the status of many cards in a single transaction"""
+        if status not in CARD_STATUSES:
+            raise ValueError(
+                f"Status {status} is not a valid option. Must be one of {CARD_STATUSES}"
+            )
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE cards SET status = ?, updated_at = ? WHERE block_id = ?",
+            [(status, now, card.notion_block["id"]) for card in anki_cards],
+        )
+        self.connection.commit()
+
+    def set_text(self, anki_card: AnkiCard, text: str) -> AnkiCard:
+        """Replace a card's text, e.g. after it was edited during review,
+        returning the updated card"""
+        self.connection.execute(
+            "UPDATE cards SET text = ?, fingerprint = ?, updated_at = ? WHERE block_id = ?",
+            (
+                text,
+                fingerprint_card_text(text),
+                time.time(),
+                anki_card.notion_block["id"],
+            ),
+        )
+        self.connection.commit()
+        return AnkiCard(
+            text, anki_card.notion_block, anki_card.topic, anki_card.topic_source
+        )
+
+    def set_topic(self, anki_card: AnkiCard, topic: str) -> AnkiCard:
+        """Replace a card's topic after the reviewer changed it, returning the
+        updated card"""
+        self.connection.execute(
+            "UPDATE cards SET topic = ?, topic_source = 'reviewer', updated_at = ? WHERE block_id = ?",
+            (topic, time.time(), anki_card.notion_block["id"]),
+        )
+        self.connection.commit()
+        return AnkiCard(anki_card.text, anki_card.notion_block, topic, "reviewer")
+
+    def import_pickle_file(self, pickle_filepath: str) -> MergeResult:
+        """Import the pending cards from a *.pkl file written by an older version
+        of scan_notion"""
+        return self.add_cards(load_legacy_pickle_file(pickle_filepath))
+
+    def close(self) -> None:
+        self.connection.close()
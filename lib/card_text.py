@@ -0,0 +1,87 @@
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+# A well-formed cloze deletion, {{c<number>::<text>}} or
+# {{c<number>::<text>::<hint>}}
+CLOZE_PATTERN = re.compile(r"\{\{c(\d+)::(.*?)\}\}", re.DOTALL)
+
+# A cloze deletion in single curly braces, which GPT-3.5 likes to write
+# instead of double ones. Braces that are already doubled are left alone
+SINGLE_CURLY_CLOZE_PATTERN = re.compile(r"(?<!\{)\{(c\d+::[^{}]*)\}(?!\})")
+
+# The quotes GPT-3.5 likes to surround its output in
+SURROUNDING_QUOTES = '"“”'
+
+# What can be wrong with a card's text once it's been fixed up, by the short
+# name it's counted under in the metrics
+CARD_TEXT_PROBLEMS = {
+    "empty": "is empty",
+    "no_cloze": "has no cloze deletions",
+    "empty_cloze": "has a cloze deletion with nothing in it",
+    "unbalanced_braces": "has curly braces outside of its cloze deletions",
+    "misnumbered": "doesn't number its cloze deletions c1, c2, ... without gaps",
+}
+
+
+class InvalidCardTextError(ValueError):
+    """Raised when the LLM keeps generating malformed card text for a block"""
+
+
+@dataclass(frozen=True)
+class ProcessedCardText:
+    """A card's text after it's been fixed up, and what's still wrong with it
+    (one of CARD_TEXT_PROBLEMS), or None if it's a valid cloze card"""
+
+    text: str
+    problem: Optional[str] = None
+
+    def describe_problem(self) -> str:
+        return f"Card text {self.text!r} {CARD_TEXT_PROBLEMS[self.problem]}"
+
+
+def post_process_card_texts(
+    texts: Sequence[Optional[str]],
+) -> List[ProcessedCardText]:
+    """Fix up the card texts generated by the LLM, and validate their cloze
+    deletions, returning them in the same order
+
+    None (which is what an empty completion's content is) is treated as empty
+    text
+    """
+    return [find_problem(fix_card_text(text or "")) for text in texts]
+
+
+def fix_card_text(text: str) -> str:
+    """Fix the mistakes the LLM makes that we can fix without asking it again"""
+    text = text.strip()
+    if text[:1] in SURROUNDING_QUOTES:
+        text = text[1:]
+    if text[-1:] in SURROUNDING_QUOTES:
+        text = text[:-1]
+    return SINGLE_CURLY_CLOZE_PATTERN.sub(r"{{\1}}", text.strip())
+
+
+def find_problem(text: str) -> ProcessedCardText:
+    if text == "":
+        return ProcessedCardText(text, "empty")
+    matches = CLOZE_PATTERN.findall(text)
+    # every brace must be part of a cloze deletion, and the braces inside a
+    # deletion must pair up, since Anki ends a deletion at the first }}
+    num_braces_in_clozes = sum(
+        4 + content.count("{") + content.count("}") for _, content in matches
+    )
+    if text.count("{") + text.count("}") != num_braces_in_clozes or any(
+        content.count("{") != content.count("}") for _, content in matches
+    ):
+        return ProcessedCardText(text, "unbalanced_braces")
+    if len(matches) == 0:
+        return ProcessedCardText(text, "no_cloze")
+    if any(content.split("::")[0].strip() == "" for _, content in matches):
+        return ProcessedCardText(text, "empty_cloze")
+    # a card can cloze several things with the same number, which are then
+    # hidden together, but the numbers themselves must run from 1 up
+    numbers = sorted({int(number) for number, _ in matches})
+    if numbers != list(range(1, len(numbers) + 1)):
+        return ProcessedCardText(text, "misnumbered")
+    return ProcessedCardText(text)
@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from .scan_index import ScanIndex
+
+# default filepath of the checkpoint that `scan_notion --resume` resumes from
+SCAN_CHECKPOINT_FILEPATH = "out/scan_checkpoint.json"
+
+# The least number of seconds between two checkpoints of a scan
+CHECKPOINT_INTERVAL_SECONDS = 10
+
+# The version of the checkpoint file's format. A checkpoint written with a
+# different version is ignored rather than misread
+SCAN_CHECKPOINT_VERSION = 1
+
+
+def write_json_atomically(filepath: str, data) -> None:
+    """Write `data` as JSON to a temporary file next to `filepath` and then
+    rename it over `filepath`, so that a crash halfway through leaves either the
+    old file or the new one, but never a partial file"""
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_filepath = f"{filepath}.tmp"
+    with open(temp_filepath, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filepath, filepath)
+
+
+@dataclass(frozen=True)
+class ScopeProgress:
+    """How far a scan got through one of its scopes"""
+
+    # the oldest `last_edited_time` the scan looks at in this scope
+    end_date: str
+    # the pagination cursor of the next chunk of pages to search, or None to
+    # start from the first chunk
+    start_cursor: Optional[str] = None
+    # the scope's high-water mark as of the last chunk searched
+    high_water_mark: Optional[str] = None
+    num_pages: int = 0
+    is_done: bool = False
+
+
+class ScanCheckpoint:
+    """The progress of a scan_notion run, saved periodically so that a run that
+    dies halfway can be resumed with `--resume`
+
+    The crawl reports the blocks it yields with `block_started` and the
+    chunks of pages it finishes searching with `chunk_searched`, and the card
+    writer reports each block it's done with (its card was written, or it
+    already had one) with `block_finished`. A chunk only makes it into the
+    checkpoint once every block found up to and including that chunk is
+    finished, so resuming from the checkpoint never skips a block whose card
+    hadn't been written yet. Saving a checkpoint also persists the scan
+    index's records (see `ScanIndex.checkpoint`).
+
+    `scan_key` identifies the scan's parameters, and a checkpoint is only
+    resumed by a scan with the same parameters.
+    """
+
+    def __init__(
+        self,
+        filepath: str = SCAN_CHECKPOINT_FILEPATH,
+        scan_key: str = "",
+        scopes: Optional[Dict[str, ScopeProgress]] = None,
+        interval_seconds: float = CHECKPOINT_INTERVAL_SECONDS,
+    ):
+        self.filepath = filepath
+        self.scan_key = scan_key
+        self.interval_seconds = interval_seconds
+        # the progress of each scope as of the last saved checkpoint, keyed on
+        # the scope's high-water mark key
+        self.scopes: Dict[str, ScopeProgress] = dict(scopes or {})
+        self._lock = threading.Lock()
+        self._next_block_number = 0
+        # the number of every block that's been yielded but isn't finished
+        self._unfinished_blocks: Dict[str, int] = {}
+        # (number of blocks yielded so far, scope key, progress) for each
+        # chunk searched since the last saved checkpoint
+        self._searched_chunks: List[Tuple[int, str, ScopeProgress]] = []
+        self._last_saved_at = time.monotonic()
+
+    @staticmethod
+    def load(
+        filepath: str = SCAN_CHECKPOINT_FILEPATH, scan_key: str = ""
+    ) -> Optional["ScanCheckpoint"]:
+        """Load the checkpoint left by an interrupted scan with the same
+        parameters, if there is one"""
+        try:
+            with open(filepath) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get("version") != SCAN_CHECKPOINT_VERSION:
+            print(f"Ignoring the checkpoint at {filepath}, it's from another version")
+            return None
+        if data.get("scan_key") != scan_key:
+            print(
+                f"Ignoring the checkpoint at {filepath}, it's from a scan with "
+                "different scopes or flags"
+            )
+            return None
+        scopes = {
+            key: ScopeProgress(**progress) for key, progress in data["scopes"].items()
+        }
+        return ScanCheckpoint(filepath, scan_key, scopes)
+
+    def get_scope_progress(self, key: str) -> Optional[ScopeProgress]:
+        return self.scopes.get(key)
+
+    def start_scope(self, key: str, end_date: datetime) -> None:
+        if key not in self.scopes:
+            self.scopes[key] = ScopeProgress(end_date.isoformat())
+
+    def block_started(self, block_id: str) -> None:
+        with self._lock:
+            self._unfinished_blocks[block_id] = self._next_block_number
+            self._next_block_number += 1
+
+    def block_finished(self, block_id: str) -> None:
+        with self._lock:
+            self._unfinished_blocks.pop(block_id, None)
+
+    def chunk_searched(
+        self,
+        key: str,
+        next_cursor: Optional[str],
+        num_pages: int,
+        high_water_mark: Optional[datetime],
+        is_done: bool = False,
+    ) -> None:
+        """Record that every page in the scope up to `next_cursor` has been
+        searched, and all of their blocks yielded"""
+        progress = ScopeProgress(
+            self.scopes[key].end_date,
+            next_cursor,
+            high_water_mark.isoformat() if high_water_mark else None,
+            num_pages,
+            is_done,
+        )
+        with self._lock:
+            self._searched_chunks.append((self._next_block_number, key, progress))
+
+    def save_if_due(self, scan_index: ScanIndex) -> None:
+        """Save a checkpoint if it's been long enough since the last one. This
+        has to be called from the thread that writes to `scan_index`"""
+        if time.monotonic() - self._last_saved_at < self.interval_seconds:
+            return
+        with self._lock:
+            first_unfinished_block = min(
+                self._unfinished_blocks.values(), default=self._next_block_number
+            )
+            num_finished_chunks = 0
+            for num_blocks, key, progress in self._searched_chunks:
+                if num_blocks > first_unfinished_block:
+                    break
+                self.scopes[key] = progress
+                num_finished_chunks += 1
+            del self._searched_chunks[:num_finished_chunks]
+
+        scan_index.checkpoint()
+        write_json_atomically(
+            self.filepath,
+            {
+                "version": SCAN_CHECKPOINT_VERSION,
+                "scan_key": self.scan_key,
+                "scopes": {
+                    key: asdict(progress) for key, progress in self.scopes.items()
+                },
+            },
+        )
+        self._last_saved_at = time.monotonic()
+
+    def delete(self) -> None:
+        """Remove the checkpoint once the scan it's for has finished"""
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
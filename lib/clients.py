@@ -0,0 +1,136 @@
+import os
+import threading
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Dict, Optional
+
+# These SDKs take up most of the CLI's startup time, so they're only imported
+# when a client is first needed. `--help`, or a generate_cards run, never pays
+# for OpenAI
+if TYPE_CHECKING:
+    import requests
+    from notion_client import Client
+    from openai import OpenAI
+    from .tenants import Tenant
+
+# The default URL of the Anki Connect addon, which we assume is running
+DEFAULT_ANKI_CONNECT_URL = "http://127.0.0.1:8765"
+
+_lock = threading.Lock()
+_environment_loaded = False
+# one Notion client per integration key, since tenants can have their own
+_notion_clients: Dict[str, "Client"] = {}
+_openai_client: Optional["OpenAI"] = None
+_anki_session: Optional["requests.Session"] = None
+
+# The tenant that the current thread is working for in a multi-tenant run (see
+# lib/tenants.py), whose Notion key, deck and SRS mention ids are used instead
+# of the ones in the environment. Threads started on a tenant's behalf have to
+# be given a copy of the context, see `pipeline.submit_in_context`
+current_tenant: ContextVar[Optional["Tenant"]] = ContextVar(
+    "current_tenant", default=None
+)
+
+
+def load_environment() -> None:
+    """Load the environment variables in .env, the first time this is called"""
+    global _environment_loaded
+    with _lock:
+        if _environment_loaded:
+            return
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        _environment_loaded = True
+
+
+def get_env(name: str, default: Optional[str] = None) -> str:
+    """Read an environment variable (which may come from .env), raising an error
+    that says what's missing if it isn't set and there's no default"""
+    load_environment()
+    value = os.environ.get(name, default)
+    if value is None:
+        raise RuntimeError(
+            f"The {name} environment variable must be set, see .env.example"
+        )
+    return value
+
+
+def get_notion_client() -> "Client":
+    """The Notion client for the current tenant's integration key (or the
+    NOTION_KEY environment variable outside of a multi-tenant run), created on
+    first use
+
+    NOTION_BASE_URL can be set to point the client at a local stub server, see
+    benchmarks/stub_notion.py
+    """
+    tenant = current_tenant.get()
+    auth = tenant.get_notion_key() if tenant is not None else get_env("NOTION_KEY")
+    notion_client = _notion_clients.get(auth)
+    if notion_client is None:
+        base_url = get_env("NOTION_BASE_URL", "https://api.notion.com")
+        with _lock:
+            notion_client = _notion_clients.get(auth)
+            if notion_client is None:
+                import logging
+                import structlog
+                from notion_client import Client
+
+                logger = structlog.wrap_logger(
+                    logging.getLogger("notion-client"),
+                    logger_factory=structlog.stdlib.LoggerFactory(),
+                    wrapper_class=structlog.stdlib.BoundLogger,
+                )
+                notion_client = Client(
+                    auth=auth,
+                    base_url=base_url,
+                    logger=logger,
+                    log_level=logging.DEBUG,
+                )
+                _notion_clients[auth] = notion_client
+    return notion_client
+
+
+def get_openai_client() -> "OpenAI":
+    """The OpenAI client, created on first use
+
+    OPENAI_BASE_URL is picked up by the client if you want to point it at a
+    local stub server. We do our own retrying in
+    `intelligence.create_chat_completion`, so the client's retries are disabled
+    """
+    global _openai_client
+    if _openai_client is None:
+        api_key = get_env("OPENAI_API_KEY")
+        with _lock:
+            if _openai_client is None:
+                from openai import OpenAI
+
+                _openai_client = OpenAI(api_key=api_key, max_retries=0)
+    return _openai_client
+
+
+def get_anki_session() -> "requests.Session":
+    """A keep-alive HTTP session, so that we reuse the same connection to Anki
+    Connect across requests"""
+    global _anki_session
+    if _anki_session is None:
+        with _lock:
+            if _anki_session is None:
+                import requests
+
+                _anki_session = requests.Session()
+    return _anki_session
+
+
+def get_anki_connect_url() -> str:
+    """ANKI_CONNECT_URL can be set to point at a local stub server instead of
+    the Anki Connect addon, see benchmarks/stub_anki_connect.py"""
+    return get_env("ANKI_CONNECT_URL", DEFAULT_ANKI_CONNECT_URL)
+
+
+def get_deck_name() -> str:
+    """The Anki deck that you want to add cards to, which is the current
+    tenant's deck in a multi-tenant run"""
+    tenant = current_tenant.get()
+    if tenant is not None:
+        return tenant.deck_name
+    return get_env("DECK_NAME")
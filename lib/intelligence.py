@@ -1,15 +1,49 @@
-from openai import OpenAI
-import re
-import os
-from dotenv import load_dotenv
-from typing import List, Dict
-from .notion_api import MENTION_TEXT
-from .anki_utils import AnkiCard
-
-load_dotenv()  # take environment variables from .env.
-
-# note: the API token gets automatically pulled in from the .env by the OpenAI class
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+import json
+import random
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Deque, Iterable, Iterator, List, Dict, Optional, Tuple
+from .notion_api import (
+    MENTION_TEXT,
+    compile_mention_section_matcher,
+    get_current_srs_mention_ids,
+)
+from .anki_utils import AnkiCard, make_block_snapshot
+from .card_text import InvalidCardTextError, post_process_card_texts
+from .clients import current_tenant, get_openai_client
+from .metrics import metrics
+from .llm_cache import LLMCache
+from .pipeline import submit_in_context
+from .prompts import (
+    DEFAULT_MAX_BLOCK_TOKENS,
+    ModelRouting,
+    TokenBudget,
+    compact_text,
+    estimate_num_tokens,
+)
+from .topic_classifier import TopicClassifier
+
+# When set (see `use_llm_cache`), LLM responses are looked up here before we
+# make a chat completion request, so re-scanning the same text is free
+llm_cache: Optional[LLMCache] = None
+
+# When set (see `use_token_budget`), every LLM request is charged to this
+# budget, and we stop making requests once it's spent
+token_budget: Optional[TokenBudget] = None
+
+# Block text longer than this many (estimated) tokens is trimmed before it's
+# put in a prompt, see `use_max_block_tokens`. None never trims
+max_block_tokens: Optional[int] = DEFAULT_MAX_BLOCK_TOKENS
+
+# When set (see `use_topic_classifier`), blocks' topics are picked in-process
+# by this classifier, and only the blocks it isn't sure about go to the LLM
+topic_classifier: Optional[TopicClassifier] = None
+
+# In a multi-tenant run, each tenant's classifier by the tenant's name, so that
+# one tenant's cards never influence the topics picked for another's
+topic_classifiers_by_tenant: Dict[str, Optional[TopicClassifier]] = {}
 
 # Text categories that help the anki card generation prompt hone in on a
 # particular category of ideas
@@ -31,6 +65,51 @@ TOPICS = [
 
 MODEL_VERSION = "gpt-3.5-turbo"
 
+
+class InvalidTopicError(ValueError):
+    """Raised when the LLM picks a topic that isn't one of TOPICS (or no topic
+    at all), and there's no topic classifier to fall back on"""
+
+
+# Which model each request goes to, see `use_model_routing`. By default every
+# request goes to MODEL_VERSION
+model_routing = ModelRouting(MODEL_VERSION, MODEL_VERSION)
+
+# The default number of Notion blocks we generate Anki cards for in parallel,
+# i.e. the max number of chat completion requests in flight at once
+DEFAULT_LLM_CONCURRENCY = 8
+
+# How long we wait on a single chat completion request before giving up on it
+LLM_REQUEST_TIMEOUT_SECONDS = 30
+
+# How many times we retry a chat completion request that timed out, was rate
+# limited or hit a server error, before giving up and raising the error
+LLM_MAX_RETRIES = 3
+
+# How many times we ask the LLM for a block's card text before giving up on a
+# block whose card text keeps coming back malformed (see card_text.py)
+MAX_CARD_TEXT_ATTEMPTS = 3
+
+# These are the names of the openai errors worth retrying, anything else
+# (e.g. a bad API key) will fail the same way every time. The openai SDK is
+# slow to import, so it's only imported once we make a request
+RETRYABLE_LLM_ERRORS = ["APIConnectionError", "RateLimitError", "InternalServerError"]
+
+# The ways we can use the LLM to generate card text:
+#   - "two_call": first ask the LLM for the block's topic, then ask it for the
+#     cloze card text given that topic
+#   - "single_call": ask the LLM for both the topic and the cloze card text in a
+#     single JSON response, falling back to "two_call" if the response is invalid
+#   - "batch": ask the LLM for the topics and cloze card texts of several blocks
+#     in a single JSON response, retrying any blocks that are missing from the
+#     response or invalid using "single_call"
+GENERATION_MODES = ["two_call", "single_call", "batch"]
+DEFAULT_GENERATION_MODE = "two_call"
+
+# In "batch" generation mode, the max number of (estimated) tokens of block
+# text we pack into a single request
+DEFAULT_MAX_BATCH_TOKENS = 1500
+
 SYSTEM_PROMPT_CARD_GENERATION_TEMPLATE = """
 You are a flashcard creation expert. Your task is to analyze the paragraph that comes after the “**Input Paragraph:**” prefix provided by the user, as well as a user-provided Topic that is from one of the 10 topics below, and generate a single Anki cloze deletion flashcard that challenges deeper understanding. You must prioritize these guidelines:
 
@@ -67,117 +146,712 @@ Please categorize the following text:
 {text}
 """
 
+SYSTEM_PROMPT_TOPIC_AND_CARD_GENERATION_TEMPLATE = """
+You are a flashcard creation expert. Your task is to analyze the paragraph that comes after the “**Input Paragraph:**” prefix provided by the user, categorize it into exactly 1 of the 10 topics below, and generate a single Anki cloze deletion flashcard that challenges deeper understanding. You must prioritize these guidelines:
 
-def generate_anki_cloze_card(text: str, topic) -> str:
-    """Generate an Anki cloze deletion flashcard from input text and topic"""
+- **Information Density:** Choose a segment of the user-provided paragraph that contains a key fact, definition, or important concept relevant to the topic.  
+- **Conciseness:** The cloze deletion should be as short as possible while still providing enough context for recall.
+- **Deeper Understanding:** The card should test more than simple memorization. If possible, structure the cloze to require analysis, comparison, or application of the concept.
+
+The 10 topics are: {topics}
+
+You MUST respond with a JSON object containing exactly two keys: "topic", which must be one of the 10 topics above, and "card", which is the text of the cloze deletion flashcard.
+
+For example, given the following input:
+
+**Input Paragraph:** In the field of energy economics, the time-to-start for different power plants is an important factor in determining the optimal mix of energy sources. Power plants that can be started quickly, such as natural gas-fired plants which take 10 minutes to start, are better suited to handle fluctuations in demand than plants that take longer to start.
+
+Then the output should look like the following JSON object:
+
+{{"topic": "Economics and Business", "card": "A natural gas plant takes about {{c1::10 minutes}} to start"}}
+"""
+
+USER_PROMPT_TOPIC_AND_CARD_GENERATION_TEMPLATE = """
+**Input Paragraph:** {text}
+"""
+
+SYSTEM_PROMPT_BATCH_TOPIC_AND_CARD_GENERATION_TEMPLATE = """
+You are a flashcard creation expert. The user will provide several numbered paragraphs, each one coming after an “**Input Paragraph N:**” prefix where N is the paragraph's index. Your task is to analyze each paragraph separately, categorize it into exactly 1 of the 10 topics below, and generate a single Anki cloze deletion flashcard for it that challenges deeper understanding. You must prioritize these guidelines:
+
+- **Information Density:** Choose a segment of the paragraph that contains a key fact, definition, or important concept relevant to the topic.  
+- **Conciseness:** The cloze deletion should be as short as possible while still providing enough context for recall.
+- **Deeper Understanding:** The card should test more than simple memorization. If possible, structure the cloze to require analysis, comparison, or application of the concept.
+
+The 10 topics are: {topics}
+
+You MUST respond with a JSON object containing a single key "cards", whose value is a list with exactly one entry per input paragraph. Each entry is a JSON object with exactly three keys: "index", which is the paragraph's index N, "topic", which must be one of the 10 topics above, and "card", which is the text of the paragraph's cloze deletion flashcard.
+
+For example, given the following input:
+
+**Input Paragraph 0:** In the field of energy economics, the time-to-start for different power plants is an important factor in determining the optimal mix of energy sources. Power plants that can be started quickly, such as natural gas-fired plants which take 10 minutes to start, are better suited to handle fluctuations in demand than plants that take longer to start.
+**Input Paragraph 1:** The Treaty of Westphalia, signed in 1648, ended the Thirty Years' War and established the principle of state sovereignty.
 
-    system_prompt = SYSTEM_PROMPT_CARD_GENERATION_TEMPLATE.format(
+Then the output should look like the following JSON object:
+
+{{"cards": [{{"index": 0, "topic": "Economics and Business", "card": "A natural gas plant takes about {{c1::10 minutes}} to start"}}, {{"index": 1, "topic": "World History", "card": "The Treaty of Westphalia established the principle of {{c1::state sovereignty}}"}}]}}
+"""
+
+USER_PROMPT_BATCH_ITEM_TEMPLATE = """
+**Input Paragraph {index}:** {text}"""
+
+# The system prompts don't depend on the block, so they're rendered once rather
+# than on every request. Everything that does depend on the block goes in the
+# user prompt after them, so all of the requests with the same purpose share
+# the same prompt prefix, which is what LLM providers' prompt caching matches on
+SYSTEM_PROMPT_CARD_GENERATION = SYSTEM_PROMPT_CARD_GENERATION_TEMPLATE.format(
+    topics=", ".join(TOPICS)
+)
+SYSTEM_TOPIC_SELECTION_PROMPT = SYSTEM_TOPIC_SELECTION_PROMPT_TEMPLATE.format(
+    topics=", ".join(TOPICS)
+)
+SYSTEM_PROMPT_TOPIC_AND_CARD_GENERATION = (
+    SYSTEM_PROMPT_TOPIC_AND_CARD_GENERATION_TEMPLATE.format(topics=", ".join(TOPICS))
+)
+SYSTEM_PROMPT_BATCH_TOPIC_AND_CARD_GENERATION = (
+    SYSTEM_PROMPT_BATCH_TOPIC_AND_CARD_GENERATION_TEMPLATE.format(
         topics=", ".join(TOPICS)
     )
-    user_prompt = USER_PROMPT_CARD_GENERATION_TEMPLATE.format(text=text, topic=topic)
-
-    completion = client.chat.completions.create(
-        model=MODEL_VERSION,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": user_prompt,
-            },
-        ],
+)
+
+
+def generate_anki_cloze_card(text: str, topic) -> str:
+    """Generate an Anki cloze deletion flashcard from input text and topic
+
+    Malformed card text is sent back to the LLM, and an InvalidCardTextError
+    is raised if it's still malformed after MAX_CARD_TEXT_ATTEMPTS tries
+    """
+
+    system_prompt = SYSTEM_PROMPT_CARD_GENERATION
+    user_prompt = USER_PROMPT_CARD_GENERATION_TEMPLATE.format(
+        text=compact_block_text(text), topic=topic
     )
 
-    # TODO: do proper error handling
-    return completion.choices[0].message.content
+    for _ in range(MAX_CARD_TEXT_ATTEMPTS):
+        content = get_chat_completion_content(
+            system_prompt, user_prompt, purpose="card"
+        )
+        [card_text] = post_process_card_texts([content])
+        if card_text.problem is None:
+            return card_text.text
+        metrics.increment("card_text_problems_total", problem=card_text.problem)
+        # otherwise the next try would read the same text from the cache
+        delete_cached_content(system_prompt, user_prompt, purpose="card")
+    raise InvalidCardTextError(card_text.describe_problem())
 
 
-def create_anki_cards_from_srs_blocks(srs_blocks: List[Dict]) -> List[AnkiCard]:
-    """Given a list of raw Notion blocks that contain mentions, generate Anki cloze cards from them"""
-    anki_cards: List[AnkiCard] = []
+def generate_topic_and_anki_cloze_card(text: str) -> Tuple[str, str]:
+    """Generate both the topic and the Anki cloze deletion flashcard for the
+    input text using a single LLM request, returning a (topic, card text) tuple
 
+    Raises a ValueError if the LLM's response isn't a JSON object with a valid
+    topic and valid cloze card text
+    """
+    system_prompt = SYSTEM_PROMPT_TOPIC_AND_CARD_GENERATION
+    user_prompt = USER_PROMPT_TOPIC_AND_CARD_GENERATION_TEMPLATE.format(
+        text=compact_block_text(text)
+    )
+
+    content = get_chat_completion_content(
+        system_prompt, user_prompt, json_response=True, purpose="topic_and_card"
+    )
+    try:
+        topic, anki_card_text = parse_topic_and_anki_cloze_card(content)
+        [card_text] = post_process_card_texts([anki_card_text])
+        if card_text.problem is not None:
+            metrics.increment("card_text_problems_total", problem=card_text.problem)
+            raise ValueError(card_text.describe_problem())
+        return topic, card_text.text
+    except ValueError:
+        # don't let an invalid response stick around in the cache
+        delete_cached_content(system_prompt, user_prompt, purpose="topic_and_card")
+        raise
+
+
+def parse_topic_and_anki_cloze_card(content: str) -> Tuple[str, str]:
+    """Parse and validate the JSON response to the single call topic and card prompt"""
+    try:
+        response = json.loads(content)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Unable to parse topic and card from {content!r}") from e
+    return get_topic_and_anki_cloze_card(response)
+
+
+def get_topic_and_anki_cloze_card(response: Dict) -> Tuple[str, str]:
+    """Validate a {"topic": ..., "card": ...} JSON object returned by the LLM"""
+    try:
+        topic = response["topic"]
+        anki_card_text = response["card"]
+    except (TypeError, KeyError) as e:
+        raise ValueError(f"Unable to get topic and card from {response!r}") from e
+
+    if topic not in TOPICS:
+        raise ValueError(
+            f"Topic {topic} is not a valid option. Must be one of {TOPICS}"
+        )
+    if not isinstance(anki_card_text, str) or anki_card_text == "":
+        raise ValueError(f"Card text {anki_card_text!r} is not a non-empty string")
+    return topic, anki_card_text
+
+
+def generate_topics_and_anki_cloze_cards(
+    texts: List[str],
+) -> List[Optional[Tuple[str, str]]]:
+    """Generate the topics and Anki cloze deletion flashcards for several input
+    texts using a single LLM request
+
+    Returns a list with a (topic, card text) tuple for each of the input texts,
+    in the same order, or None for any text whose card was missing from the
+    LLM's response or invalid. The card texts are all post-processed at once
+    """
+    system_prompt = SYSTEM_PROMPT_BATCH_TOPIC_AND_CARD_GENERATION
+    user_prompt = "".join(
+        USER_PROMPT_BATCH_ITEM_TEMPLATE.format(index=i, text=compact_block_text(text))
+        for i, text in enumerate(texts)
+    )
+
+    content = get_chat_completion_content(
+        system_prompt, user_prompt, json_response=True, purpose="batch"
+    )
+    results: List[Optional[Tuple[str, str]]] = [None] * len(texts)
+    try:
+        items = json.loads(content)["cards"]
+        if not isinstance(items, list):
+            raise ValueError(f"cards is not a list in {content!r}")
+    except (TypeError, ValueError, KeyError) as e:
+        print(f"Unable to parse batch of {len(texts)} cards: {e}")
+        # don't let an invalid response stick around in the cache
+        delete_cached_content(system_prompt, user_prompt, purpose="batch")
+        return results
+
+    topics_and_cards: Dict[int, Tuple[str, str]] = {}
+    for item in items:
+        try:
+            index = item["index"]
+            topic_and_card = get_topic_and_anki_cloze_card(item)
+        except (TypeError, KeyError, ValueError):
+            continue
+        if isinstance(index, int) and 0 <= index < len(texts):
+            topics_and_cards[index] = topic_and_card
+
+    card_texts = post_process_card_texts(
+        [anki_card_text for _, anki_card_text in topics_and_cards.values()]
+    )
+    for (index, (topic, _)), card_text in zip(topics_and_cards.items(), card_texts):
+        if card_text.problem is not None:
+            metrics.increment("card_text_problems_total", problem=card_text.problem)
+            continue
+        results[index] = (topic, card_text.text)
+    return results
+
+
+def iterate_batches(
+    srs_blocks: Iterable[Dict], max_batch_tokens: int
+) -> Iterator[List[Dict]]:
+    """Group blocks into consecutive batches whose estimated token counts add
+    up to at most `max_batch_tokens`. A block that's too long on its own gets
+    a batch to itself"""
+    batch: List[Dict] = []
+    batch_tokens = 0
     for block in srs_blocks:
-        # a Notion block consists of a list of section dicts which contain the
-        # actual text in the "plain_text" key entry. Here we reconstitute
-        # the block's full text from the sections, while ignoring the MENTION tag
-        # because it's irrelevant to Anki card generation
-        srs_item_text = "".join(
-            [
-                section["plain_text"]
-                for section in block.get(block["type"], {}).get("rich_text", [])
-                if MENTION_TEXT not in section["plain_text"]
-            ]
+        num_tokens = estimate_num_tokens(
+            compact_text(get_srs_item_text(block), max_block_tokens)
         )
+        if batch and batch_tokens + num_tokens > max_batch_tokens:
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(block)
+        batch_tokens += num_tokens
+    if batch:
+        yield batch
+
+
+def compact_block_text(text: str) -> str:
+    """Trim a block's text down to `max_block_tokens` before it's put in a
+    prompt (see `prompts.compact_text`), counting the tokens that saves"""
+    compacted_text = compact_text(text, max_block_tokens)
+    num_saved_tokens = estimate_num_tokens(text) - estimate_num_tokens(compacted_text)
+    if num_saved_tokens > 0:
+        metrics.increment(
+            "llm_prompt_tokens_saved_total", num_saved_tokens, reason="compacted"
+        )
+    return compacted_text
 
-        # create the text we'll put in the Anki card using an LLM
-        topic = get_topic_from_text(srs_item_text)
-        anki_card_text = generate_anki_cloze_card(srs_item_text, topic)
-        validated_anki_card_text = validate_and_fix_card_text(anki_card_text)
 
-        # add the Anki Card to our total list of cards we'll later
-        # add to our Anki Deck
-        anki_card = AnkiCard(validated_anki_card_text, block)
-        anki_cards.append(anki_card)
+def use_llm_cache(cache: Optional[LLMCache]) -> None:
+    """Set the cache that LLM responses are read from and written to, or pass
+    None to always call the LLM"""
+    global llm_cache
+    llm_cache = cache
+
+
+def use_token_budget(budget: Optional[TokenBudget]) -> None:
+    """Set the budget that LLM requests are charged to, or pass None to make
+    as many requests as it takes"""
+    global token_budget
+    token_budget = budget
+
+
+def get_token_budget() -> Optional[TokenBudget]:
+    """The budget LLM requests are charged to, if there is one"""
+    return token_budget
+
+
+def use_topic_classifier(classifier: Optional[TopicClassifier]) -> None:
+    """Set the classifier that picks blocks' topics for the current tenant (or
+    outside of a multi-tenant run), or pass None to have the LLM pick every
+    topic"""
+    global topic_classifier
+    tenant = current_tenant.get()
+    if tenant is not None:
+        topic_classifiers_by_tenant[tenant.name] = classifier
+    else:
+        topic_classifier = classifier
+
+
+def get_topic_classifier() -> Optional[TopicClassifier]:
+    """The classifier that picks blocks' topics for the current tenant, or
+    `topic_classifier` outside of a multi-tenant run"""
+    tenant = current_tenant.get()
+    if tenant is not None:
+        return topic_classifiers_by_tenant.get(tenant.name)
+    return topic_classifier
+
+
+def use_model_routing(routing: ModelRouting) -> None:
+    global model_routing
+    model_routing = routing
+
+
+def use_max_block_tokens(max_tokens: Optional[int]) -> None:
+    """Set how many tokens of a block's text are put in a prompt, or pass None
+    to never trim blocks"""
+    global max_block_tokens
+    max_block_tokens = max_tokens
+
+
+def choose_model(user_prompt: str, purpose: str) -> str:
+    """The model a request goes to, by its purpose and the size of its user
+    prompt (see `ModelRouting`)"""
+    return model_routing.choose_model(purpose, estimate_num_tokens(user_prompt))
+
+
+def delete_cached_content(system_prompt: str, user_prompt: str, purpose: str) -> None:
+    """Remove an invalid response from `llm_cache`, so that we don't fail on the
+    same text every time we re-scan it"""
+    if llm_cache is not None:
+        model = choose_model(user_prompt, purpose)
+        llm_cache.delete(LLMCache.make_key(model, system_prompt, user_prompt))
+
+
+def get_chat_completion_content(
+    system_prompt: str,
+    user_prompt: str,
+    json_response: bool = False,
+    purpose: str = "completion",
+) -> str:
+    """Get the LLM's response to a prompt, from `llm_cache` if we've seen this
+    exact model and prompt before, otherwise with a chat completion request
+
+    `purpose` (e.g. "topic" or "card") picks the model along with the size of
+    the prompt (see `choose_model`), and labels the metrics
+    """
+    model = choose_model(user_prompt, purpose)
+    cache_key = LLMCache.make_key(model, system_prompt, user_prompt)
+    if llm_cache is not None:
+        cached_content = llm_cache.get(cache_key)
+        if cached_content is not None:
+            metrics.increment("llm_cache_hits_total", purpose=purpose)
+            metrics.increment(
+                "llm_prompt_tokens_saved_total",
+                estimate_num_tokens(system_prompt) + estimate_num_tokens(user_prompt),
+                reason="cache_hit",
+            )
+            return cached_content
+        metrics.increment("llm_cache_misses_total", purpose=purpose)
+
+    completion = create_chat_completion(
+        system_prompt, user_prompt, json_response, purpose, model
+    )
+    content = completion.choices[0].message.content
+
+    if llm_cache is not None and content:
+        llm_cache.set(cache_key, content)
+    return content
+
+
+def create_chat_completion(
+    system_prompt: str,
+    user_prompt: str,
+    json_response: bool = False,
+    purpose: str = "completion",
+    model: str = MODEL_VERSION,
+):
+    """Make a chat completion request with a timeout, retrying with exponential
+    backoff and full jitter if it fails with a transient error
+
+    If `json_response` is True the LLM is put in JSON mode, so that it's
+    guaranteed to respond with a valid JSON object. The request's latency and
+    token usage are recorded in `metrics`, labelled with `purpose` and `model`.
+    If there's a `token_budget`, the request is charged to it first, which
+    raises a TokenBudgetExceededError if the budget is spent
+    """
+    import openai
+
+    num_estimated_tokens = estimate_num_tokens(system_prompt) + estimate_num_tokens(
+        user_prompt
+    )
+    if token_budget is not None:
+        token_budget.charge(num_estimated_tokens)
+    retryable_errors = tuple(getattr(openai, name) for name in RETRYABLE_LLM_ERRORS)
+    response_format = {"type": "json_object" if json_response else "text"}
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        metrics.increment("llm_requests_total", purpose=purpose, model=model)
+        try:
+            with metrics.time("llm_request_seconds", purpose=purpose):
+                completion = get_openai_client().chat.completions.create(
+                    model=model,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": system_prompt,
+                        },
+                        {
+                            "role": "user",
+                            "content": user_prompt,
+                        },
+                    ],
+                    response_format=response_format,
+                    timeout=LLM_REQUEST_TIMEOUT_SECONDS,
+                )
+        except retryable_errors as error:
+            metrics.increment(
+                "llm_errors_total", purpose=purpose, error=type(error).__name__
+            )
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            time.sleep(random.uniform(0, 2**attempt))
+            continue
+
+        if completion.usage is not None:
+            metrics.increment(
+                "llm_prompt_tokens_total",
+                completion.usage.prompt_tokens,
+                purpose=purpose,
+                model=model,
+            )
+            metrics.increment(
+                "llm_completion_tokens_total",
+                completion.usage.completion_tokens,
+                purpose=purpose,
+                model=model,
+            )
+            num_billed_tokens = completion.usage.total_tokens
+        else:
+            num_billed_tokens = num_estimated_tokens + estimate_num_tokens(
+                completion.choices[0].message.content or ""
+            )
+        if token_budget is not None:
+            token_budget.correct(num_estimated_tokens, num_billed_tokens)
+        return completion
+
+
+def create_anki_cards_from_srs_blocks(
+    srs_blocks: List[Dict],
+    concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+) -> List[AnkiCard]:
+    """Given a list of raw Notion blocks that contain mentions, generate Anki cloze cards from them
+
+    Up to `concurrency` requests are made at once, and the returned cards
+    are in the same order as `srs_blocks`. See GENERATION_MODES for the
+    possible values of `generation_mode`
+    """
+    return list(
+        iterate_anki_cards_from_srs_blocks(
+            srs_blocks, concurrency, generation_mode, max_batch_tokens
+        )
+    )
+
+
+def iterate_anki_cards_from_srs_blocks(
+    srs_blocks: Iterable[Dict],
+    concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    executor: Optional[Executor] = None,
+    on_block_skipped: Optional[Callable[[Dict], None]] = None,
+) -> Iterator[AnkiCard]:
+    """Generate Anki cloze cards from a stream of raw Notion blocks
+
+    Work on each block (or batch of blocks) starts as soon as it comes out of
+    `srs_blocks`, and each card is yielded as soon as it and every card before
+    it are done, so the cards come out in the same order as the blocks. We
+    stop pulling blocks out of `srs_blocks` while 2 * `concurrency` blocks
+    (or batches) are waiting on the LLM, so a fast producer can't pile up
+    an unbounded amount of work
+
+    The LLM requests are made on a pool of `concurrency` threads, or on
+    `executor` if it's passed in, which lets several scans share one pool
+
+    A block whose card text keeps coming back malformed gets no card, and is
+    passed to `on_block_skipped` instead (on one of the pool's threads), so
+    the caller can tell it apart from a block that's still in progress
+    """
+    if generation_mode not in GENERATION_MODES:
+        raise ValueError(
+            f"Generation mode {generation_mode} is not a valid option. Must be one of {GENERATION_MODES}"
+        )
 
+    block_groups: Iterable[List[Dict]]
+    create_anki_cards: Callable[[List[Dict]], List[AnkiCard]]
+    if generation_mode == "batch":
+        block_groups = iterate_batches(srs_blocks, max_batch_tokens)
+        create_anki_cards = partial(
+            create_anki_cards_in_batch, on_block_skipped=on_block_skipped
+        )
+    else:
+        block_groups = ([block] for block in srs_blocks)
+        create_anki_cards = partial(
+            create_anki_cards_one_at_a_time,
+            generation_mode=generation_mode,
+            on_block_skipped=on_block_skipped,
+        )
+
+    max_in_flight = 2 * max(1, concurrency)
+    if executor is not None:
+        yield from iterate_results_in_order(
+            executor, create_anki_cards, block_groups, max_in_flight
+        )
+        return
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        yield from iterate_results_in_order(
+            executor, create_anki_cards, block_groups, max_in_flight
+        )
+
+
+def iterate_results_in_order(
+    executor: Executor,
+    create_anki_cards: Callable[[List[Dict]], List[AnkiCard]],
+    block_groups: Iterable[List[Dict]],
+    max_in_flight: int,
+) -> Iterator[AnkiCard]:
+    """Run `create_anki_cards` on each block group on `executor`, with at most
+    `max_in_flight` groups submitted at once, yielding the cards in order"""
+    in_flight: Deque[Future] = deque()
+    for block_group in block_groups:
+        # the LLM work runs as the current tenant, with their topic
+        # classifier and with their name on its output
+        in_flight.append(submit_in_context(executor, create_anki_cards, block_group))
+        while in_flight and (in_flight[0].done() or len(in_flight) >= max_in_flight):
+            yield from in_flight.popleft().result()
+    while in_flight:
+        yield from in_flight.popleft().result()
+
+
+def create_anki_cards_one_at_a_time(
+    srs_blocks: List[Dict],
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    on_block_skipped: Optional[Callable[[Dict], None]] = None,
+) -> List[AnkiCard]:
+    # the classifier picks the topics of the whole group at once
+    local_topics = classify_topics([get_srs_item_text(block) for block in srs_blocks])
+    anki_cards: List[AnkiCard] = []
+    for block, local_topic in zip(srs_blocks, local_topics):
+        try:
+            anki_cards.append(
+                create_anki_card_from_srs_block(block, generation_mode, local_topic)
+            )
+        except (InvalidCardTextError, InvalidTopicError) as e:
+            skip_block_with_invalid_response(block, e, on_block_skipped)
     return anki_cards
 
 
-def validate_and_fix_card_text(anki_card_text: str) -> str:
-    """Validate Anki card text and fix any issues, returning the fixed text"""
+def create_anki_cards_in_batch(
+    srs_blocks: List[Dict],
+    on_block_skipped: Optional[Callable[[Dict], None]] = None,
+) -> List[AnkiCard]:
+    """Generate Anki cloze cards for a batch of blocks with a single request,
+    then retry any blocks whose cards didn't come back from the batch individually"""
+    srs_item_texts = [get_srs_item_text(block) for block in srs_blocks]
+    results = generate_topics_and_anki_cloze_cards(srs_item_texts)
 
-    # GPT-3.5 likes to surround its output in double-quotes
-    # so we strip those here
-    if anki_card_text[0] == '"':
-        anki_card_text = anki_card_text[1:]
-    if anki_card_text[-1] == '"':
-        anki_card_text = anki_card_text[:-1]
+    missing_indexes = [i for i, result in enumerate(results) if result is None]
+    if len(missing_indexes) > 0:
+        print(
+            f"Retrying {len(missing_indexes)} cards missing from their batch or invalid..."
+        )
+    # in case a retry falls back to picking its topic separately
+    local_topics = dict(
+        zip(
+            missing_indexes,
+            classify_topics([srs_item_texts[i] for i in missing_indexes]),
+        )
+    )
 
-    anki_card_text = make_double_curly(anki_card_text)
+    anki_cards: List[AnkiCard] = []
+    for i, (block, topic_and_card) in enumerate(zip(srs_blocks, results)):
+        if topic_and_card is None:
+            try:
+                anki_cards.append(
+                    create_anki_card_from_srs_block(
+                        block, "single_call", local_topics[i]
+                    )
+                )
+            except (InvalidCardTextError, InvalidTopicError) as e:
+                skip_block_with_invalid_response(block, e, on_block_skipped)
+            continue
+        topic, anki_card_text = topic_and_card
+        anki_cards.append(
+            AnkiCard(anki_card_text, make_block_snapshot(block), topic, "llm")
+        )
 
-    return anki_card_text
+    return anki_cards
 
 
-def make_double_curly(text):
+def skip_block_with_invalid_response(
+    block: Dict,
+    error: ValueError,
+    on_block_skipped: Optional[Callable[[Dict], None]] = None,
+):
+    """Leave a block out of the card store when the LLM kept generating
+    malformed card text for it, or picked an invalid topic for it, handing
+    it to `on_block_skipped` so that the caller can remember not to pay for
+    it again on every scan. The rest of the scan carries on"""
+    if isinstance(error, InvalidCardTextError):
+        metrics.increment("card_texts_rejected_total")
+        reason = (
+            f"its card text was still malformed after {MAX_CARD_TEXT_ATTEMPTS} tries"
+        )
+    else:
+        metrics.increment("topics_rejected_total")
+        reason = "the LLM didn't pick a valid topic for it"
+    print(f"Skipping block {block['id']}, {reason}: {error}")
+    if on_block_skipped is not None:
+        on_block_skipped(block)
+
+
+def create_anki_card_from_srs_block(
+    block: Dict,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    local_topic: Optional[str] = None,
+) -> AnkiCard:
+    """Generate a single Anki cloze card from a raw Notion block that contains a mention
+
+    `local_topic` is the topic the topic classifier picked for the block, if
+    it was sure of one, which is used if the topic is picked separately.
+    Raises an InvalidCardTextError if the LLM keeps generating malformed card
+    text, or an InvalidTopicError if it picks an invalid topic
     """
-    Simple helper function to correct GPT-3's habit of using
-    single curly braces when it should use double curly braces
+    srs_item_text = get_srs_item_text(block)
+
+    # create the text we'll put in the Anki card using an LLM
+    anki_card_text = None
+    if generation_mode == "single_call":
+        try:
+            topic, anki_card_text = generate_topic_and_anki_cloze_card(srs_item_text)
+            topic_source = "llm"
+        except ValueError as e:
+            print(f"Falling back to two LLM calls for block {block['id']}: {e}")
+    if anki_card_text is None:
+        topic, topic_source = get_topic(srs_item_text, local_topic)
+        anki_card_text = generate_anki_cloze_card(srs_item_text, topic)
+
+    return AnkiCard(anki_card_text, make_block_snapshot(block), topic, topic_source)
+
+
+def get_srs_item_text(block: Dict) -> str:
+    """Get the text of a Notion block that we'll generate an Anki card from
+
+    a Notion block consists of a list of section dicts which contain the
+    actual text in the "plain_text" key entry. Here we reconstitute
+    the block's full text from the sections, while ignoring the MENTION tag
+    because it's irrelevant to Anki card generation. Mentions are recognized
+    the same way the scan finds them, so a renamed srs-item page is still
+    left out when SRS_MENTION_IDS is set
     """
+    is_mention = compile_mention_section_matcher(
+        MENTION_TEXT, get_current_srs_mention_ids()
+    )
+    return "".join(
+        [
+            section["plain_text"]
+            for section in block.get(block["type"], {}).get("rich_text", [])
+            if not is_mention(section)
+        ]
+    )
+
+
+def classify_topics(srs_item_texts: List[str]) -> List[Optional[str]]:
+    """The topic the current tenant's topic classifier picks for each text, or
+    None for the texts it isn't sure of (and for every text if there's no
+    classifier)"""
+    classifier = get_topic_classifier()
+    if classifier is None or len(srs_item_texts) == 0:
+        return [None] * len(srs_item_texts)
+    with metrics.time("topic_classifier_seconds"):
+        return classifier.classify(srs_item_texts)
+
 
-    def replace_single(match):
-        return "{{" + match.group(1) + "}}"
+def get_topic(srs_item_text: str, local_topic: Optional[str] = None) -> Tuple[str, str]:
+    """Pick the topic of a text, which is `local_topic` if the classifier was
+    sure of one (see `classify_topics`), and otherwise the LLM's
 
-    return re.sub(r"\{(.*?)\}", replace_single, text)
+    Returns a (topic, source) tuple, where the source is one of
+    card_store.TOPIC_SOURCES and says who picked the topic
+    """
+    if local_topic is not None:
+        metrics.increment("topic_selections_total", source="local")
+        return local_topic, "classifier"
+
+    metrics.increment("topic_selections_total", source="llm")
+    try:
+        return get_topic_from_text(srs_item_text), "llm"
+    except InvalidTopicError as e:
+        classifier = get_topic_classifier()
+        if classifier is None:
+            raise
+        # a topic the classifier isn't sure of is still better than failing
+        # the whole scan
+        [(topic, _)] = classifier.predict([srs_item_text])
+        print(f"{e}, using {topic} instead")
+        return topic, "classifier"
+
+
+def match_topic(response: Optional[str]) -> Optional[str]:
+    """The topic in TOPICS that an LLM's response names, ignoring case,
+    surrounding quotes and a trailing period, or None if it names none of them
+    (or the response is empty)"""
+    if not response:
+        return None
+    normalized_response = response.strip().strip("\"'.*").strip().lower()
+    for topic in TOPICS:
+        if topic.lower() == normalized_response:
+            return topic
+    return None
 
 
 def get_topic_from_text(srs_item_text: str) -> str:
-    """Use an LLM API to categorize text into one of the predefined topics given in TOPICS"""
+    """Use an LLM API to categorize text into one of the predefined topics given in TOPICS
 
-    system_prompt = SYSTEM_TOPIC_SELECTION_PROMPT_TEMPLATE.format(
-        topics=", ".join(TOPICS)
-    )
+    Raises an InvalidTopicError if the LLM's response isn't one of them
+    """
 
-    user_prompt = USER_TOPIC_SELECTION_PROMPT_TEMPLATE.format(text=srs_item_text)
-
-    completion = client.chat.completions.create(
-        model=MODEL_VERSION,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": user_prompt,
-            },
-        ],
+    system_prompt = SYSTEM_TOPIC_SELECTION_PROMPT
+
+    user_prompt = USER_TOPIC_SELECTION_PROMPT_TEMPLATE.format(
+        text=compact_block_text(srs_item_text)
     )
 
     # TODO: do proper error handling
-    topic = completion.choices[0].message.content
-    if topic not in TOPICS:
-        raise ValueError(
-            f"Topic {topic} is not a valid option. Must be one of {TOPICS}"
+    response = get_chat_completion_content(system_prompt, user_prompt, purpose="topic")
+    topic = match_topic(response)
+    if topic is None:
+        # don't let an invalid response stick around in the cache, otherwise
+        # we'd fail on this text every time we re-scan it
+        delete_cached_content(system_prompt, user_prompt, purpose="topic")
+        raise InvalidTopicError(
+            f"Topic {response} is not a valid option. Must be one of {TOPICS}"
         )
     return topic
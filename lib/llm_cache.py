@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# default filepath of the SQLite database that caches LLM responses
+LLM_CACHE_FILEPATH = "out/llm_cache.sqlite3"
+
+# Cached responses older than this are evicted, so that prompt or model
+# improvements eventually make their way into regenerated cards
+LLM_CACHE_MAX_AGE_DAYS = 30
+
+# The max number of cached responses we keep around. When there are more than
+# this, the least recently used responses are evicted first
+LLM_CACHE_MAX_ENTRIES = 10_000
+
+# How many responses are written between evictions, so that a long-running
+# `watch` stays under LLM_CACHE_MAX_ENTRIES (give or take this many) without
+# paying for an eviction on every write
+LLM_CACHE_WRITES_PER_EVICTION = 100
+
+
+class LLMCache:
+    """A persistent, content-addressed cache of LLM chat completion responses
+
+    Responses are keyed by a hash of the model and the full rendered system and
+    user prompts (which include the Notion block text), so any change to the
+    model, the prompt templates or the text results in a cache miss.
+
+    The cache is shared between the threads that generate card text, so every
+    access goes through a lock.
+    """
+
+    def __init__(
+        self,
+        filepath: str = LLM_CACHE_FILEPATH,
+        max_age_days: float = LLM_CACHE_MAX_AGE_DAYS,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        writes_per_eviction: int = LLM_CACHE_WRITES_PER_EVICTION,
+    ):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.writes_per_eviction = writes_per_eviction
+        self.num_writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+            """)
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str) -> str:
+        key_material = json.dumps([model, system_prompt, user_prompt])
+        return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT content FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE responses SET last_used_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.connection.commit()
+            return row[0]
+
+    def set(self, key: str, content: str) -> None:
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, content, now, now),
+            )
+            self.connection.commit()
+            self.num_writes_since_eviction += 1
+            if self.num_writes_since_eviction >= self.writes_per_eviction:
+                self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def evict(self) -> None:
+        """Remove responses that are too old, and then the least recently used
+        responses until we're back under `max_entries`"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        oldest_allowed = time.time() - self.max_age_days * 24 * 60 * 60
+        self.connection.execute(
+            "DELETE FROM responses WHERE created_at < ?", (oldest_allowed,)
+        )
+        self.connection.execute(
+            """
+            DELETE FROM responses WHERE key NOT IN (
+                SELECT key FROM responses ORDER BY last_used_at DESC LIMIT ?
+            )
+            """,
+            (self.max_entries,),
+        )
+        self.connection.commit()
+        self.num_writes_since_eviction = 0
+
+    def purge(self) -> None:
+        """Remove every cached response"""
+        with self._lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
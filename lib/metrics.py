@@ -0,0 +1,228 @@
+import json
+import random
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# The quantiles we report for every histogram
+QUANTILES = [0.5, 0.9, 0.99]
+
+# How many of the slowest items (e.g. pages) we remember for each tracker
+NUM_SLOWEST = 5
+
+# How many of its values a histogram keeps to compute its quantiles from. A
+# short run keeps all of them, so its quantiles are exact, while a histogram
+# in a long-running `watch` stays the same size however long it runs
+MAX_HISTOGRAM_SAMPLES = 10_000
+
+# A metric's name and its sorted (label, value) pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def make_key(name: str, labels: Dict[str, str]) -> MetricKey:
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+
+def format_key(key: MetricKey) -> str:
+    """Format a metric key the way Prometheus does, e.g. `name{label="value"}`"""
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def quantile(values: List[float], q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[
+        max(int(q * 100) - 1, 0)
+    ]
+
+
+class Histogram:
+    """The count and sum of the values observed, and a uniform random sample
+    of up to `max_samples` of them (reservoir sampling) for the quantiles"""
+
+    def __init__(self, max_samples: int = MAX_HISTOGRAM_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0.0
+        self.samples: List[float] = []
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+            return
+        # every value seen so far has the same chance of being in the sample
+        index = random.randrange(self.count)
+        if index < self.max_samples:
+            self.samples[index] = value
+
+    def quantile(self, q: float) -> float:
+        return quantile(self.samples, q)
+
+
+class Metrics:
+    """Counters and latency histograms for a single run of the CLI
+
+    Counters count things like requests, retries, cache hits and tokens.
+    Histograms keep the count and sum of the values observed, and a bounded
+    sample of them for the quantiles (see `Histogram`). Slowest trackers
+    remember the few slowest items, e.g. the pages that took the longest to
+    fetch. Everything is shared between threads, so every update goes through
+    a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, Histogram] = {}
+        self.slowest: Dict[str, List[Tuple[float, str]]] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = make_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = make_key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """Observe how many seconds the body of the `with` statement takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get_counter(self, name: str, **labels: str) -> float:
+        """The total of a counter across all of its labels, or across the ones
+        that have the given `labels`"""
+        wanted_labels = set(make_key(name, labels)[1])
+        with self._lock:
+            return sum(
+                value
+                for (counter_name, counter_labels), value in self.counters.items()
+                if counter_name == name and wanted_labels <= set(counter_labels)
+            )
+
+    def track_slowest(self, name: str, item: str, seconds: float) -> None:
+        with self._lock:
+            slowest = self.slowest.setdefault(name, [])
+            slowest.append((seconds, item))
+            slowest.sort(reverse=True)
+            del slowest[NUM_SLOWEST:]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.slowest.clear()
+
+    def format_summary(self) -> str:
+        """A human readable summary of everything that was recorded"""
+        with self._lock:
+            lines = []
+            if self.histograms:
+                lines.append(
+                    f"{'timing':<60} {'count':>7} {'total s':>9} "
+                    f"{'p50 ms':>8} {'p99 ms':>8}"
+                )
+                for key, histogram in sorted(self.histograms.items()):
+                    lines.append(
+                        f"{format_key(key):<60} {histogram.count:>7} "
+                        f"{histogram.sum:>9.2f} "
+                        f"{histogram.quantile(0.5) * 1000:>8.1f} "
+                        f"{histogram.quantile(0.99) * 1000:>8.1f}"
+                    )
+            if self.counters:
+                lines.append(f"\n{'counter':<60} {'value':>7}")
+                for key, value in sorted(self.counters.items()):
+                    lines.append(f"{format_key(key):<60} {value:>7g}")
+            for name, slowest in sorted(self.slowest.items()):
+                lines.append(f"\nslowest {name}:")
+                for seconds, item in slowest:
+                    lines.append(f"  {item} {seconds * 1000:.0f}ms")
+            return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        """Everything that was recorded in the Prometheus text exposition format.
+        Histograms are exported as summaries with QUANTILES"""
+        with self._lock:
+            lines = []
+            counter_names = sorted({name for name, _ in self.counters})
+            for counter_name in counter_names:
+                lines.append(f"# TYPE {counter_name} counter")
+                for key, value in sorted(self.counters.items()):
+                    if key[0] == counter_name:
+                        lines.append(f"{format_key(key)} {value:g}")
+
+            histogram_names = sorted({name for name, _ in self.histograms})
+            for histogram_name in histogram_names:
+                lines.append(f"# TYPE {histogram_name} summary")
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != histogram_name:
+                        continue
+                    for q in QUANTILES:
+                        quantile_key = (
+                            name,
+                            tuple(sorted(labels + (("quantile", str(q)),))),
+                        )
+                        lines.append(
+                            f"{format_key(quantile_key)} {histogram.quantile(q):.6f}"
+                        )
+                    lines.append(
+                        f"{format_key((name + '_sum', labels))} {histogram.sum:.6f}"
+                    )
+                    lines.append(
+                        f"{format_key((name + '_count', labels))} {histogram.count}"
+                    )
+            return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict:
+        """Everything that was recorded, as a JSON-serializable dict"""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "quantiles": {str(q): histogram.quantile(q) for q in QUANTILES},
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+                "slowest": {
+                    name: [
+                        {"item": item, "seconds": seconds} for seconds, item in slowest
+                    ]
+                    for name, slowest in sorted(self.slowest.items())
+                },
+            }
+
+    def write(self, filepath: str) -> None:
+        """Write the metrics to a file, as JSON if the filepath ends with .json
+        and in the Prometheus text format otherwise"""
+        with open(filepath, "w") as f:
+            if filepath.endswith(".json"):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+
+# The metrics for this run, which every part of the CLI records into
+metrics = Metrics()
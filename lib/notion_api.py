@@ -1,29 +1,46 @@
-import os
-from dotenv import load_dotenv
-from typing import Tuple, List, Dict
-from notion_client import Client
-import logging
-import structlog
-from notion_client.helpers import iterate_paginated_api
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Iterator,
+    Tuple,
+    List,
+    Dict,
+    FrozenSet,
+    Optional,
+    TYPE_CHECKING,
+)
 from datetime import datetime, timedelta, timezone
-
-load_dotenv()
-
-logger = structlog.wrap_logger(
-    logging.getLogger("notion-client"),
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    wrapper_class=structlog.stdlib.BoundLogger,
+from .clients import current_tenant, get_env, get_notion_client
+from .metrics import metrics
+from .pipeline import submit_in_context
+from .block_tree_cache import BlockTreeCache
+from .checkpoint import ScanCheckpoint, ScopeProgress
+from .scan_index import (
+    DEFAULT_HIGH_WATER_MARK_KEY,
+    LAST_EDITED_TIME_RESOLUTION_SECONDS,
+    ScanIndex,
 )
 
-notion = Client(auth=os.environ["NOTION_KEY"], logger=logger, log_level=logging.DEBUG)
+if TYPE_CHECKING:
+    from notion_client import APIResponseError
 
 # This is the Notion mention text that I will include in a Notion block in order
 # to signal that I want the surounding block of text to be used to generate
 # an Anki card
 MENTION_TEXT = "srs-item"
 
+
 # Only search through the last SEARCH_PERIOD_DAYS days of recently edited pages,
-# because iterating through my whole Notion workspace would be too slow
+# because iterating through my whole Notion workspace would be too slow. Once a
+# ScanIndex has a high-water mark from a previous scan we use that instead
 SEARCH_PERIOD_DAYS = 5
 
 # These are all of the Notion block types that we want to recurse through,
@@ -40,46 +57,518 @@ BLOCK_TYPES_TO_PROCESS = [
     "toggle",
 ]
 
+# Notion allows an average of 3 requests per second per integration, see
+# https://developers.notion.com/reference/request-limits
+NOTION_REQUESTS_PER_SECOND = 3
+
+# The default number of worker threads used to fetch block children in parallel.
+# Throughput is ultimately capped by NOTION_REQUESTS_PER_SECOND, so there's
+# little point in setting this much higher
+DEFAULT_CONCURRENCY = 4
+
+# How many times we retry a request that Notion rejected with a 429 before
+# giving up and raising the error
+MAX_RATE_LIMIT_RETRIES = 5
+
+# The kinds of ScanScope we can search for SRS blocks in
+SCOPE_KINDS = ["workspace", "database", "page"]
+
+# When set (see `use_block_tree_cache`), the block trees of pages that haven't
+# changed since they were last fetched are read from here instead of Notion
+block_tree_cache: Optional[BlockTreeCache] = None
+
+
+@dataclass(frozen=True)
+class ScanScope:
+    """A part of the Notion workspace to search for SRS blocks
 
-def find_srs_blocks():
+    - "workspace": every page shared with the integration, found with `notion.search`
+    - "database": the pages in the database with id `id`, found with
+      `notion.databases.query` filtered on last_edited_time
+    - "page": the single page with id `id`
+    """
+
+    kind: str
+    id: Optional[str] = None
+
+    def __str__(self) -> str:
+        return self.kind if self.id is None else f"{self.kind} {self.id}"
+
+
+WORKSPACE_SCOPE = ScanScope("workspace")
+
+
+class TokenBucket:
+    """A thread-safe token bucket rate limiter
+
+    Each request takes one token out of the bucket, and the bucket refills
+    at `rate` tokens per second up to `capacity` tokens. If the bucket is empty,
+    `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) * self.rate,
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def pause(self, seconds: float) -> None:
+        """Empty the bucket and stop handing out tokens for `seconds` seconds,
+        so that every thread backs off when Notion tells us to slow down"""
+        with self._lock:
+            self._tokens = -seconds * self.rate
+            self._updated_at = time.monotonic()
+
+
+rate_limiter = TokenBucket(NOTION_REQUESTS_PER_SECOND, NOTION_REQUESTS_PER_SECOND)
+
+# Notion's rate limit is per integration, so in a multi-tenant run each tenant's
+# requests are throttled by the rate limiter of their integration's key, and
+# one tenant being rate limited doesn't slow down the others
+rate_limiters_by_key: Dict[str, TokenBucket] = {}
+rate_limiters_lock = threading.Lock()
+
+# The number of Notion API requests we've made for each tenant (None outside of
+# a multi-tenant run), so that we can report how many requests each scan
+# scope costs
+num_api_calls_by_tenant: Dict[Optional[str], int] = {}
+num_api_calls_lock = threading.Lock()
+
+
+def call_notion_api(function: Callable[..., Any], **kwargs: Any) -> Any:
+    """Call a notion-client API method, throttled by `rate_limiter`
+
+    If Notion responds with a 429 we wait for as long as its Retry-After
+    header asks (or an exponential backoff if it's missing) and try again
+    """
+    from notion_client import APIErrorCode, APIResponseError
+
+    endpoint = get_endpoint_name(function)
+    tenant = current_tenant.get()
+    tenant_name = tenant.name if tenant is not None else None
+    tenant_rate_limiter = get_rate_limiter()
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        with metrics.time("notion_rate_limiter_wait_seconds"):
+            tenant_rate_limiter.acquire()
+        with num_api_calls_lock:
+            num_api_calls_by_tenant[tenant_name] = (
+                num_api_calls_by_tenant.get(tenant_name, 0) + 1
+            )
+        metrics.increment("notion_requests_total", endpoint=endpoint)
+        try:
+            with metrics.time("notion_request_seconds", endpoint=endpoint):
+                return function(**kwargs)
+        except APIResponseError as error:
+            if (
+                error.code != APIErrorCode.RateLimited
+                or attempt == MAX_RATE_LIMIT_RETRIES
+            ):
+                metrics.increment(
+                    "notion_errors_total", endpoint=endpoint, code=error.code
+                )
+                raise
+            metrics.increment("notion_rate_limited_total", endpoint=endpoint)
+            retry_after = get_retry_after_seconds(error, attempt)
+            print(f"Rate limited by Notion, retrying in {retry_after:.1f}s...")
+            tenant_rate_limiter.pause(retry_after)
+
+
+def get_rate_limiter() -> TokenBucket:
+    """The rate limiter of the current tenant's Notion integration, or
+    `rate_limiter` outside of a multi-tenant run"""
+    tenant = current_tenant.get()
+    if tenant is None:
+        return rate_limiter
+    notion_key = tenant.get_notion_key()
+    with rate_limiters_lock:
+        if notion_key not in rate_limiters_by_key:
+            rate_limiters_by_key[notion_key] = TokenBucket(
+                rate_limiter.rate, rate_limiter.capacity
+            )
+        return rate_limiters_by_key[notion_key]
+
+
+def get_tenant_labels() -> Dict[str, str]:
+    """The metric labels that say which tenant a metric is for, in a
+    multi-tenant run"""
+    tenant = current_tenant.get()
+    return {"tenant": tenant.name} if tenant is not None else {}
+
+
+def get_num_api_calls() -> int:
+    """The number of Notion API requests made so far for the current tenant"""
+    tenant = current_tenant.get()
+    with num_api_calls_lock:
+        return num_api_calls_by_tenant.get(
+            tenant.name if tenant is not None else None, 0
+        )
+
+
+def get_endpoint_name(function: Callable[..., Any]) -> str:
+    """A name for a notion-client API method to label its metrics with, e.g.
+    "BlocksEndpoint.update" for `notion.blocks.update`"""
+    owner = getattr(function, "__self__", None)
+    name = getattr(function, "__name__", None)
+    if name is None:
+        # some notion-client versions make endpoints like `notion.search`
+        # callable objects rather than methods
+        return type(function).__name__
+    return f"{type(owner).__name__}.{name}" if owner is not None else name
+
+
+def get_retry_after_seconds(error: "APIResponseError", attempt: int) -> float:
+    """Read the Retry-After header off a 429 error, falling back to exponential
+    backoff with jitter if the header is missing or malformed"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return 2**attempt + random.random()
+
+
+def find_srs_blocks(
+    concurrency: int = DEFAULT_CONCURRENCY,
+    scan_index: Optional[ScanIndex] = None,
+    full_scan: bool = False,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Collection[str] = (),
+) -> List[Dict]:
+    """Collect all of the blocks found by `iterate_srs_blocks` into a list"""
+    return list(
+        iterate_srs_blocks(concurrency, scan_index, full_scan, scopes, excluded_ids)
+    )
+
+
+def iterate_srs_blocks(
+    concurrency: int = DEFAULT_CONCURRENCY,
+    scan_index: Optional[ScanIndex] = None,
+    full_scan: bool = False,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Collection[str] = (),
+    checkpoint: Optional[ScanCheckpoint] = None,
+) -> Iterator[Dict]:
     """
 
     Based on the Notion API key you're using and the pages that have been
     shared with the key's integration, search through recently-edited pages
     in descending order looking for Notion blocks that have the @srs-item
     tag in them, and generate anki cards from the information in that block
+
+    Up to `concurrency` requests for block children are made in parallel, but
+    the blocks are always yielded in the same order as a serial crawl. Blocks
+    are yielded as soon as the page they're on has been searched, so callers
+    can start working on them before the whole crawl finishes
+
+    If a `scan_index` is passed in, we only look at pages edited since its
+    high-water mark and skip any page that hasn't changed since it was last
+    scanned. The whole block tree of every other page is searched, since
+    Notion doesn't bump a block's `last_edited_time` when one of its
+    descendants is edited. `full_scan` ignores the scan index and looks at
+    every page in the workspace
+
+    By default the whole workspace is searched, but `scopes` can narrow the
+    search down to specific databases and pages. Any page that is in, or is
+    beneath, one of the `excluded_ids` pages/databases/blocks is skipped
+
+    If a `checkpoint` is passed in, our progress through each scope is
+    reported to it after every chunk of pages, and any progress it already has
+    (from an interrupted scan) is resumed: finished scopes are skipped, and
+    the others pick up from their last pagination cursor with the same end
+    date as before
     """
 
+    # the parent of every page/database/block we've looked up while checking
+    # for excluded ancestors, so each one is only looked up once
+    parents_by_id: Dict[str, Dict] = {}
+    # a page can be in more than one scope, but its blocks should only be
+    # yielded once
+    searched_page_ids = set()
+
+    for scope in scopes or [WORKSPACE_SCOPE]:
+        high_water_mark_key = get_high_water_mark_key(scope)
+        progress = (
+            checkpoint.get_scope_progress(high_water_mark_key) if checkpoint else None
+        )
+        if progress is not None and progress.is_done:
+            print(f"Already searched the {scope} scope before the scan was interrupted")
+            restore_high_water_mark(scan_index, progress, high_water_mark_key)
+            continue
+        if progress is not None:
+            end_date = datetime.fromisoformat(progress.end_date)
+            start_cursor = progress.start_cursor
+            num_pages = progress.num_pages
+            restore_high_water_mark(scan_index, progress, high_water_mark_key)
+            print(
+                f"Resuming the {scope} scope after {num_pages} pages, END DATE: {end_date}"
+            )
+        else:
+            end_date = get_end_date(scope, scan_index, full_scan)
+            start_cursor = None
+            num_pages = 0
+            print(f"END DATE for the {scope} scope: {end_date}")
+        if checkpoint is not None:
+            checkpoint.start_scope(high_water_mark_key, end_date)
+        num_api_calls_before_scope = get_num_api_calls()
+
+        for page_chunk, next_cursor in iterate_page_chunks_in_scope(
+            scope, end_date, full_scan, start_cursor
+        ):
+            pages, should_break = select_pages_to_search(
+                page_chunk, end_date, scan_index, scope, full_scan
+            )
+            pages = [page for page in pages if page["id"] not in searched_page_ids]
+            if excluded_ids:
+                pages = [
+                    page
+                    for page in pages
+                    if not is_excluded(page, excluded_ids, parents_by_id)
+                ]
+            searched_page_ids.update(page["id"] for page in pages)
+            num_pages += len(pages)
+            metrics.increment(
+                "notion_pages_searched_total",
+                len(pages),
+                scope=scope.kind,
+                **get_tenant_labels(),
+            )
+            metrics.increment(
+                "notion_pages_edited_total",
+                len(
+                    [
+                        page
+                        for page in pages
+                        if scan_index is None or scan_index.is_edited(page)
+                    ]
+                ),
+                scope=scope.kind,
+                **get_tenant_labels(),
+            )
+            # the bulk of this script's work happens here
+            for srs_block in iterate_srs_blocks_in_pages(
+                pages, concurrency, scan_index
+            ):
+                if checkpoint is not None:
+                    checkpoint.block_started(srs_block["id"])
+                yield srs_block
+            if checkpoint is not None:
+                checkpoint.chunk_searched(
+                    high_water_mark_key,
+                    next_cursor,
+                    num_pages,
+                    (
+                        scan_index.get_pending_high_water_mark(high_water_mark_key)
+                        if scan_index
+                        else None
+                    ),
+                    is_done=should_break or next_cursor is None,
+                )
+                if scan_index is not None:
+                    checkpoint.save_if_due(scan_index)
+            if should_break:
+                break
+
+        print(
+            f"Searched {num_pages} pages in the {scope} scope using "
+            f"{get_num_api_calls() - num_api_calls_before_scope} Notion API calls"
+        )
+
+
+def get_end_date(
+    scope: ScanScope = WORKSPACE_SCOPE,
+    scan_index: Optional[ScanIndex] = None,
+    full_scan: bool = False,
+) -> datetime:
+    """The oldest `last_edited_time` a page in the scope needs to have for us to search it
+
+    Each scope has its own high-water mark, so scanning a single database
+    doesn't cause pages elsewhere in the workspace to be skipped
+    """
     # only search a subset of the pages in order to save on time and compute
-    now = datetime.now(timezone.utc)
-    end_date = now - timedelta(days=SEARCH_PERIOD_DAYS)
-    print(f"END DATE: {end_date}")
-
-    srs_blocks = []
-
-    for page_chunk in iterate_paginated_api(
-        notion.search,
-        sort={"direction": "descending", "timestamp": "last_edited_time"},
-        filter={"value": "page", "property": "object"},
-    ):
-        # the bulk of this script's work happens here
-        (some_srs_blocks, should_break) = find_srs_blocks_in_chunk(page_chunk, end_date)
-        srs_blocks.extend(some_srs_blocks)
-        if should_break:
-            break
+    high_water_mark = (
+        scan_index.get_high_water_mark(get_high_water_mark_key(scope))
+        if scan_index
+        else None
+    )
+    if full_scan:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    elif high_water_mark is not None:
+        # Notion timestamps are rounded down to the minute, so a page edited
+        # again in the minute of the high-water mark (or just before it) can
+        # look older than the mark. Looking a bit further back is cheap, since
+        # the scan index skips the pages that haven't changed
+        return high_water_mark - timedelta(seconds=LAST_EDITED_TIME_RESOLUTION_SECONDS)
+    else:
+        return datetime.now(timezone.utc) - timedelta(days=SEARCH_PERIOD_DAYS)
+
+
+def restore_high_water_mark(
+    scan_index: Optional[ScanIndex], progress: ScopeProgress, key: str
+) -> None:
+    """Carry over the high-water mark an interrupted scan had reached, so that
+    resuming it ends up where the scan would have without the interruption"""
+    if scan_index is not None and progress.high_water_mark is not None:
+        scan_index.set_high_water_mark(
+            datetime.fromisoformat(progress.high_water_mark), key
+        )
+
 
-    return srs_blocks
+def get_high_water_mark_key(scope: ScanScope) -> str:
+    # the workspace scope keeps the key used before scopes existed, so existing
+    # scan indexes carry on from where they left off
+    if scope == WORKSPACE_SCOPE:
+        return DEFAULT_HIGH_WATER_MARK_KEY
+    return f"{DEFAULT_HIGH_WATER_MARK_KEY}:{scope.kind}:{scope.id}"
 
 
-def find_srs_blocks_in_chunk(page_chunk, end_date: datetime) -> Tuple[list, bool]:
+def iterate_page_chunks_in_scope(
+    scope: ScanScope,
+    end_date: datetime,
+    full_scan: bool = False,
+    start_cursor: Optional[str] = None,
+) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+    """Iterate over the pages in a ScanScope in chunks, most recently edited first,
+    starting from `start_cursor` if it's set
+
+    Yields a (chunk of pages, cursor of the next chunk) tuple for each chunk,
+    where the cursor is None after the last chunk
+    """
+    notion = get_notion_client()
+    if scope.kind == "workspace":
+        yield from iterate_result_chunks(
+            partial(call_notion_api, notion.search),
+            start_cursor,
+            sort={"direction": "descending", "timestamp": "last_edited_time"},
+            filter={"value": "page", "property": "object"},
+        )
+    elif scope.kind == "database":
+        # unlike search, a database query can filter on last_edited_time, so
+        # Notion only sends back the pages we actually need to look at
+        query: Dict[str, Any] = {
+            "database_id": scope.id,
+            "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}],
+        }
+        if not full_scan:
+            query["filter"] = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {"on_or_after": end_date.isoformat()},
+            }
+        yield from iterate_result_chunks(
+            partial(call_notion_api, notion.databases.query), start_cursor, **query
+        )
+    elif scope.kind == "page":
+        yield [call_notion_api(notion.pages.retrieve, page_id=scope.id)], None
+    else:
+        raise ValueError(
+            f"Scope kind {scope.kind} is not a valid option. Must be one of {SCOPE_KINDS}"
+        )
+
+
+def iterate_result_chunks(
+    function: Callable[..., Dict], start_cursor: Optional[str] = None, **kwargs: Any
+) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+    """Call a paginated Notion API endpoint, following the pagination cursor and
+    yielding each response's list of results along with the cursor of the
+    next response (None for the last one)
+
+    notion_client.helpers.iterate_paginated_api yields one result at a time in
+    some versions of notion-client and whole pages of results in others, so we
+    page through the results ourselves
+    """
+    if start_cursor is not None:
+        kwargs["start_cursor"] = start_cursor
+    while True:
+        response = function(**kwargs)
+        next_cursor = response.get("next_cursor") if response.get("has_more") else None
+        yield response["results"], next_cursor
+        if next_cursor is None:
+            return
+        kwargs["start_cursor"] = next_cursor
+
+
+def is_excluded(
+    page: Dict, excluded_ids: Collection[str], parents_by_id: Dict[str, Dict]
+) -> bool:
+    """Whether the page or any of its ancestors is in `excluded_ids`
+
+    Ancestors are found by walking up the page's parents, looking up each
+    parent we haven't seen before with the Notion API and remembering it in
+    `parents_by_id`. The walk stops at the first ancestor that isn't shared
+    with the integration, since we can't see any further up from there
+    """
+    if page["id"] in excluded_ids:
+        return True
+
+    parent = page.get("parent", {})
+    while parent.get("type") in ("page_id", "database_id", "block_id"):
+        parent_id = parent[parent["type"]]
+        if parent_id in excluded_ids:
+            return True
+        if parent_id not in parents_by_id:
+            parents_by_id[parent_id] = retrieve_parent_of(parent)
+        parent = parents_by_id[parent_id]
+    return False
+
+
+def retrieve_parent_of(parent: Dict) -> Dict:
+    """Look up a page/database/block's `parent` and return that parent's own
+    parent, or an empty parent if the integration can't see it"""
+    from notion_client import APIErrorCode, APIResponseError
+
+    notion = get_notion_client()
+    parent_type = parent["type"]
+    try:
+        if parent_type == "page_id":
+            item = call_notion_api(notion.pages.retrieve, page_id=parent["page_id"])
+        elif parent_type == "database_id":
+            item = call_notion_api(
+                notion.databases.retrieve, database_id=parent["database_id"]
+            )
+        else:
+            item = call_notion_api(notion.blocks.retrieve, block_id=parent["block_id"])
+    except APIResponseError as error:
+        # Notion answers with a 404 for anything that isn't shared with the
+        # integration, e.g. the workspace page above a shared page
+        if error.code not in (
+            APIErrorCode.ObjectNotFound,
+            APIErrorCode.RestrictedResource,
+        ):
+            raise
+        return {}
+    return item.get("parent", {})
+
+
+def select_pages_to_search(
+    page_chunk,
+    end_date: datetime,
+    scan_index: Optional[ScanIndex] = None,
+    scope: ScanScope = WORKSPACE_SCOPE,
+    full_scan: bool = False,
+) -> Tuple[List[Dict], bool]:
     """
     Returns a tuple with:
-        - A list of SRS blocks found in the page chunk
+        - A list of the pages in the page chunk that need to be searched for SRS blocks
         - A boolean indicating if we should stop iterating further pages
 
     We don't want to waste time and compute on iterating through pages that
     are too old. This function returns True if we should stop iterating
-    further pages.
+    further pages. Pages that haven't changed since `scan_index` last saw them
+    are left out too, unless it's a `full_scan`.
 
     For debugging purposes, here is an example of what a `page_chunk` looks
     like:
@@ -122,25 +611,205 @@ def find_srs_blocks_in_chunk(page_chunk, end_date: datetime) -> Tuple[list, bool
     ]
     ```json
     """
-    srs_blocks: List[Dict] = []
+    pages: List[Dict] = []
+    should_break = False
     for page in page_chunk:
-        if end_date > datetime.fromisoformat(page["last_edited_time"]):
-            return (srs_blocks, True)
-        page_id = page["id"]
-        some_srs_blocks = search_page_for_blocks_containing_mention(
-            page_id, MENTION_TEXT
-        )
-        srs_blocks.extend(some_srs_blocks)
+        page_last_edited_time = datetime.fromisoformat(page["last_edited_time"])
+        if end_date > page_last_edited_time:
+            should_break = True
+            break
+        if scan_index is not None:
+            scan_index.set_high_water_mark(
+                page_last_edited_time, get_high_water_mark_key(scope)
+            )
+            if not full_scan and not scan_index.needs_scan(page):
+                # nothing has changed on this page since we last scanned it
+                continue
+        pages.append(page)
+
+    return (pages, should_break)
+
+
+def use_block_tree_cache(cache: Optional[BlockTreeCache]) -> None:
+    """Set the cache that pages' block trees are read from and written to, or
+    pass None to always fetch them from Notion"""
+    global block_tree_cache
+    block_tree_cache = cache
+
+
+def iterate_srs_blocks_in_pages(
+    pages: List[Dict],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    scan_index: Optional[ScanIndex] = None,
+) -> Iterator[Dict]:
+    """Search the given pages for SRS blocks, yielding them page by page"""
+    pages_by_id = {page["id"]: page for page in pages}
+
+    # fetch every page's block tree in parallel (unless it's cached), and then
+    # walk each tree as soon as it's complete, page by page so the blocks come
+    # out in a deterministic order
+    for page_id, children_by_id in iterate_page_block_trees(pages, concurrency):
+        with metrics.time("mention_search_seconds"):
+            some_srs_blocks = search_page_for_blocks_containing_mention(
+                page_id, MENTION_TEXT, children_by_id
+            )
+        metrics.increment("srs_blocks_found_total", len(some_srs_blocks))
+        if scan_index is not None:
+            scan_index.record(
+                pages_by_id[page_id], has_mention=len(some_srs_blocks) > 0
+            )
+        yield from some_srs_blocks
+
+
+def iterate_page_block_trees(
+    pages: List[Dict],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Iterator[Tuple[str, Dict[str, List[Dict]]]]:
+    """`iterate_block_trees` for pages, reading the trees of pages that haven't
+    changed from the block tree cache and fetching the rest"""
+    cached_trees = {}
+    if block_tree_cache is not None:
+        for page in pages:
+            children_by_id = block_tree_cache.get(page)
+            if children_by_id is not None:
+                cached_trees[page["id"]] = children_by_id
+
+    fetched_trees = iterate_block_trees(
+        [page["id"] for page in pages if page["id"] not in cached_trees],
+        concurrency,
+    )
+    # closing the fetches as soon as we stop, rather than whenever they're
+    # garbage collected, cancels the ones that haven't started
+    with closing(fetched_trees):
+        for page in pages:
+            if page["id"] in cached_trees:
+                yield page["id"], cached_trees[page["id"]]
+                continue
+            # the fetched trees come out in the same order as the pages
+            page_id, children_by_id = next(fetched_trees)
+            if block_tree_cache is not None:
+                block_tree_cache.set(page, children_by_id)
+            yield page_id, children_by_id
+
+
+def should_recurse_into_block(block: Dict) -> bool:
+    """Whether we need to look through the children of this block for mentions
+
+    A block's own `last_edited_time` says nothing about its children, since
+    Notion doesn't bump it when a descendant is edited, so a changed page's
+    whole tree is always searched
+    """
+    return block["type"] in BLOCK_TYPES_TO_PROCESS and block["has_children"]
+
+
+def fetch_block_children(block_id: str) -> List[Dict]:
+    """Fetch all of the child blocks of a Notion page/block, following the
+    pagination cursor until there are no more results"""
+    children: List[Dict] = []
+    kwargs: Dict[str, Any] = {"block_id": block_id}
+    while True:
+        response = call_notion_api(get_notion_client().blocks.children.list, **kwargs)
+        children.extend(response["results"])
+        if not response.get("has_more") or not response.get("next_cursor"):
+            return children
+        kwargs["start_cursor"] = response["next_cursor"]
 
-    return (srs_blocks, False)
+
+def fetch_block_children_timed(block_id: str) -> Tuple[List[Dict], float]:
+    """`fetch_block_children`, along with how many seconds it took"""
+    start = time.perf_counter()
+    children = fetch_block_children(block_id)
+    return children, time.perf_counter() - start
+
+
+def iterate_block_trees(
+    root_block_ids: List[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Iterator[Tuple[str, Dict[str, List[Dict]]]]:
+    """Fetch the block trees beneath the given pages/blocks using a pool of
+    `concurrency` threads
+
+    Yields a (root block id, children_by_id) tuple for each root as soon as its
+    whole tree has been fetched, in the same order as `root_block_ids`, where
+    children_by_id maps each block id in the tree to its list of child blocks.
+    As soon as a block's children come back, we queue up fetches for any of
+    those children that themselves have children, so the trees are fetched
+    breadth-first without waiting on sibling subtrees.
+
+    If the caller stops early (closing the generator, e.g. on Ctrl-C or when
+    card generation fails) or a fetch fails, the fetches that haven't started
+    are cancelled rather than waited for, and the ones already running are
+    left to finish in the background.
+    """
+    children_by_root: Dict[str, Dict[str, List[Dict]]] = {
+        root_block_id: {} for root_block_id in root_block_ids
+    }
+    # the number of fetches still in flight for each root's tree
+    num_pending_by_root = {root_block_id: 1 for root_block_id in root_block_ids}
+    # the time spent fetching each root's tree, so we can spot slow pages
+    fetch_seconds_by_root = {root_block_id: 0.0 for root_block_id in root_block_ids}
+    next_root_index = 0
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    pending: Dict[Future, Tuple[str, str]] = {}
+    is_done = False
+    try:
+        pending = {
+            submit_in_context(executor, fetch_block_children_timed, block_id): (
+                block_id,
+                block_id,
+            )
+            for block_id in root_block_ids
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                block_id, root_block_id = pending.pop(future)
+                children, fetch_seconds = future.result()
+                children_by_root[root_block_id][block_id] = children
+                num_pending_by_root[root_block_id] -= 1
+                fetch_seconds_by_root[root_block_id] += fetch_seconds
+                for child in children:
+                    if should_recurse_into_block(child):
+                        child_future = submit_in_context(
+                            executor, fetch_block_children_timed, child["id"]
+                        )
+                        pending[child_future] = (child["id"], root_block_id)
+                        num_pending_by_root[root_block_id] += 1
+
+            # hand back every finished tree we can without going out of order
+            while (
+                next_root_index < len(root_block_ids)
+                and num_pending_by_root[root_block_ids[next_root_index]] == 0
+            ):
+                root_block_id = root_block_ids[next_root_index]
+                fetch_seconds = fetch_seconds_by_root.pop(root_block_id)
+                metrics.observe("notion_page_fetch_seconds", fetch_seconds)
+                metrics.track_slowest("page fetches", root_block_id, fetch_seconds)
+                yield (root_block_id, children_by_root.pop(root_block_id))
+                next_root_index += 1
+        is_done = True
+    finally:
+        if is_done:
+            executor.shutdown()
+        else:
+            # don't wait for the rest of the pages to be fetched, with the
+            # rate limiting and backoff that comes with them
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 def search_page_for_blocks_containing_mention(
-    block_id: str, mention_text: str
+    block_id: str,
+    mention_text: str,
+    children_by_id: Optional[Dict[str, List[Dict]]] = None,
 ) -> List[Dict]:
     """Search a Notion page/block for blocks containing a mention text and return any matching blocks
 
-    We recurse on the block if it has any child blocks
+    We recurse on the block if it has any child blocks. If `children_by_id`
+    (as yielded by `iterate_block_trees`) is passed in, child blocks are
+    read from it instead of being fetched from the Notion API
 
     For debugging purposes, here's an example output from the notion.blocks.children.list
     API call:
@@ -244,41 +913,117 @@ def search_page_for_blocks_containing_mention(
     ```json
     """
 
+    if children_by_id is not None and block_id in children_by_id:
+        blocks = children_by_id[block_id]
+    else:
+        blocks = fetch_block_children(block_id)
+
+    has_mention = compile_mention_matcher(mention_text, get_current_srs_mention_ids())
     blocks_with_mentions: List[Dict] = []
-    for blocks in iterate_paginated_api(
-        notion.blocks.children.list,
-        block_id=block_id,
-    ):
-        some_blocks_with_mentions: List[Dict] = []
-
-        for block in blocks:
-            # TODO recursively search through block children
-            block_type = block["type"]
-            if block_type not in BLOCK_TYPES_TO_PROCESS:
-                # these block types contain nothing interesting,
-                # continue on
-                continue
+    for block in blocks:
+        block_type = block["type"]
+        if block_type not in BLOCK_TYPES_TO_PROCESS:
+            # these block types contain nothing interesting,
+            # continue on
+            continue
+
+        # add the block to our list of mentioned blocks as soon as one of
+        # its sections contains the mention, so it's only added once
+        block_has_mention = has_mention(block[block_type]["rich_text"])
+        if block_has_mention:
+            blocks_with_mentions.append(block)
 
-            # search for the mention within each section of of a block
-            # and add the block to our list of mentioned block if it
-            # does indeed contain the mention
-            for content_section in block[block_type]["rich_text"]:
-                if (
-                    mention_text in content_section["plain_text"]
-                    and not content_section["annotations"]["strikethrough"]
-                ):
-                    some_blocks_with_mentions.append(block)
-
-            if block["has_children"]:
-                # recurse!
-                some_blocks_with_mentions.extend(
-                    search_page_for_blocks_containing_mention(block["id"], mention_text)
+        if should_recurse_into_block(block):
+            # recurse!
+            blocks_with_mentions.extend(
+                search_page_for_blocks_containing_mention(
+                    block["id"], mention_text, children_by_id
                 )
+            )
 
-        blocks_with_mentions.extend(some_blocks_with_mentions)
     return blocks_with_mentions
 
 
+@lru_cache(maxsize=None)
+def get_srs_mention_ids() -> FrozenSet[str]:
+    """The ids of the Notion pages/users/dates that the srs-item mention points to
+
+    These are read from the SRS_MENTION_IDS environment variable, as a
+    comma-separated list (in a multi-tenant run, each tenant's come from the
+    tenants config instead). When they're set, a mention is recognized by its id
+    rather than by the text it happens to render as, so renaming the srs-item
+    page doesn't break anything
+    """
+    return frozenset(
+        mention_id.strip()
+        for mention_id in get_env("SRS_MENTION_IDS", "").split(",")
+        if mention_id.strip()
+    )
+
+
+def get_current_srs_mention_ids() -> FrozenSet[str]:
+    """The srs-item mention ids of the current tenant, or `get_srs_mention_ids`
+    outside of a multi-tenant run"""
+    tenant = current_tenant.get()
+    return tenant.srs_mention_ids if tenant is not None else get_srs_mention_ids()
+
+
+@lru_cache(maxsize=None)
+def compile_mention_section_matcher(
+    mention_text: str, mention_ids: FrozenSet[str] = frozenset()
+) -> Callable[[Dict], bool]:
+    """Build a function that says whether a single rich_text section is an
+    SRS mention, processed or not
+
+    A real Notion mention has a structured payload like
+    `{'type': 'page', 'page': {'id': '0348...'}}`. If `mention_ids` is given we
+    match on the id in that payload, otherwise on the mention rendering as
+    `mention_text` (with or without a leading "@"). Sections that aren't
+    mentions fall back to looking for `mention_text` in their plain text, so
+    a typed "srs-item" still counts.
+    """
+    mention_titles = frozenset([mention_text, f"@{mention_text}"])
+
+    def is_mention(content_section: Dict) -> bool:
+        plain_text = content_section["plain_text"]
+        if content_section["type"] == "mention":
+            mention = content_section["mention"]
+            mentioned = mention.get(mention["type"])
+            if mention_ids and isinstance(mentioned, dict):
+                is_match = mentioned.get("id") in mention_ids
+            else:
+                is_match = plain_text.strip() in mention_titles
+            return is_match or mention_text in plain_text
+        return mention_text in plain_text
+
+    return is_mention
+
+
+@lru_cache(maxsize=None)
+def compile_mention_matcher(
+    mention_text: str, mention_ids: FrozenSet[str] = frozenset()
+) -> Callable[[List[Dict]], bool]:
+    """Build a function that says whether a block's rich_text contains an
+    unprocessed SRS mention
+
+    Sections are matched with `compile_mention_section_matcher`. Struck-through
+    sections have already been processed, so they never match. The search
+    stops at the first match.
+    """
+    is_mention = compile_mention_section_matcher(mention_text, mention_ids)
+
+    def has_mention(rich_text: List[Dict]) -> bool:
+        for content_section in rich_text:
+            if (
+                is_mention(content_section)
+                and not content_section["annotations"]["strikethrough"]
+            ):
+                return True
+        return False
+
+    return has_mention
+
+
 def mark_srs_block_as_processed(block: Dict) -> Dict:
     """Adds a strikethrough to the mention text in a block to mark it as processed
 
@@ -289,7 +1034,8 @@ def mark_srs_block_as_processed(block: Dict) -> Dict:
     new_rich_text: List[Dict] = []
 
     for content_section in block[block_type]["rich_text"]:
-        content_section["annotations"]["strikethrough"] = True
+        # block snapshots leave out the annotations that aren't set
+        content_section.setdefault("annotations", {})["strikethrough"] = True
         new_rich_text.append(content_section)
 
     block[block_type]["rich_text"] = new_rich_text
@@ -305,28 +1051,41 @@ def update_block_for_different_block_types(block: Dict) -> Dict:
     the `notion.blocks.update` function takes a non-positional `block_id` parameter but a
     positional argument for the block data, we need to pass the positional block data argument
     using differently named keyword arguments based on the block type.
+
+    Updates go through `call_notion_api`, so they're throttled and retried on 429s
     """
+    notion = get_notion_client()
     block_type = block["type"]
     block_content = block[block_type]
 
     if block_type == "paragraph":
-        return notion.blocks.update(block_id=block["id"], paragraph=block_content)
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], paragraph=block_content
+        )
     elif block_type == "bulleted_list_item":
-        return notion.blocks.update(
-            block_id=block["id"], bulleted_list_item=block_content
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], bulleted_list_item=block_content
         )
     elif block_type == "heading_1":
-        return notion.blocks.update(block_id=block["id"], heading_1=block_content)
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], heading_1=block_content
+        )
     elif block_type == "heading_2":
-        return notion.blocks.update(block_id=block["id"], heading_2=block_content)
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], heading_2=block_content
+        )
     elif block_type == "heading_3":
-        return notion.blocks.update(block_id=block["id"], heading_3=block_content)
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], heading_3=block_content
+        )
     elif block_type == "numbered_list_item":
-        return notion.blocks.update(
-            block_id=block["id"], numbered_list_item=block_content
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], numbered_list_item=block_content
         )
     elif block_type == "toggle":
-        return notion.blocks.update(block_id=block["id"], toggle=block_content)
+        return call_notion_api(
+            notion.blocks.update, block_id=block["id"], toggle=block_content
+        )
     else:
         raise ValueError(
             f"Block type {block_type} is an unexpected block type that's not in BLOCK_TYPES_TO_PROCESS: {BLOCK_TYPES_TO_PROCESS}"
@@ -0,0 +1,102 @@
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from contextvars import copy_context
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# The default max number of items a background producer can get ahead of
+# its consumer by
+DEFAULT_MAX_QUEUE_SIZE = 64
+
+# how often (in seconds) a blocked producer checks whether its consumer has gone away
+PRODUCER_POLL_INTERVAL_SECONDS = 0.5
+
+
+class _Done:
+    """Put on the queue by the producer once it has run out of items"""
+
+
+class _Failed:
+    """Put on the queue by the producer if it raises, so the consumer can re-raise"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def iterate_in_background(
+    items: Iterable[T], max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE
+) -> Iterator[T]:
+    """Run `items` on a background thread, handing its items over to the caller
+    through a bounded queue
+
+    This lets a slow producer (e.g. the Notion crawl) keep working while the
+    caller is busy with the items it has already produced (e.g. waiting on
+    the LLM). The producer blocks once it's `max_queue_size` items ahead, and
+    stops if the caller stops iterating. Any exception raised by the producer
+    is re-raised in the caller.
+
+    Once the returned generator is closed (or exhausted, or the producer
+    fails), the producer thread has finished, so the caller can safely clean
+    up whatever the producer was using, e.g. roll back a SQLite connection.
+    Closing it waits for the producer to get to its next item.
+    """
+    item_queue: "queue.Queue" = queue.Queue(maxsize=max_queue_size)
+    stopped = threading.Event()
+
+    def put(item) -> None:
+        while not stopped.is_set():
+            try:
+                item_queue.put(item, timeout=PRODUCER_POLL_INTERVAL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def produce() -> None:
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    return
+                put(item)
+            put(_Done())
+        except BaseException as e:
+            put(_Failed(e))
+        finally:
+            # a generator that was stopped early is closed here, so its own
+            # clean up runs on this thread rather than whenever it's collected
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    # the producer runs with the caller's context, e.g. its current tenant
+    producer = threading.Thread(target=copy_context().run, args=(produce,), daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if isinstance(item, _Done):
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        # make room on the queue, so a producer that's waiting to put an item
+        # notices that it should stop right away
+        while True:
+            try:
+                item_queue.get_nowait()
+            except queue.Empty:
+                break
+        producer.join()
+
+
+def submit_in_context(
+    executor: Executor, function: Callable[..., T], *args: Any
+) -> "Future[T]":
+    """`executor.submit`, but the function runs with a copy of the calling
+    thread's context variables (e.g. `clients.current_tenant`), which worker
+    threads don't otherwise inherit"""
+    return executor.submit(copy_context().run, function, *args)
@@ -0,0 +1,114 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# A rough rule of thumb for English text, used to estimate token counts without
+# needing a tokenizer
+CHARS_PER_TOKEN = 4
+
+# Blocks whose text is longer than this many (estimated) tokens are trimmed
+# before they're put in a prompt. A card only needs a sentence or two of
+# context, and the rest of a long block is paid for on every request made for it
+DEFAULT_MAX_BLOCK_TOKENS = 400
+
+# Requests whose user prompt (which is mostly the block's text) has up to this
+# many (estimated) tokens are short enough for the cheap model, see `ModelRouting`
+DEFAULT_CHEAP_MODEL_MAX_TOKENS = 120
+
+# Appended to a trimmed block's text, so the LLM knows it isn't the whole block
+TRIMMED_TEXT_MARKER = " …"
+
+# The end of a sentence, where we'd rather trim a block than mid-sentence
+SENTENCE_END_PATTERN = re.compile(r"[.!?](?=\s)")
+
+# runs of whitespace, which cost tokens without changing the text's meaning
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class TokenBudgetExceededError(RuntimeError):
+    """Raised instead of making an LLM request once a run has spent its token
+    budget, see `TokenBudget`"""
+
+
+def estimate_num_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def compact_text(text: str, max_tokens: Optional[int]) -> str:
+    """Collapse the whitespace in a block's text, and trim it to about
+    `max_tokens` tokens if it's longer than that (None or 0 never trims)
+
+    Trimmed text is cut at the last sentence end that fits, or the last word
+    if there isn't one, so the LLM never sees half a word
+    """
+    text = WHITESPACE_PATTERN.sub(" ", text).strip()
+    if not max_tokens or estimate_num_tokens(text) <= max_tokens:
+        return text
+
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    trimmed_text = text[:max_chars]
+    sentence_ends = [
+        match.end() for match in SENTENCE_END_PATTERN.finditer(trimmed_text)
+    ]
+    if sentence_ends:
+        trimmed_text = trimmed_text[: sentence_ends[-1]]
+    elif " " in trimmed_text:
+        trimmed_text = trimmed_text[: trimmed_text.rindex(" ")]
+    return trimmed_text + TRIMMED_TEXT_MARKER
+
+
+@dataclass(frozen=True)
+class ModelRouting:
+    """Which model each LLM request goes to
+
+    Topic selection is a simple classification, so it always goes to
+    `cheap_model`. Card requests whose user prompt has up to
+    `cheap_model_max_tokens` tokens go to `cheap_model` too, and card requests
+    for longer blocks (and batches, which are long) go to `model`
+    """
+
+    model: str
+    cheap_model: str
+    cheap_model_max_tokens: int = DEFAULT_CHEAP_MODEL_MAX_TOKENS
+
+    def choose_model(self, purpose: str, num_prompt_tokens: int) -> str:
+        if purpose == "topic" or num_prompt_tokens <= self.cheap_model_max_tokens:
+            return self.cheap_model
+        return self.model
+
+
+class TokenBudget:
+    """The max number of LLM tokens (prompt and completion) a run can spend
+
+    Each request is charged its estimated prompt tokens before it's made,
+    which raises a TokenBudgetExceededError if they'd go over the budget, and
+    is corrected with the tokens the LLM actually billed once it's done. A
+    request that fails keeps its estimated charge, since a request that timed
+    out may still have been billed. Requests answered from the LLM cache are
+    free. The budget is shared between the threads that generate card text, so
+    every access goes through a lock
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.num_spent = 0
+        self._lock = threading.Lock()
+
+    def charge(self, num_tokens: int) -> None:
+        with self._lock:
+            if self.num_spent + num_tokens > self.max_tokens:
+                raise TokenBudgetExceededError(
+                    f"Stopped generating cards after spending {self.num_spent} of "
+                    f"the run's {self.max_tokens} token budget"
+                )
+            self.num_spent += num_tokens
+
+    def correct(self, num_estimated_tokens: int, num_billed_tokens: int) -> None:
+        with self._lock:
+            self.num_spent += num_billed_tokens - num_estimated_tokens
+
+    def get_usage(self) -> Tuple[int, int]:
+        """The number of tokens spent so far and the budget"""
+        with self._lock:
+            return self.num_spent, self.max_tokens
@@ -0,0 +1,288 @@
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, List, Optional, Sequence, Tuple
+from .anki_utils import DEFAULT_ANKI_CHUNK_SIZE, AnkiCard, add_anki_cards_to_deck
+from .card_store import CardStore
+from .card_text import post_process_card_texts
+from .intelligence import TOPICS
+from .metrics import metrics
+from .pipeline import submit_in_context
+from .writeback_queue import WritebackQueue
+
+# The commands the generate_cards review understands
+REVIEW_HELP = """\
+  y or Enter     accept this card
+  n              reject this card
+  e              edit this card's text before deciding
+  c <topic>      change this card's topic to the one that starts with <topic>
+  s              skip this card for now, it stays pending
+  a              accept this card and every undecided card after it
+  t <topic>      reject every undecided card whose topic starts with <topic>
+  <i>-<j> y|n    accept or reject the undecided cards numbered i to j
+  l              list the undecided cards
+  q              stop reviewing, the undecided cards stay pending
+  ?              show this help"""
+
+# e.g. "3-7 n" or "12 y"
+RANGE_COMMAND_PATTERN = re.compile(r"^(\d+)(?:\s*-\s*(\d+))?\s+([yn])$")
+
+
+class AnkiSyncer:
+    """Adds accepted cards to Anki on a background thread, so the review never
+    waits on Anki Connect
+
+    Accepted cards are buffered and sent to Anki `chunk_size` at a time. The
+    results are applied (the cards marked as synced, and their blocks queued
+    to be marked as processed in Notion) on the reviewing thread whenever
+    `collect` is called, since the card store's SQLite connection belongs to
+    that thread. A single worker keeps the cards in the order they were
+    accepted. Any card that fails for a reason other than already being in
+    the deck stays accepted, so that we try again next time.
+    """
+
+    def __init__(
+        self,
+        card_store: CardStore,
+        writeback_queue: WritebackQueue,
+        chunk_size: int = DEFAULT_ANKI_CHUNK_SIZE,
+    ):
+        self.card_store = card_store
+        self.writeback_queue = writeback_queue
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.buffer: List[AnkiCard] = []
+        self.in_flight: Deque[Tuple[List[AnkiCard], Future]] = deque()
+        self.num_synced = 0
+        self.num_failed = 0
+
+    def add(self, card: AnkiCard) -> None:
+        self.buffer.append(card)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Start adding the buffered cards to Anki"""
+        if not self.buffer:
+            return
+        cards, self.buffer = self.buffer, []
+        future = submit_in_context(
+            self.executor, add_anki_cards_to_deck, cards, self.chunk_size
+        )
+        self.in_flight.append((cards, future))
+
+    def collect(self, wait: bool = False) -> None:
+        """Apply the results of the chunks that have been added to Anki, waiting
+        for every chunk still in flight if `wait` is set"""
+        while self.in_flight and (wait or self.in_flight[0][1].done()):
+            cards, future = self.in_flight.popleft()
+            try:
+                results = future.result()
+            except Exception as e:
+                # e.g. Anki isn't running
+                print(f"\nfailed to add {len(cards)} cards to Anki: {e}")
+                self.num_failed += len(cards)
+                continue
+
+            for result in results:
+                notion_block_id = result.card.notion_block["id"]
+                if result.error is not None and not result.is_duplicate:
+                    print(
+                        f"\nfailed to add card with id {notion_block_id}: {result.error}"
+                    )
+                    self.num_failed += 1
+                    continue
+                if result.is_duplicate:
+                    print(
+                        f"\ncard with id {notion_block_id} is already in the Anki deck"
+                    )
+                self.card_store.set_status(result.card, "synced")
+                self.writeback_queue.enqueue(result.card.notion_block)
+                self.num_synced += 1
+
+    def close(self) -> None:
+        """Add the rest of the buffered cards to Anki and wait for them"""
+        self.flush()
+        self.collect(wait=True)
+        self.executor.shutdown()
+
+
+class ReviewSession:
+    """The interactive review of the pending cards in `generate_cards`
+
+    Every decision is saved to the card store as soon as it's made, and its
+    side effects run in the background: accepted cards are handed to the
+    AnkiSyncer and rejected cards' blocks to the WritebackQueue. That way the
+    next card is shown as soon as the reviewer has answered. Cards are
+    numbered from 1 in the order they're shown, which is what the range
+    command refers to.
+    """
+
+    def __init__(
+        self,
+        cards: Sequence[AnkiCard],
+        card_store: CardStore,
+        writeback_queue: WritebackQueue,
+        anki_syncer: AnkiSyncer,
+    ):
+        self.cards = list(cards)
+        self.card_store = card_store
+        self.writeback_queue = writeback_queue
+        self.anki_syncer = anki_syncer
+        # the status each card was given during this review, or None while
+        # it's undecided
+        self.statuses: List[Optional[str]] = [None] * len(self.cards)
+        self.position = 0
+
+    def run(self) -> None:
+        if len(self.cards) == 0:
+            return
+        print(
+            "Please view the list of cards to create and either accept or deny each, "
+            "or enter ? to see the other commands...\n"
+        )
+        while True:
+            self.anki_syncer.collect()
+            index = self.get_next_undecided_index()
+            if index is None:
+                return
+            self.position = index
+            self.print_card(index)
+            try:
+                command = input(
+                    "Do you want to generate this card? (y/n/e/c/s/a/t/q, ? for help): "
+                ).strip()
+            except EOFError:
+                return
+            if not self.handle_command(index, command):
+                return
+
+    def handle_command(self, index: int, command: str) -> bool:
+        """Carry out a review command for the card at `index`, returning False if
+        the review should stop"""
+        lowered_command = command.lower()
+        range_match = RANGE_COMMAND_PATTERN.match(lowered_command)
+        if lowered_command in ("y", ""):
+            self.decide([index], "accepted")
+            self.position = index + 1
+        elif lowered_command == "n":
+            self.decide([index], "rejected")
+            self.position = index + 1
+        elif lowered_command == "e":
+            self.edit_card(index)
+        elif lowered_command.startswith("c "):
+            self.change_topic(index, command[2:].strip())
+        elif lowered_command == "s":
+            self.position = index + 1
+        elif lowered_command == "a":
+            num_accepted = self.decide(range(index, len(self.cards)), "accepted")
+            print(f"accepted {num_accepted} cards")
+        elif lowered_command.startswith("t "):
+            self.reject_topic(command[2:].strip())
+        elif range_match is not None:
+            first, last, answer = range_match.groups()
+            self.decide_range(int(first), int(last or first), answer)
+        elif lowered_command == "l":
+            self.list_undecided_cards()
+        elif lowered_command == "q":
+            return False
+        else:
+            print(REVIEW_HELP)
+        return True
+
+    def decide(self, indexes: Sequence[int], status: str) -> int:
+        """Accept or reject the undecided cards at `indexes`, returning how many
+        of them were decided"""
+        indexes = [index for index in indexes if self.statuses[index] is None]
+        cards = [self.cards[index] for index in indexes]
+        if len(cards) == 0:
+            return 0
+        self.card_store.set_statuses(cards, status)
+        for index in indexes:
+            self.statuses[index] = status
+        for card in cards:
+            if status == "accepted":
+                self.anki_syncer.add(card)
+            else:
+                # a rejected card is done with, so it can be marked as processed now
+                self.writeback_queue.enqueue(card.notion_block)
+        metrics.increment("review_decisions_total", len(cards), decision=status)
+        return len(cards)
+
+    def decide_range(self, first: int, last: int, answer: str) -> None:
+        if not 1 <= first <= last <= len(self.cards):
+            print(f"cards are numbered from 1 to {len(self.cards)}")
+            return
+        status = "accepted" if answer == "y" else "rejected"
+        num_decided = self.decide(range(first - 1, last), status)
+        print(f"{status} {num_decided} cards")
+
+    def reject_topic(self, topic_prefix: str) -> None:
+        undecided_indexes = self.get_undecided_indexes()
+        indexes = [
+            index
+            for index in undecided_indexes
+            if self.cards[index].topic is not None
+            and self.cards[index].topic.lower().startswith(topic_prefix.lower())
+        ]
+        if len(indexes) == 0 or topic_prefix == "":
+            topics = sorted(
+                {
+                    self.cards[index].topic
+                    for index in undecided_indexes
+                    if self.cards[index].topic is not None
+                }
+            )
+            print(f"no undecided cards match that topic, their topics are: {topics}")
+            return
+        topics = sorted({self.cards[index].topic for index in indexes})
+        num_rejected = self.decide(indexes, "rejected")
+        print(f"rejected {num_rejected} cards about {', '.join(topics)}")
+
+    def edit_card(self, index: int) -> None:
+        try:
+            text = input("New card text (leave empty to keep it): ").strip()
+        except EOFError:
+            return
+        if text == "":
+            return
+        # edits go through the same fix-up and validation as the LLM's text
+        [card_text] = post_process_card_texts([text])
+        if card_text.problem is not None:
+            print(f"not changing the card: {card_text.describe_problem()}")
+            return
+        self.cards[index] = self.card_store.set_text(self.cards[index], card_text.text)
+
+    def change_topic(self, index: int, topic_prefix: str) -> None:
+        """Give a card the topic that starts with `topic_prefix`. The topic
+        classifier learns from the reviewer's topics along with the LLM's"""
+        topics = [
+            topic for topic in TOPICS if topic.lower().startswith(topic_prefix.lower())
+        ]
+        if len(topics) != 1 or topic_prefix == "":
+            print(f"that's not exactly one topic, the topics are: {TOPICS}")
+            return
+        self.cards[index] = self.card_store.set_topic(self.cards[index], topics[0])
+        metrics.increment("review_topic_changes_total")
+
+    def list_undecided_cards(self) -> None:
+        for index in self.get_undecided_indexes():
+            card = self.cards[index]
+            print(f"{index + 1:>4} [{card.topic or 'no topic'}] {card.text}")
+
+    def print_card(self, index: int) -> None:
+        card = self.cards[index]
+        topic = f" {card.topic}" if card.topic is not None else ""
+        print(f"\n[{index + 1}/{len(self.cards)}]{topic}")
+        print(card.text)
+
+    def get_undecided_indexes(self) -> List[int]:
+        return [index for index, status in enumerate(self.statuses) if status is None]
+
+    def get_next_undecided_index(self) -> Optional[int]:
+        """The first undecided card from the current position on. Skipped cards
+        aren't shown again, but they can still be decided with a range"""
+        for index in range(self.position, len(self.cards)):
+            if self.statuses[index] is None:
+                return index
+        return None
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+# default filepath of the SQLite database that remembers what we've already scanned
+SCAN_INDEX_FILEPATH = "out/scan_index.sqlite3"
+
+# the scan_state key of the high-water mark for scans of the whole workspace
+DEFAULT_HIGH_WATER_MARK_KEY = "high_water_mark"
+
+# Notion rounds `last_edited_time` down to the minute, so an edit made in the
+# same minute as our last scan doesn't change the timestamp. We treat anything
+# scanned less than this long after its timestamp as possibly out of date
+# (with some slack for the time between fetching and recording a block)
+LAST_EDITED_TIME_RESOLUTION_SECONDS = 90
+
+
+class ScanIndex:
+    """An on-disk index of the Notion pages we've already scanned
+
+    For every page we've searched we store its `last_edited_time` and whether
+    it contained an unprocessed SRS mention. On the next scan any page whose
+    timestamp hasn't moved and which had no mentions can be skipped without
+    calling the Notion API. Only pages are skipped: Notion bumps a page's
+    timestamp when anything on it is edited, but a block's only when the
+    block itself or its list of children changes, so an unchanged block can
+    still have edited descendants.
+
+    We also store a high-water mark, the newest page `last_edited_time` we've
+    seen, so that the next scan only needs to look at pages edited since then.
+    Scans that are narrowed down to a database or page keep their own
+    high-water mark under a different key.
+
+    Writes are only persisted once `commit` is called, which should happen
+    after the cards found during the scan have been saved. That way a scan
+    which crashes halfway will be redone from scratch next time, or straight
+    away if `rollback` is called. A long scan can persist the pages and blocks
+    it has searched so far with `checkpoint`, which leaves out the high-water
+    marks: committing those before the older pages were searched would make
+    the next scan skip them. Persisting a record early is always safe, since a
+    page with a mention is searched again anyway.
+    """
+
+    def __init__(self, filepath: str = SCAN_INDEX_FILEPATH):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the crawl that reads and writes the index runs on a background thread
+        # (see `iterate_in_background`), but only ever one thread at a time
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        # high-water marks set since the last commit, which only get written
+        # to scan_state on commit
+        self.pending_high_water_marks: Dict[str, datetime] = {}
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS blocks (
+                id TEXT PRIMARY KEY,
+                last_edited_time TEXT NOT NULL,
+                has_mention INTEGER NOT NULL,
+                scanned_at REAL
+            )
+            """)
+        # scan indexes created before scanned_at was added need the column.
+        # Their rows are left NULL, which counts as settled
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(blocks)")
+        ]
+        if "scanned_at" not in columns:
+            self.connection.execute("ALTER TABLE blocks ADD COLUMN scanned_at REAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS scan_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """)
+        self.connection.commit()
+
+    def needs_scan(self, block: Dict) -> bool:
+        """Whether a page has to be searched again
+
+        This is only a reliable signal for pages, whose timestamp changes on
+        any edit, see the class docstring. A page we scanned within
+        LAST_EDITED_TIME_RESOLUTION_SECONDS of its timestamp is searched
+        again, since it may have been edited again within the minute
+        """
+        row = self.connection.execute(
+            "SELECT last_edited_time, has_mention, scanned_at FROM blocks WHERE id = ?",
+            (block["id"],),
+        ).fetchone()
+        if row is None:
+            return True
+        last_edited_time, has_mention, scanned_at = row
+        if last_edited_time != block["last_edited_time"] or bool(has_mention):
+            return True
+        return (
+            scanned_at is not None
+            and scanned_at
+            < datetime.fromisoformat(last_edited_time).timestamp()
+            + LAST_EDITED_TIME_RESOLUTION_SECONDS
+        )
+
+    def is_edited(self, block: Dict) -> bool:
+        """Whether a page is new, or its timestamp has moved since we last
+        searched it. Unlike `needs_scan`, this is False for a page that's only
+        searched again because it still has an unprocessed mention"""
+        row = self.connection.execute(
+            "SELECT last_edited_time FROM blocks WHERE id = ?", (block["id"],)
+        ).fetchone()
+        return row is None or row[0] != block["last_edited_time"]
+
+    def record(self, block: Dict, has_mention: bool) -> None:
+        """Remember that we've searched this page at its current timestamp"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO blocks (id, last_edited_time, has_mention, scanned_at) VALUES (?, ?, ?, ?)",
+            (block["id"], block["last_edited_time"], int(has_mention), time.time()),
+        )
+
+    def get_high_water_mark(
+        self, key: str = DEFAULT_HIGH_WATER_MARK_KEY
+    ) -> Optional[datetime]:
+        """The newest page `last_edited_time` seen by a previous scan, if any, as
+        of the last commit"""
+        row = self.connection.execute(
+            "SELECT value FROM scan_state WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0])
+
+    def set_high_water_mark(
+        self, high_water_mark: datetime, key: str = DEFAULT_HIGH_WATER_MARK_KEY
+    ) -> None:
+        existing_high_water_mark = self.get_pending_high_water_mark(key)
+        if existing_high_water_mark and existing_high_water_mark >= high_water_mark:
+            return
+        self.pending_high_water_marks[key] = high_water_mark
+
+    def get_pending_high_water_mark(
+        self, key: str = DEFAULT_HIGH_WATER_MARK_KEY
+    ) -> Optional[datetime]:
+        """The high-water mark as it will be once the current scan is committed"""
+        return self.pending_high_water_marks.get(key) or self.get_high_water_mark(key)
+
+    def commit(self) -> None:
+        for key, high_water_mark in self.pending_high_water_marks.items():
+            self.connection.execute(
+                "INSERT OR REPLACE INTO scan_state (key, value) VALUES (?, ?)",
+                (key, high_water_mark.isoformat()),
+            )
+        self.pending_high_water_marks.clear()
+        self.connection.commit()
+
+    def checkpoint(self) -> None:
+        """Persist the pages and blocks recorded so far, but not the high-water
+        marks, which wait for `commit`"""
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        """Forget everything recorded since the last `commit` or `checkpoint`"""
+        self.pending_high_water_marks.clear()
+        self.connection.rollback()
+
+    def close(self) -> None:
+        self.connection.close()
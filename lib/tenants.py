@@ -0,0 +1,194 @@
+import io
+import json
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterator, List, Optional, TextIO, Tuple
+from .clients import current_tenant, get_env
+
+# The directory that each tenant's card store, scan index and other state
+# files are kept in, under a subdirectory named after the tenant
+TENANTS_DIRECTORY = "out/tenants"
+
+# Tenant names are used as directory names, so they're kept to these characters
+TENANT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# The keys a tenant can have in the tenants config file, see `load_tenants`
+TENANT_CONFIG_KEYS = [
+    "name",
+    "deck_name",
+    "notion_key_env",
+    "srs_mention_ids",
+    "databases",
+    "pages",
+    "exclude",
+    "directory",
+]
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """One of the people a multi-tenant run scans Notion for, with their own
+    Notion integration, Anki deck, scopes and state files
+
+    Anything that needs to know which tenant it's working for (the Notion
+    client, the Notion rate limiter, the deck cards are added to) reads it from
+    `clients.current_tenant`, which `use_tenant` sets
+    """
+
+    name: str
+    deck_name: str
+    # the environment variable (which may come from .env) that holds the key of
+    # the tenant's Notion integration, so that keys stay out of the config file
+    notion_key_env: str = "NOTION_KEY"
+    # see notion_api.get_srs_mention_ids
+    srs_mention_ids: FrozenSet[str] = frozenset()
+    # the ids of the databases and pages to scan, or the whole workspace if
+    # neither are given, and of the pages/databases/blocks to leave out
+    databases: Tuple[str, ...] = ()
+    pages: Tuple[str, ...] = ()
+    exclude: Tuple[str, ...] = ()
+    # where the tenant's state files are kept, TENANTS_DIRECTORY/<name> by default
+    directory: str = ""
+
+    def get_notion_key(self) -> str:
+        return get_env(self.notion_key_env)
+
+    @property
+    def card_store_filepath(self) -> str:
+        return os.path.join(self.directory, "cards.sqlite3")
+
+    @property
+    def scan_index_filepath(self) -> str:
+        return os.path.join(self.directory, "scan_index.sqlite3")
+
+    @property
+    def checkpoint_filepath(self) -> str:
+        return os.path.join(self.directory, "scan_checkpoint.json")
+
+    @property
+    def writeback_queue_filepath(self) -> str:
+        return os.path.join(self.directory, "writeback_queue.sqlite3")
+
+
+def load_tenants(filepath: str) -> List[Tenant]:
+    """Read the tenants from a JSON config file like:
+
+    ```json
+    {
+        "tenants": [
+            {"name": "ada", "deck_name": "Ada's Deck", "notion_key_env": "ADA_NOTION_KEY"},
+            {"name": "grace", "deck_name": "Master Deck", "databases": ["<database id>"]}
+        ]
+    }
+    ```
+
+    Raises a ValueError that says what's wrong if the config is invalid
+    """
+    with open(filepath) as f:
+        config = json.load(f)
+    tenant_configs = config.get("tenants") if isinstance(config, dict) else None
+    if not isinstance(tenant_configs, list) or len(tenant_configs) == 0:
+        raise ValueError(f"{filepath} must have a non-empty list of tenants")
+
+    tenants = [parse_tenant(tenant_config) for tenant_config in tenant_configs]
+    names = [tenant.name for tenant in tenants]
+    duplicate_names = sorted({name for name in names if names.count(name) > 1})
+    if duplicate_names:
+        raise ValueError(f"Tenant names must be unique, found {duplicate_names}")
+    return tenants
+
+
+def parse_tenant(tenant_config: Dict) -> Tenant:
+    """Validate a single tenant's entry in the tenants config file"""
+    if not isinstance(tenant_config, dict):
+        raise ValueError(f"Tenant {tenant_config!r} is not a JSON object")
+    unknown_keys = set(tenant_config) - set(TENANT_CONFIG_KEYS)
+    if unknown_keys:
+        raise ValueError(
+            f"Unknown keys {sorted(unknown_keys)} for a tenant. Must be some of {TENANT_CONFIG_KEYS}"
+        )
+    name = tenant_config.get("name")
+    if not isinstance(name, str) or not TENANT_NAME_PATTERN.match(name):
+        raise ValueError(
+            f"Tenant name {name!r} must be made up of letters, digits, - and _"
+        )
+    for key in ["deck_name", "notion_key_env", "directory"]:
+        if key in tenant_config and not isinstance(tenant_config[key], str):
+            raise ValueError(f"{key} of tenant {name} must be a string")
+    if "deck_name" not in tenant_config:
+        raise ValueError(f"Tenant {name} is missing a deck_name")
+    for key in ["srs_mention_ids", "databases", "pages", "exclude"]:
+        ids = tenant_config.get(key, [])
+        if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+            raise ValueError(f"{key} of tenant {name} must be a list of ids")
+
+    return Tenant(
+        name=name,
+        deck_name=tenant_config["deck_name"],
+        notion_key_env=tenant_config.get("notion_key_env", "NOTION_KEY"),
+        srs_mention_ids=frozenset(tenant_config.get("srs_mention_ids", [])),
+        databases=tuple(tenant_config.get("databases", [])),
+        pages=tuple(tenant_config.get("pages", [])),
+        exclude=tuple(tenant_config.get("exclude", [])),
+        directory=tenant_config.get("directory", os.path.join(TENANTS_DIRECTORY, name)),
+    )
+
+
+def get_tenant(tenants: List[Tenant], name: str) -> Tenant:
+    for tenant in tenants:
+        if tenant.name == name:
+            return tenant
+    raise ValueError(
+        f"Tenant {name} is not in the tenants config. Must be one of {[tenant.name for tenant in tenants]}"
+    )
+
+
+@contextmanager
+def use_tenant(tenant: Tenant) -> Iterator[Tenant]:
+    """Work for `tenant` on the current thread until the block exits"""
+    token = current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_tenant.reset(token)
+
+
+class TenantOutput(io.TextIOBase):
+    """Stands in for stdout while tenants are scanned at once, prefixing every
+    line printed on a tenant's behalf with the tenant's name
+
+    Text is held back until it makes a whole line, since `print` writes the
+    text and its newline separately and otherwise the tenants' lines run into
+    each other
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._lock = threading.Lock()
+        # the text written so far of each thread's unfinished line
+        self._partial_lines: Dict[Tuple[int, Optional[str]], str] = {}
+
+    def write(self, text: str) -> int:
+        tenant = current_tenant.get()
+        name = tenant.name if tenant is not None else None
+        key = (threading.get_ident(), name)
+        with self._lock:
+            *lines, partial_line = (self._partial_lines.pop(key, "") + text).split("\n")
+            if partial_line:
+                self._partial_lines[key] = partial_line
+            for line in lines:
+                self.stream.write(f"[{name}] {line}\n" if name else f"{line}\n")
+        return len(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+@contextmanager
+def prefix_output_with_tenant_names() -> Iterator[None]:
+    with redirect_stdout(TenantOutput(sys.stdout)):
+        yield
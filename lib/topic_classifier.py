@@ -0,0 +1,159 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# The ways a block's topic can be picked, see the --topic-classifier flag
+TOPIC_CLASSIFIERS = ["local", "llm"]
+DEFAULT_TOPIC_CLASSIFIER = "local"
+
+# With fewer labeled cards than this, the local classifier hasn't seen enough
+# of each topic to be trusted, so every topic is picked by the LLM until the
+# card store has grown
+MIN_TRAINING_EXAMPLES = 50
+
+# The local classifier's topic is used when its probability is at least this,
+# and the LLM picks the topic otherwise
+DEFAULT_MIN_TOPIC_CONFIDENCE = 0.6
+
+# Additive smoothing of the words' weights per topic, so that a word that was
+# never seen with a topic doesn't rule that topic out
+SMOOTHING = 0.1
+
+# Lowercase words and numbers, which is all a topic is told apart by
+WORD_PATTERN = re.compile(r"[a-z0-9]{2,}")
+
+# Words that show up in every topic, so they only add noise to the scores
+STOP_WORDS = frozenset("""
+    about after all also an and any are as at be been but by can could did do
+    does for from had has have he her his how if in into is it its may more most
+    not of on one or other our out she so some such than that the their them
+    then there these they this those to up was we were what when where which
+    while who why will with would you your
+    """.split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS
+    ]
+
+
+def make_tf_idf_vector(counts: Counter, idf: Dict[str, float]) -> Dict[str, float]:
+    """Weigh each word of a text by how rare it is, scaled so that the vector
+    has unit length. Without the scaling every word of a long text would count
+    as separate evidence, and the model would be sure of itself far too often
+    """
+    weights = {
+        word: (1 + math.log(count)) * idf[word] for word, count in counts.items()
+    }
+    norm = math.sqrt(sum(weight**2 for weight in weights.values()))
+    if norm == 0:
+        return {}
+    return {word: weight / norm for word, weight in weights.items()}
+
+
+class TopicClassifier:
+    """Picks a block's topic in-process rather than with an LLM request
+
+    It's a multinomial naive Bayes model over TF-IDF weighted words, trained
+    on the topics that the LLM or the reviewer gave the cards already in the
+    card store, and never on its own (see card_store.TOPIC_SOURCES). Scoring
+    a text is a sum over its words of each word's per-topic weights, so it's
+    linear in the text's length and takes microseconds. `classify` only
+    returns the topics it's at least `min_confidence` sure of, leaving the
+    rest to the LLM.
+    """
+
+    def __init__(
+        self,
+        topics: List[str],
+        log_priors: List[float],
+        word_log_probs: Dict[str, List[float]],
+        idf: Dict[str, float],
+        min_confidence: float = DEFAULT_MIN_TOPIC_CONFIDENCE,
+    ):
+        self.topics = topics
+        self.log_priors = log_priors
+        # each known word's log probability under each topic, in `topics` order
+        self.word_log_probs = word_log_probs
+        self.idf = idf
+        self.min_confidence = min_confidence
+
+    @classmethod
+    def train(
+        cls,
+        texts: Sequence[str],
+        topics: Sequence[str],
+        min_confidence: float = DEFAULT_MIN_TOPIC_CONFIDENCE,
+    ) -> "TopicClassifier":
+        """Fit the model to `texts`, where `topics[i]` is the topic of `texts[i]`"""
+        if len(texts) != len(topics):
+            raise ValueError(f"Got {len(texts)} texts but {len(topics)} topics")
+        labels = sorted(set(topics))
+        label_indices = {label: i for i, label in enumerate(labels)}
+
+        word_counts = [Counter(tokenize(text)) for text in texts]
+        document_frequencies = Counter(
+            word for counts in word_counts for word in counts
+        )
+        idf = {
+            word: math.log((1 + len(texts)) / (1 + frequency)) + 1
+            for word, frequency in document_frequencies.items()
+        }
+
+        weights = {word: [0.0] * len(labels) for word in idf}
+        for counts, topic in zip(word_counts, topics):
+            label_index = label_indices[topic]
+            for word, weight in make_tf_idf_vector(counts, idf).items():
+                weights[word][label_index] += weight
+        total_weights = [
+            sum(word_weights[i] for word_weights in weights.values())
+            + SMOOTHING * len(weights)
+            for i in range(len(labels))
+        ]
+        word_log_probs = {
+            word: [
+                math.log((weight + SMOOTHING) / total_weights[i])
+                for i, weight in enumerate(word_weights)
+            ]
+            for word, word_weights in weights.items()
+        }
+
+        topic_counts = Counter(topics)
+        log_priors = [math.log(topic_counts[label] / len(topics)) for label in labels]
+        return cls(labels, log_priors, word_log_probs, idf, min_confidence)
+
+    def predict(self, texts: Sequence[str]) -> List[Tuple[str, float]]:
+        """The most likely topic of each text and its probability"""
+        predictions = []
+        for text in texts:
+            scores = list(self.log_priors)
+            counts = Counter(
+                word for word in tokenize(text) if word in self.word_log_probs
+            )
+            for word, weight in make_tf_idf_vector(counts, self.idf).items():
+                log_probs = self.word_log_probs[word]
+                scores = [
+                    score + weight * log_prob
+                    for score, log_prob in zip(scores, log_probs)
+                ]
+            # softmax, shifted by the max score so that exp can't overflow
+            max_score = max(scores)
+            probabilities = [math.exp(score - max_score) for score in scores]
+            best_index = max(range(len(scores)), key=scores.__getitem__)
+            predictions.append(
+                (
+                    self.topics[best_index],
+                    probabilities[best_index] / sum(probabilities),
+                )
+            )
+        return predictions
+
+    def classify(self, texts: Sequence[str]) -> List[Optional[str]]:
+        """The topic of each text, or None for the texts the model isn't
+        `min_confidence` sure of"""
+        return [
+            topic if probability >= self.min_confidence else None
+            for topic, probability in self.predict(texts)
+        ]
@@ -0,0 +1,115 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+from .notion_api import DEFAULT_CONCURRENCY, mark_srs_block_as_processed
+from .metrics import metrics
+from .pipeline import submit_in_context
+
+# default filepath of the SQLite database that holds the pending Notion write-backs
+WRITEBACK_QUEUE_FILEPATH = "out/writeback_queue.sqlite3"
+
+# How many times we try to mark a block as processed before leaving it in the
+# queue for the next run
+WRITEBACK_MAX_ATTEMPTS = 4
+
+
+class WritebackQueue:
+    """A durable queue of Notion blocks waiting to be marked as processed
+
+    Blocks are written to SQLite as soon as they're enqueued, and a pool of
+    background threads strikes them through in Notion (throttled by the
+    Notion rate limiter) and removes them from the queue once that succeeds.
+    This way the `generate_cards` review never waits on Notion, and if the
+    process dies mid-session the blocks still in the queue are flushed the
+    next time the queue is started.
+
+    Striking through a block is idempotent, so a block that was updated in
+    Notion right before a crash (but not yet removed from the queue) being
+    updated a second time is harmless.
+    """
+
+    def __init__(
+        self,
+        filepath: str = WRITEBACK_QUEUE_FILEPATH,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pending_writebacks (
+                block_id TEXT PRIMARY KEY,
+                block TEXT NOT NULL,
+                enqueued_at REAL NOT NULL
+            )
+            """)
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.futures: List[Future] = []
+
+    def start(self) -> None:
+        """Start flushing any blocks left in the queue by a previous run"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT block FROM pending_writebacks ORDER BY enqueued_at"
+            ).fetchall()
+        if len(rows) > 0:
+            print(f"Resuming {len(rows)} pending Notion updates from a previous run")
+        for (block_json,) in rows:
+            self._submit(json.loads(block_json))
+
+    def enqueue(self, block: Dict) -> None:
+        """Durably record that a block should be marked as processed, and have
+        it updated in Notion in the background"""
+        with self._lock:
+            # keyed on the block id, so enqueueing a block twice only updates it once
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pending_writebacks (block_id, block, enqueued_at) VALUES (?, ?, ?)",
+                (block["id"], json.dumps(block), time.time()),
+            )
+            self.connection.commit()
+        self._submit(block)
+
+    def drain(self) -> int:
+        """Wait for all of the enqueued blocks to be processed, returning the
+        number of blocks that are still in the queue because they failed"""
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        with self._lock:
+            (num_pending,) = self.connection.execute(
+                "SELECT COUNT(*) FROM pending_writebacks"
+            ).fetchone()
+        return num_pending
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.connection.close()
+
+    def _submit(self, block: Dict) -> None:
+        self.futures.append(submit_in_context(self.executor, self._write_back, block))
+
+    def _write_back(self, block: Dict) -> None:
+        for attempt in range(WRITEBACK_MAX_ATTEMPTS):
+            try:
+                mark_srs_block_as_processed(block)
+                break
+            except Exception as e:
+                metrics.increment("writeback_errors_total")
+                if attempt == WRITEBACK_MAX_ATTEMPTS - 1:
+                    print(f"Failed to update block with ID {block['id']}: {e}")
+                    return
+                time.sleep(random.uniform(0, 2**attempt))
+
+        with self._lock:
+            self.connection.execute(
+                "DELETE FROM pending_writebacks WHERE block_id = ?", (block["id"],)
+            )
+            self.connection.commit()
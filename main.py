@@ -1,35 +1,489 @@
 import argparse
-import pickle
+import json
 import os
-from typing import List
-from lib.intelligence import create_anki_cards_from_srs_blocks
-from lib.notion_api import find_srs_blocks, mark_srs_block_as_processed
-from lib.anki_utils import AnkiCard, add_anki_card_to_deck
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from lib.intelligence import (
+    DEFAULT_GENERATION_MODE,
+    DEFAULT_LLM_CONCURRENCY,
+    DEFAULT_MAX_BATCH_TOKENS,
+    GENERATION_MODES,
+    MODEL_VERSION,
+    TOPICS,
+    get_srs_item_text,
+    get_token_budget,
+    iterate_anki_cards_from_srs_blocks,
+    use_llm_cache,
+    use_max_block_tokens,
+    use_model_routing,
+    use_token_budget,
+    use_topic_classifier,
+)
+from lib.block_tree_cache import BLOCK_TREE_CACHE_FILEPATH, BlockTreeCache
+from lib.llm_cache import LLM_CACHE_FILEPATH, LLMCache
+from lib.metrics import metrics
+from lib.notion_api import (
+    DEFAULT_CONCURRENCY,
+    WORKSPACE_SCOPE,
+    ScanScope,
+    get_high_water_mark_key,
+    iterate_srs_blocks,
+    get_tenant_labels,
+    use_block_tree_cache,
+)
+from lib.anki_utils import DEFAULT_ANKI_CHUNK_SIZE, AnkiCard
+from lib.card_store import CARD_STORE_FILEPATH, CardStore, MergeResult
+from lib.checkpoint import SCAN_CHECKPOINT_FILEPATH, ScanCheckpoint
+from lib.pipeline import iterate_in_background
+from lib.prompts import (
+    DEFAULT_CHEAP_MODEL_MAX_TOKENS,
+    DEFAULT_MAX_BLOCK_TOKENS,
+    ModelRouting,
+    TokenBudget,
+    TokenBudgetExceededError,
+)
+from lib.review import AnkiSyncer, ReviewSession
+from lib.scan_index import SCAN_INDEX_FILEPATH, ScanIndex
+from lib.topic_classifier import (
+    DEFAULT_MIN_TOPIC_CONFIDENCE,
+    DEFAULT_TOPIC_CLASSIFIER,
+    MIN_TRAINING_EXAMPLES,
+    TOPIC_CLASSIFIERS,
+    TopicClassifier,
+)
+from lib.tenants import (
+    TENANTS_DIRECTORY,
+    Tenant,
+    get_tenant,
+    load_tenants,
+    prefix_output_with_tenant_names,
+    use_tenant,
+)
+from lib.writeback_queue import WRITEBACK_QUEUE_FILEPATH, WritebackQueue
 
-# default filepath at which we store the inference card text
-CARD_FILEPATH = "out/cards.pkl"
+# default filepath of the *.pkl card file written by older versions of scan_notion
+PICKLE_FILEPATH = "out/cards.pkl"
+
+# The `watch` command polls Notion this often while pages are being edited,
+# and backs off by POLL_BACKOFF_FACTOR after every quiet poll until it's
+# polling every DEFAULT_MAX_POLL_INTERVAL_SECONDS
+DEFAULT_MIN_POLL_INTERVAL_SECONDS = 5
+DEFAULT_MAX_POLL_INTERVAL_SECONDS = 300
+POLL_BACKOFF_FACTOR = 2
 
 
 # This is the entrypoint to your program
 def main():
     """run either the script to grab text from notion, use an LLM to create card text,
-    and then save it to a file for later acceptance by the user, or run the CLI acceptance
-    tool to take text, generate an Anki Card, and add it to the Deck"""
+    and then save it to the card store for later acceptance by the user, or run the CLI
+    acceptance tool to take text, generate an Anki Card, and add it to the Deck"""
     parser = setup_cli_parsers()
     args = parser.parse_args()
 
-    if not args.pickle_filepath.endswith(".pkl"):
-        raise ValueError("--pickle-filepath must end with .pkl, e.g. 'out/cards.pkl'")
+    if args.command in ("scan_notion", "watch") and args.tenants_config:
+        if args.database or args.page or args.exclude:
+            parser.error(
+                "--database, --page and --exclude can't be used with --tenants-config, "
+                "set each tenant's databases, pages and exclude in the config instead"
+            )
+        tenants = load_tenants(args.tenants_config)
 
-    if args.command == "scan_notion":
-        find_srs_blocks_and_create_anki_cards(args.pickle_filepath)
+    if args.command == "scan_notion" and args.tenants_config:
+        setup_llm_cache(args)
+        setup_block_tree_cache(args)
+        setup_prompt_building(args)
+        setup_tenant_topic_classifiers(args, tenants)
+        try:
+            with metrics.time("command_seconds", command=args.command):
+                scan_tenants(
+                    tenants,
+                    args.concurrency,
+                    args.full_scan,
+                    args.llm_concurrency,
+                    args.generation_mode,
+                    args.max_batch_tokens,
+                    args.resume,
+                )
+        finally:
+            report_metrics(args.metrics_filepath)
+    elif args.command == "scan_notion":
+        setup_llm_cache(args)
+        setup_block_tree_cache(args)
+        setup_prompt_building(args)
+        import_leftover_pickle_file(args.card_store_filepath)
+        setup_topic_classifier(args, args.card_store_filepath)
+        try:
+            with metrics.time("command_seconds", command=args.command):
+                find_srs_blocks_and_create_anki_cards(
+                    args.card_store_filepath,
+                    args.concurrency,
+                    args.scan_index_filepath,
+                    args.full_scan,
+                    args.llm_concurrency,
+                    args.generation_mode,
+                    args.max_batch_tokens,
+                    get_scan_scopes(args),
+                    args.exclude,
+                    args.resume,
+                    args.checkpoint_filepath,
+                )
+        except TokenBudgetExceededError as e:
+            print(f"\n{e}, the rest of the blocks will be picked up by the next scan")
+        finally:
+            report_metrics(args.metrics_filepath)
+    elif args.command == "watch" and args.tenants_config:
+        setup_llm_cache(args)
+        setup_block_tree_cache(args)
+        setup_prompt_building(args)
+        setup_tenant_topic_classifiers(args, tenants)
+        try:
+            watch_tenants(
+                tenants,
+                args.concurrency,
+                args.llm_concurrency,
+                args.generation_mode,
+                args.max_batch_tokens,
+                args.min_poll_interval,
+                args.max_poll_interval,
+            )
+        finally:
+            report_metrics(args.metrics_filepath)
+    elif args.command == "watch":
+        setup_llm_cache(args)
+        setup_block_tree_cache(args)
+        setup_prompt_building(args)
+        setup_topic_classifier(args, args.card_store_filepath)
+        try:
+            watch_notion(
+                args.card_store_filepath,
+                args.concurrency,
+                args.scan_index_filepath,
+                args.llm_concurrency,
+                args.generation_mode,
+                args.max_batch_tokens,
+                get_scan_scopes(args),
+                args.exclude,
+                args.min_poll_interval,
+                args.max_poll_interval,
+            )
+        finally:
+            report_metrics(args.metrics_filepath)
+    elif args.command == "generate_cards" and args.tenants_config:
+        if args.tenant is None:
+            parser.error("--tenant is required with --tenants-config")
+        tenant = get_tenant(load_tenants(args.tenants_config), args.tenant)
+        try:
+            # the tenant's cards are added to their deck, and their blocks
+            # marked as processed with their Notion integration
+            with (
+                use_tenant(tenant),
+                metrics.time("command_seconds", command=args.command),
+            ):
+                generate_anki_card_and_mark_as_processed(
+                    tenant.card_store_filepath,
+                    args.anki_chunk_size,
+                    tenant.writeback_queue_filepath,
+                    args.concurrency,
+                )
+        finally:
+            report_metrics(args.metrics_filepath)
     elif args.command == "generate_cards":
-        generate_anki_card_and_mark_as_processed(args.pickle_filepath)
+        import_leftover_pickle_file(args.card_store_filepath)
+        try:
+            with metrics.time("command_seconds", command=args.command):
+                generate_anki_card_and_mark_as_processed(
+                    args.card_store_filepath,
+                    args.anki_chunk_size,
+                    args.writeback_queue_filepath,
+                    args.concurrency,
+                )
+        finally:
+            report_metrics(args.metrics_filepath)
+    elif args.command == "import_pickle":
+        if not args.pickle_filepath.endswith(".pkl"):
+            raise ValueError(
+                "--pickle-filepath must end with .pkl, e.g. 'out/cards.pkl'"
+            )
+        import_pickle_file(args.pickle_filepath, args.card_store_filepath)
     else:
         parser.print_help()
     return
 
 
+def setup_llm_cache(args: argparse.Namespace):
+    """Set up the LLM response cache according to the scan_notion CLI flags"""
+    if args.no_llm_cache:
+        use_llm_cache(None)
+        return
+
+    cache = LLMCache(args.llm_cache_filepath)
+    if args.purge_llm_cache:
+        print(f"purging LLM cache at {args.llm_cache_filepath}")
+        cache.purge()
+    use_llm_cache(cache)
+
+
+def setup_block_tree_cache(args: argparse.Namespace):
+    """Set up the cache of pages' block trees according to the scan_notion CLI flags"""
+    if args.no_block_cache:
+        use_block_tree_cache(None)
+        return
+    use_block_tree_cache(BlockTreeCache(args.block_cache_filepath))
+
+
+def setup_prompt_building(args: argparse.Namespace):
+    """Set up block trimming, model routing and the token budget according to
+    the scan_notion CLI flags"""
+    use_max_block_tokens(args.max_block_tokens or None)
+    use_model_routing(
+        ModelRouting(
+            args.model, args.cheap_model or args.model, args.cheap_model_max_tokens
+        )
+    )
+    use_token_budget(TokenBudget(args.token_budget) if args.token_budget else None)
+
+
+def setup_tenant_topic_classifiers(args: argparse.Namespace, tenants: List[Tenant]):
+    """Train a local topic classifier for each tenant on their own cards only,
+    so that one tenant's cards never influence another's topics"""
+    with prefix_output_with_tenant_names():
+        for tenant in tenants:
+            with use_tenant(tenant):
+                setup_topic_classifier(args, tenant.card_store_filepath)
+
+
+def setup_topic_classifier(args: argparse.Namespace, card_store_filepath: str):
+    """Train the current tenant's local topic classifier on the topics the LLM
+    or the reviewer gave the cards in their card store, according to the
+    scan_notion CLI flags"""
+    if args.topic_classifier == "llm":
+        use_topic_classifier(None)
+        return
+
+    texts, topics = [], []
+    card_store = CardStore(card_store_filepath)
+    try:
+        for notion_block, topic in card_store.get_topic_examples():
+            if topic in TOPICS:
+                texts.append(get_srs_item_text(notion_block))
+                topics.append(topic)
+    finally:
+        card_store.close()
+    if len(texts) < MIN_TRAINING_EXAMPLES:
+        print(
+            f"Only {len(texts)} cards have a topic picked by the LLM or a reviewer, "
+            f"the LLM will pick topics until there are {MIN_TRAINING_EXAMPLES}"
+        )
+        use_topic_classifier(None)
+        return
+    if len(set(topics)) < 2:
+        # the classifier would give every block that one topic
+        print("All of the cards have the same topic, the LLM will pick topics")
+        use_topic_classifier(None)
+        return
+
+    with metrics.time("topic_classifier_training_seconds"):
+        classifier = TopicClassifier.train(texts, topics, args.min_topic_confidence)
+    print(f"Trained the topic classifier on {len(texts)} cards")
+    use_topic_classifier(classifier)
+
+
+def report_metrics(metrics_filepath: Optional[str]):
+    """Print a summary of the run's metrics, and write them to
+    `metrics_filepath` if it's set"""
+    print("\nRun summary:")
+    print(metrics.format_summary())
+    report_token_usage()
+    if metrics_filepath:
+        metrics.write(metrics_filepath)
+        print(f"\nwrote metrics to {metrics_filepath}")
+
+
+def report_token_usage():
+    """Print how many LLM tokens the run spent, how much of its token budget
+    that used up, and how many it saved by trimming long blocks and by
+    reading responses from the LLM cache"""
+    num_spent_tokens = metrics.get_counter(
+        "llm_prompt_tokens_total"
+    ) + metrics.get_counter("llm_completion_tokens_total")
+    num_compacted_tokens = metrics.get_counter(
+        "llm_prompt_tokens_saved_total", reason="compacted"
+    )
+    num_cached_tokens = metrics.get_counter(
+        "llm_prompt_tokens_saved_total", reason="cache_hit"
+    )
+    if num_spent_tokens == 0 and num_compacted_tokens + num_cached_tokens == 0:
+        return
+    budget = ""
+    token_budget = get_token_budget()
+    if token_budget is not None:
+        # the budget also keeps the estimated charge of requests that failed,
+        # so it can be more than the tokens the LLM billed
+        num_charged_tokens, max_tokens = token_budget.get_usage()
+        budget = f" ({num_charged_tokens} of the {max_tokens} token budget)"
+    print(
+        f"\nSpent {num_spent_tokens:.0f} LLM tokens{budget}, and saved about "
+        f"{num_compacted_tokens + num_cached_tokens:.0f} prompt tokens: "
+        f"{num_compacted_tokens:.0f} by trimming long blocks and "
+        f"{num_cached_tokens:.0f} with the LLM cache"
+    )
+
+
+def get_scan_scopes(args: argparse.Namespace) -> List[ScanScope]:
+    """Build the list of scopes to scan from the scan_notion CLI flags"""
+    return make_scan_scopes(args.database, args.page)
+
+
+def make_scan_scopes(
+    database_ids: Iterable[str], page_ids: Iterable[str]
+) -> List[ScanScope]:
+    scopes = [ScanScope("database", database_id) for database_id in database_ids]
+    scopes.extend(ScanScope("page", page_id) for page_id in page_ids)
+    return scopes or [WORKSPACE_SCOPE]
+
+
+def add_scan_arguments(parser: argparse.ArgumentParser):
+    """Add the CLI flags shared by the scan_notion and watch commands"""
+    parser.add_argument(
+        "--card-store-filepath",
+        type=str,
+        default=CARD_STORE_FILEPATH,
+        help=f"The filepath of the SQLite card store that the Anki text will be saved to for later use in `generate_cards`. Defaults to ./{CARD_STORE_FILEPATH}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"The max number of Notion API requests to make in parallel while crawling pages. Use 1 for a serial crawl. Defaults to {DEFAULT_CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--scan-index-filepath",
+        type=str,
+        default=SCAN_INDEX_FILEPATH,
+        help=f"The filepath of the SQLite index that remembers which pages and blocks have already been scanned. Defaults to ./{SCAN_INDEX_FILEPATH}",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        action="append",
+        default=[],
+        help="The id of a Notion database whose pages should be scanned. Can be given multiple times. If neither --database nor --page is given, the whole workspace is scanned",
+    )
+    parser.add_argument(
+        "--page",
+        type=str,
+        action="append",
+        default=[],
+        help="The id of a Notion page that should be scanned. Can be given multiple times. If neither --database nor --page is given, the whole workspace is scanned",
+    )
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        action="append",
+        default=[],
+        help="The id of a Notion page, database or block whose pages should not be scanned, including any pages nested beneath it. Can be given multiple times",
+    )
+    parser.add_argument(
+        "--llm-concurrency",
+        type=int,
+        default=DEFAULT_LLM_CONCURRENCY,
+        help=f"The max number of LLM requests to make in parallel while generating card text. Defaults to {DEFAULT_LLM_CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--llm-cache-filepath",
+        type=str,
+        default=LLM_CACHE_FILEPATH,
+        help=f"The filepath of the SQLite cache of LLM responses. Defaults to ./{LLM_CACHE_FILEPATH}",
+    )
+    parser.add_argument(
+        "--no-llm-cache",
+        action="store_true",
+        help="Always call the LLM, without reading from or writing to the LLM response cache",
+    )
+    parser.add_argument(
+        "--block-cache-filepath",
+        type=str,
+        default=BLOCK_TREE_CACHE_FILEPATH,
+        help=f"The filepath of the SQLite cache of the block trees of pages, which are read from the cache instead of Notion while the page hasn't been edited. Defaults to ./{BLOCK_TREE_CACHE_FILEPATH}",
+    )
+    parser.add_argument(
+        "--no-block-cache",
+        action="store_true",
+        help="Always fetch pages' block trees from Notion, without reading from or writing to the block tree cache",
+    )
+    parser.add_argument(
+        "--generation-mode",
+        type=str,
+        choices=GENERATION_MODES,
+        default=DEFAULT_GENERATION_MODE,
+        help=f"Whether to generate each card's topic and text with two LLM requests, a single JSON-mode request that falls back to two requests if its response is invalid, or a JSON-mode request per batch of blocks. Defaults to {DEFAULT_GENERATION_MODE}",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=DEFAULT_MAX_BATCH_TOKENS,
+        help=f"In batch generation mode, the max number of estimated tokens of block text to put in a single LLM request. Defaults to {DEFAULT_MAX_BATCH_TOKENS}",
+    )
+    parser.add_argument(
+        "--topic-classifier",
+        type=str,
+        choices=TOPIC_CLASSIFIERS,
+        default=DEFAULT_TOPIC_CLASSIFIER,
+        help=f"How the topic of each block is picked in the two_call generation mode. 'local' uses a classifier trained on the topics of the cards already in the card store, and only asks the LLM about the blocks it isn't sure of (or about every block, until there are {MIN_TRAINING_EXAMPLES} cards to learn from). 'llm' always asks the LLM. Defaults to {DEFAULT_TOPIC_CLASSIFIER}",
+    )
+    parser.add_argument(
+        "--min-topic-confidence",
+        type=float,
+        default=DEFAULT_MIN_TOPIC_CONFIDENCE,
+        help=f"The local topic classifier's topic is used when it's at least this sure of it (between 0 and 1), and the LLM picks the topic otherwise. Defaults to {DEFAULT_MIN_TOPIC_CONFIDENCE}",
+    )
+    parser.add_argument(
+        "--max-block-tokens",
+        type=int,
+        default=DEFAULT_MAX_BLOCK_TOKENS,
+        help=f"Trim the text of blocks longer than this many estimated tokens at a sentence end before putting it in a prompt. Use 0 to never trim. Defaults to {DEFAULT_MAX_BLOCK_TOKENS}",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=MODEL_VERSION,
+        help=f"The LLM that generates card text. Defaults to {MODEL_VERSION}",
+    )
+    parser.add_argument(
+        "--cheap-model",
+        type=str,
+        default=None,
+        help="A cheaper LLM that topics are selected with, and that generates the card text of short blocks (see --cheap-model-max-tokens). Defaults to --model",
+    )
+    parser.add_argument(
+        "--cheap-model-max-tokens",
+        type=int,
+        default=DEFAULT_CHEAP_MODEL_MAX_TOKENS,
+        help=f"Card text requests whose user prompt has up to this many estimated tokens go to --cheap-model. Defaults to {DEFAULT_CHEAP_MODEL_MAX_TOKENS}",
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=None,
+        help="The max number of LLM tokens (prompt and completion) the run can spend. Once it's spent no more card text is generated, and the blocks left over are picked up by the next scan. By default there's no limit",
+    )
+    parser.add_argument(
+        "--metrics-filepath",
+        type=str,
+        default=None,
+        help="A file to write the run's timings, request counts, retries, cache hits and token usage to, as JSON if it ends with .json and in the Prometheus text format otherwise. A summary is always printed at the end of the run",
+    )
+    parser.add_argument(
+        "--tenants-config",
+        type=str,
+        default=None,
+        help=f"A JSON file of tenants whose Notion workspaces should all be scanned at once, each with their own Notion key, deck, scopes, card store and scan index (kept in ./{TENANTS_DIRECTORY}/<name> by default), see lib/tenants.py. The tenants share the LLM cache, block tree cache and --llm-concurrency LLM workers, and --concurrency is per tenant",
+    )
+
+
 def setup_cli_parsers():
     parser = argparse.ArgumentParser(
         description="Convert Notion SRS blocks to Anki cards"
@@ -39,102 +493,636 @@ def setup_cli_parsers():
     scan_notion_parser = subparsers.add_parser(
         "scan_notion", help="Scan Notion for new SRS blocks and add them to Anki"
     )
+    add_scan_arguments(scan_notion_parser)
     scan_notion_parser.add_argument(
-        "--pickle-filepath",
+        "--full-scan",
+        action="store_true",
+        help="Look at every page in the workspace instead of only pages edited since the last scan, including pages that haven't changed since they were last scanned",
+    )
+    scan_notion_parser.add_argument(
+        "--purge-llm-cache",
+        action="store_true",
+        help="Delete every cached LLM response before scanning",
+    )
+    scan_notion_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a scan that was interrupted from its last checkpoint, without searching the pages it had already finished. The scopes and flags must be the same as the interrupted scan's",
+    )
+    scan_notion_parser.add_argument(
+        "--checkpoint-filepath",
         type=str,
-        default=CARD_FILEPATH,
-        help=f"The filepath of the *.pkl that stores the Anki text that will later be used in `generate_cards`. Defaults to ./{CARD_FILEPATH}",
+        default=SCAN_CHECKPOINT_FILEPATH,
+        help=f"The filepath of the JSON checkpoint that the scan's progress is saved to as it goes, and that --resume resumes from. Defaults to ./{SCAN_CHECKPOINT_FILEPATH}",
     )
 
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Keep polling Notion for newly edited pages, and add cards for any new SRS blocks to the card store as soon as they're found",
+    )
+    add_scan_arguments(watch_parser)
+    watch_parser.add_argument(
+        "--min-poll-interval",
+        type=float,
+        default=DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+        help=f"The number of seconds to wait between polls while pages are being edited. Defaults to {DEFAULT_MIN_POLL_INTERVAL_SECONDS}",
+    )
+    watch_parser.add_argument(
+        "--max-poll-interval",
+        type=float,
+        default=DEFAULT_MAX_POLL_INTERVAL_SECONDS,
+        help=f"The max number of seconds to wait between polls, which we back off to while nothing is being edited. Defaults to {DEFAULT_MAX_POLL_INTERVAL_SECONDS}",
+    )
+    watch_parser.set_defaults(purge_llm_cache=False)
+
     generate_cards_parser = subparsers.add_parser(
         "generate_cards",
-        help="Add cards to your Anki deck using the text from the pickle file generated by `scan_notion`",
+        help="Add cards to your Anki deck using the text from the card store generated by `scan_notion`",
+    )
+    generate_cards_parser.add_argument(
+        "--card-store-filepath",
+        type=str,
+        default=CARD_STORE_FILEPATH,
+        help=f"The filepath of the SQLite card store we'll read Anki text from, generated by the scan_notion command. Defaults to ./{CARD_STORE_FILEPATH}",
     )
     generate_cards_parser.add_argument(
+        "--anki-chunk-size",
+        type=int,
+        default=DEFAULT_ANKI_CHUNK_SIZE,
+        help=f"The max number of accepted cards to add to Anki in a single Anki Connect request. Defaults to {DEFAULT_ANKI_CHUNK_SIZE}",
+    )
+    generate_cards_parser.add_argument(
+        "--writeback-queue-filepath",
+        type=str,
+        default=WRITEBACK_QUEUE_FILEPATH,
+        help=f"The filepath of the SQLite queue of Notion blocks waiting to be marked as processed. Defaults to ./{WRITEBACK_QUEUE_FILEPATH}",
+    )
+    generate_cards_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"The max number of Notion API requests to make in parallel while marking blocks as processed. Defaults to {DEFAULT_CONCURRENCY}",
+    )
+    generate_cards_parser.add_argument(
+        "--metrics-filepath",
+        type=str,
+        default=None,
+        help="A file to write the run's timings and request counts to, as JSON if it ends with .json and in the Prometheus text format otherwise. A summary is always printed at the end of the run",
+    )
+    generate_cards_parser.add_argument(
+        "--tenants-config",
+        type=str,
+        default=None,
+        help="The JSON file of tenants passed to scan_notion --tenants-config. Use it with --tenant to review a tenant's cards and add them to the tenant's deck",
+    )
+    generate_cards_parser.add_argument(
+        "--tenant",
+        type=str,
+        default=None,
+        help="The name of the tenant in --tenants-config whose cards should be reviewed. Their card store and writeback queue are used instead of --card-store-filepath and --writeback-queue-filepath",
+    )
+
+    import_pickle_parser = subparsers.add_parser(
+        "import_pickle",
+        help="Import the cards from a *.pkl file written by an older version of `scan_notion` into the card store",
+    )
+    import_pickle_parser.add_argument(
         "--pickle-filepath",
         type=str,
-        default=CARD_FILEPATH,
-        help=f"The filepath of the *.pkl file we'll read Anki text from, generated by the scan_notion command. Defaults to ./{CARD_FILEPATH}",
+        default=PICKLE_FILEPATH,
+        help=f"The filepath of the *.pkl file to import. Defaults to ./{PICKLE_FILEPATH}",
+    )
+    import_pickle_parser.add_argument(
+        "--card-store-filepath",
+        type=str,
+        default=CARD_STORE_FILEPATH,
+        help=f"The filepath of the SQLite card store to import the cards into. Defaults to ./{CARD_STORE_FILEPATH}",
     )
 
     return parser
 
 
-def find_srs_blocks_and_create_anki_cards(pickle_filepath: str):
-    srs_blocks = find_srs_blocks()
-    anki_cards = create_anki_cards_from_srs_blocks(srs_blocks)
+def find_srs_blocks_and_create_anki_cards(
+    card_store_filepath: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    scan_index_filepath: str = SCAN_INDEX_FILEPATH,
+    full_scan: bool = False,
+    llm_concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Iterable[str] = (),
+    resume: bool = False,
+    checkpoint_filepath: str = SCAN_CHECKPOINT_FILEPATH,
+    llm_executor: Optional[Executor] = None,
+) -> Tuple[int, int]:
+    checkpoint = get_scan_checkpoint(
+        checkpoint_filepath, resume, full_scan, scopes, excluded_ids
+    )
+    scan_index = ScanIndex(scan_index_filepath)
+    card_store = CardStore(card_store_filepath)
+    try:
+        num_cards, num_new_cards = scan_and_write_anki_cards(
+            scan_index,
+            card_store,
+            concurrency,
+            full_scan,
+            llm_concurrency,
+            generation_mode,
+            max_batch_tokens,
+            scopes,
+            excluded_ids,
+            checkpoint,
+            llm_executor,
+        )
+    except BaseException:
+        if os.path.exists(checkpoint_filepath):
+            print(
+                "\nThe scan was interrupted, run scan_notion again with the same "
+                "flags and --resume to continue it from its last checkpoint"
+            )
+        raise
+    finally:
+        scan_index.close()
+        card_store.close()
+    checkpoint.delete()
+
+    if num_cards == 0:
+        print("No new card text found from Notion, shutting down...")
+    elif num_new_cards == 0:
+        print("No new cards found, shutting down...")
+    return num_cards, num_new_cards
+
 
-    assert len(anki_cards) == len(srs_blocks)
-    write_anki_cards_to_pickle_file(anki_cards, pickle_filepath)
+def scan_and_write_anki_cards(
+    scan_index: ScanIndex,
+    card_store: CardStore,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    full_scan: bool = False,
+    llm_concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Iterable[str] = (),
+    checkpoint: Optional[ScanCheckpoint] = None,
+    llm_executor: Optional[Executor] = None,
+) -> Tuple[int, int]:
+    """Scan Notion once and write cards for any new SRS blocks to the card store,
+    returning the number of cards generated and how many of them were new
 
+    Card text is generated on a pool of `llm_concurrency` threads, or on
+    `llm_executor` if it's passed in
 
-def write_anki_cards_to_pickle_file(anki_cards: List[AnkiCard], pickle_filepath: str):
-    """Write the generated Anki cards to a pickle file for later use"""
-    if len(anki_cards) == 0:
-        print("No card text found from Notion, shutting down...")
-        return
+    Everything the scan records in `scan_index` is committed once the cards
+    are written, or rolled back if the scan fails (apart from what was
+    already saved by a `checkpoint`)
+    """
+    # the blocks left without a card, which are appended to on the LLM pool's
+    # threads and recorded in the card store once they're done
+    skipped_blocks: List[Dict] = []
+
+    def block_skipped(block: Dict) -> None:
+        skipped_blocks.append(block)
+        # a block left without a card is as finished as one with a card,
+        # otherwise the checkpoint could never move past it
+        if checkpoint is not None:
+            checkpoint.block_finished(block["id"])
 
-    # first, see if we have any existing saved potential card text from a prior
-    # execution of the script
-    existing_cards = []
     try:
-        with open(pickle_filepath, "rb") as f:
-            existing_cards = pickle.load(f)
-            existing_cards.extend(anki_cards)
-    except FileNotFoundError:
-        existing_cards.extend(anki_cards)
-
-    # filter out any duplicates, which will happen if we run the scan_notion
-    # command twice without running the generate_cards command in between
-    unique_cards: List[AnkiCard] = []
-    for card in existing_cards:
-        block_id = card.notion_block["id"]
-        num_card = len(
-            [
-                another_card
-                for another_card in unique_cards
-                if another_card.notion_block["id"] == block_id
-            ]
-        )
-        if num_card == 0:
-            unique_cards.append(card)
-        elif num_card > 1:
-            print("something wierd happened...")
-    if len(unique_cards) == 0:
-        print("No new cards found, shutting down...")
-        return
+        # the crawl runs in the background and feeds blocks into card
+        # generation as soon as they're found, and each card is saved as soon
+        # as it's generated, so an interrupted scan keeps the cards it made.
+        # Closing the blocks waits for the crawl to stop, so that it's no
+        # longer using `scan_index` when the scan is rolled back
+        with closing(
+            iterate_in_background(
+                iterate_srs_blocks(
+                    concurrency,
+                    scan_index,
+                    full_scan,
+                    scopes,
+                    set(excluded_ids),
+                    checkpoint,
+                )
+            )
+        ) as srs_blocks:
+            anki_cards = iterate_anki_cards_from_srs_blocks(
+                skip_blocks_with_cards(srs_blocks, card_store, checkpoint),
+                llm_concurrency,
+                generation_mode,
+                max_batch_tokens,
+                llm_executor,
+                block_skipped,
+            )
+            num_cards, num_new_cards = write_anki_cards_to_card_store(
+                anki_cards, card_store, checkpoint
+            )
+    except BaseException:
+        scan_index.rollback()
+        raise
+    finally:
+        card_store.add_skipped_blocks(skipped_blocks)
 
-    # now, save all the card text to the file
-    with open(pickle_filepath, "wb") as f:
-        pickle.dump(unique_cards, f)
+    # only remember what we've scanned once the cards are safely written,
+    # otherwise a crash would cause us to skip those blocks next time
+    scan_index.commit()
+    return num_cards, num_new_cards
 
-    plural_or_singular_cards = "card" if len(unique_cards) == 1 else "cards"
-    print(
-        f"Wrote {len(unique_cards)} Anki {plural_or_singular_cards} to {pickle_filepath}"
+
+def get_scan_checkpoint(
+    checkpoint_filepath: str,
+    resume: bool = False,
+    full_scan: bool = False,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Iterable[str] = (),
+) -> ScanCheckpoint:
+    """Load the checkpoint to resume the scan from, or start a new one"""
+    # a checkpoint can only be resumed by a scan of the same pages
+    scan_key = json.dumps(
+        {
+            "full_scan": full_scan,
+            "scopes": [get_high_water_mark_key(scope) for scope in scopes or []],
+            "excluded_ids": sorted(excluded_ids),
+        }
     )
+    if resume:
+        checkpoint = ScanCheckpoint.load(checkpoint_filepath, scan_key)
+        if checkpoint is not None:
+            return checkpoint
+        print("No checkpoint to resume from, starting a new scan")
+    elif os.path.exists(checkpoint_filepath):
+        print(
+            f"Discarding the checkpoint of an interrupted scan at {checkpoint_filepath} "
+            "and starting a new scan, pass --resume to continue the interrupted scan"
+        )
+    checkpoint = ScanCheckpoint(checkpoint_filepath, scan_key)
+    checkpoint.delete()
+    return checkpoint
+
+
+def skip_blocks_with_cards(
+    srs_blocks: Iterable[Dict],
+    card_store: CardStore,
+    checkpoint: Optional[ScanCheckpoint] = None,
+) -> Iterator[Dict]:
+    """Leave out the SRS blocks that already have a card in the card store, which
+    will happen if we scan twice without running generate_cards in between, so
+    we don't pay for generating their card text again. Blocks that were left
+    without a card are left out too, until they're edited"""
+    for srs_block in srs_blocks:
+        if not card_store.has_card(srs_block["id"]) and not card_store.was_skipped(
+            srs_block
+        ):
+            yield srs_block
+        elif checkpoint is not None:
+            checkpoint.block_finished(srs_block["id"])
+
 
+def write_anki_cards_to_card_store(
+    anki_cards: Iterable[AnkiCard],
+    card_store: CardStore,
+    checkpoint: Optional[ScanCheckpoint] = None,
+) -> Tuple[int, int]:
+    """Write the generated Anki cards to the card store for later use, one at a
+    time as they come out of `anki_cards`, returning the number of cards and
+    how many of them were new"""
+    num_cards = 0
+    num_new_cards = 0
+    for card in anki_cards:
+        num_cards += 1
+        # the card store ignores any card whose block it already has
+        merge_result = card_store.add_cards([card])
+        print_duplicate_texts(merge_result)
+        num_new_cards += merge_result.num_added
+        if checkpoint is not None:
+            checkpoint.block_finished(card.notion_block["id"])
 
-def generate_anki_card_and_mark_as_processed(pickle_filepath: str):
-    existing_cards = []
+    if num_new_cards > 0:
+        plural_or_singular_cards = "card" if num_new_cards == 1 else "cards"
+        print(
+            f"Wrote {num_new_cards} new Anki {plural_or_singular_cards} to the card store"
+        )
+    return num_cards, num_new_cards
+
+
+def watch_notion(
+    card_store_filepath: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    scan_index_filepath: str = SCAN_INDEX_FILEPATH,
+    llm_concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    scopes: Optional[List[ScanScope]] = None,
+    excluded_ids: Iterable[str] = (),
+    min_poll_interval_seconds: float = DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+    max_poll_interval_seconds: float = DEFAULT_MAX_POLL_INTERVAL_SECONDS,
+    llm_executor: Optional[Executor] = None,
+    stop_event: Optional[threading.Event] = None,
+):
+    """Poll Notion for newly edited pages until interrupted (or until
+    `stop_event` is set), writing cards for any new SRS blocks to the card
+    store as soon as they're found
+
+    The scan index, card store, LLM cache and API clients stay open between
+    polls. Each poll only looks at pages edited since the scan index's
+    high-water mark, so a poll where nothing has changed costs a single search
+    request per scope. The polling interval drops back to
+    `min_poll_interval_seconds` whenever a poll finds edited pages or new SRS
+    blocks, and backs off after every quiet poll, up to
+    `max_poll_interval_seconds`
+    """
+    scan_index = ScanIndex(scan_index_filepath)
+    card_store = CardStore(card_store_filepath)
+    poll_interval_seconds = min_poll_interval_seconds
+    # in a multi-tenant run, only this tenant's pages count as edits
+    tenant_labels = get_tenant_labels()
+    print("Watching Notion for new SRS blocks, press Ctrl-C to stop...")
+    try:
+        while stop_event is None or not stop_event.is_set():
+            num_pages_edited = metrics.get_counter(
+                "notion_pages_edited_total", **tenant_labels
+            )
+            metrics.increment("watch_polls_total", **tenant_labels)
+            try:
+                num_cards, _ = scan_and_write_anki_cards(
+                    scan_index,
+                    card_store,
+                    concurrency,
+                    False,
+                    llm_concurrency,
+                    generation_mode,
+                    max_batch_tokens,
+                    scopes,
+                    excluded_ids,
+                    llm_executor=llm_executor,
+                )
+                # a page that's only searched again because it still has an
+                # unprocessed mention isn't an edit, otherwise we'd never back off
+                had_edits = (
+                    metrics.get_counter("notion_pages_edited_total", **tenant_labels)
+                    > num_pages_edited
+                    or num_cards > 0
+                )
+            except TokenBudgetExceededError as e:
+                # every poll from now on would fail the same way
+                print(e)
+                break
+            except Exception as e:
+                # e.g. the network is down, which we wait out like a quiet poll
+                print(f"Failed to poll Notion: {e}")
+                metrics.increment("watch_poll_errors_total", **tenant_labels)
+                had_edits = False
+
+            poll_interval_seconds = get_next_poll_interval(
+                poll_interval_seconds,
+                had_edits,
+                min_poll_interval_seconds,
+                max_poll_interval_seconds,
+            )
+            if stop_event is None:
+                time.sleep(poll_interval_seconds)
+            else:
+                stop_event.wait(poll_interval_seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scan_index.close()
+        card_store.close()
+    print("\nStopped watching Notion")
+
+
+def scan_tenants(
+    tenants: List[Tenant],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    full_scan: bool = False,
+    llm_concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    resume: bool = False,
+):
+    """Scan every tenant's Notion workspace at once, each on its own thread
+    with its own Notion client, rate limiter, scan index and card store
+
+    The tenants share a single pool of `llm_concurrency` LLM workers, so the
+    LLM is kept busy by whichever tenants have blocks waiting. A tenant whose
+    scan fails doesn't stop the others, and the run fails once they're all done
+    """
+
+    def scan_tenant(tenant: Tenant) -> Tuple[int, int]:
+        with use_tenant(tenant):
+            return find_srs_blocks_and_create_anki_cards(
+                tenant.card_store_filepath,
+                concurrency,
+                tenant.scan_index_filepath,
+                full_scan,
+                llm_concurrency,
+                generation_mode,
+                max_batch_tokens,
+                make_scan_scopes(tenant.databases, tenant.pages),
+                tenant.exclude,
+                resume,
+                tenant.checkpoint_filepath,
+                llm_executor,
+            )
+
+    failed_tenant_names = []
+    with (
+        prefix_output_with_tenant_names(),
+        ThreadPoolExecutor(max_workers=max(1, llm_concurrency)) as llm_executor,
+        ThreadPoolExecutor(max_workers=len(tenants)) as tenant_executor,
+    ):
+        futures = [tenant_executor.submit(scan_tenant, tenant) for tenant in tenants]
+        summaries = []
+        for tenant, future in zip(tenants, futures):
+            try:
+                num_cards, num_new_cards = future.result()
+            except TokenBudgetExceededError:
+                # the tenant's scan was cut short, not broken, and the next
+                # scan picks up where it stopped
+                metrics.increment(
+                    "tenant_scans_total", tenant=tenant.name, result="out_of_budget"
+                )
+                summaries.append(f"  {tenant.name}: stopped, out of token budget")
+                continue
+            except Exception as e:
+                failed_tenant_names.append(tenant.name)
+                metrics.increment(
+                    "tenant_scans_total", tenant=tenant.name, result="error"
+                )
+                summaries.append(f"  {tenant.name}: failed, {e!r}")
+                continue
+            metrics.increment("tenant_scans_total", tenant=tenant.name, result="ok")
+            summaries.append(
+                f"  {tenant.name}: {num_new_cards} new cards ({num_cards} generated) "
+                f"in {tenant.card_store_filepath}"
+            )
+
+    print("\nTenants:")
+    print("\n".join(summaries))
+    if failed_tenant_names:
+        raise RuntimeError(f"The scans of {failed_tenant_names} failed")
+
+
+def watch_tenants(
+    tenants: List[Tenant],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    llm_concurrency: int = DEFAULT_LLM_CONCURRENCY,
+    generation_mode: str = DEFAULT_GENERATION_MODE,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    min_poll_interval_seconds: float = DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+    max_poll_interval_seconds: float = DEFAULT_MAX_POLL_INTERVAL_SECONDS,
+):
+    """`watch_notion` for every tenant at once, each polling on its own thread
+    and sharing a single pool of `llm_concurrency` LLM workers, until
+    interrupted"""
+    stop_event = threading.Event()
+
+    def watch_tenant(tenant: Tenant) -> None:
+        with use_tenant(tenant):
+            watch_notion(
+                tenant.card_store_filepath,
+                concurrency,
+                tenant.scan_index_filepath,
+                llm_concurrency,
+                generation_mode,
+                max_batch_tokens,
+                make_scan_scopes(tenant.databases, tenant.pages),
+                tenant.exclude,
+                min_poll_interval_seconds,
+                max_poll_interval_seconds,
+                llm_executor,
+                stop_event,
+            )
+
+    with (
+        prefix_output_with_tenant_names(),
+        ThreadPoolExecutor(max_workers=max(1, llm_concurrency)) as llm_executor,
+        ThreadPoolExecutor(max_workers=len(tenants)) as tenant_executor,
+    ):
+        futures = [tenant_executor.submit(watch_tenant, tenant) for tenant in tenants]
+        try:
+            # only the main thread sees Ctrl-C, so it waits here and tells
+            # the tenants to stop
+            while not all(future.done() for future in futures):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("\nStopping once each tenant's current poll is done...")
+        finally:
+            stop_event.set()
+        for future in futures:
+            future.result()
+
+
+def get_next_poll_interval(
+    poll_interval_seconds: float,
+    had_edits: bool,
+    min_poll_interval_seconds: float = DEFAULT_MIN_POLL_INTERVAL_SECONDS,
+    max_poll_interval_seconds: float = DEFAULT_MAX_POLL_INTERVAL_SECONDS,
+) -> float:
+    """Poll quickly while pages are being edited, and back off while they aren't"""
+    if had_edits:
+        return min_poll_interval_seconds
+    return min(poll_interval_seconds * POLL_BACKOFF_FACTOR, max_poll_interval_seconds)
+
+
+def import_pickle_file(pickle_filepath: str, card_store_filepath: str):
+    """One-shot import of a *.pkl card file into the card store"""
+    card_store = CardStore(card_store_filepath)
     try:
-        with open(pickle_filepath, "rb") as f:
-            existing_cards = pickle.load(f)
-    except FileNotFoundError:
+        merge_result = card_store.import_pickle_file(pickle_filepath)
+    finally:
+        card_store.close()
+    print_duplicate_texts(merge_result)
+    print(f"Imported {merge_result.num_added} new cards from {pickle_filepath}")
+
+
+def import_leftover_pickle_file(card_store_filepath: str):
+    """Import the cards an older version of scan_notion left in PICKLE_FILEPATH,
+    so that upgrading doesn't lose the cards that weren't added to Anki yet
+
+    The file is renamed once it's imported, so it's only imported once. If it
+    can't be imported, we carry on and point to `import_pickle` instead
+    """
+    if not os.path.exists(PICKLE_FILEPATH):
+        return
+    try:
+        import_pickle_file(PICKLE_FILEPATH, card_store_filepath)
+    except Exception as e:
+        print(
+            f"Unable to import the cards from {PICKLE_FILEPATH}, which was written "
+            f"by an older version of scan_notion: {e}. Import it with "
+            f"`python main.py import_pickle` to review its cards"
+        )
         return
-    print("Please view the list of cards to create and either accept or deny each...\n")
-    for card in existing_cards:
-        print("")
-        print(card.text)
-        user_input = input("Do you want to generate this card? (y/n): ").strip().lower()
-        if user_input == "y" or user_input == "":
-            notion_block_id = card.notion_block["id"]
-            print(f"adding card with id {notion_block_id} to Anki deck...")
-            add_anki_card_to_deck(card)
-        print(f"Updating block with ID: {card.notion_block['id']}")
-        mark_srs_block_as_processed(card.notion_block)
-
-    print(f"deleting {pickle_filepath}")
-    os.remove(pickle_filepath)
+    imported_filepath = f"{PICKLE_FILEPATH}.imported"
+    os.replace(PICKLE_FILEPATH, imported_filepath)
+    print(f"Moved {PICKLE_FILEPATH} to {imported_filepath}")
+
+
+def print_duplicate_texts(merge_result: MergeResult):
+    """Warn about new cards with the same text as another card, so they can be
+    rejected during review"""
+    for block_id, duplicate_block_id in merge_result.duplicate_texts:
+        print(
+            f"card with id {block_id} has the same text as the card with id {duplicate_block_id}"
+        )
+
+
+def generate_anki_card_and_mark_as_processed(
+    card_store_filepath: str,
+    anki_chunk_size: int = DEFAULT_ANKI_CHUNK_SIZE,
+    writeback_queue_filepath: str = WRITEBACK_QUEUE_FILEPATH,
+    concurrency: int = DEFAULT_CONCURRENCY,
+):
+    # marking blocks as processed in Notion happens in the background, so that
+    # the review below never has to wait on the Notion API
+    card_store = CardStore(card_store_filepath)
+    writeback_queue = WritebackQueue(writeback_queue_filepath, concurrency)
+    try:
+        writeback_queue.start()
+        review_and_generate_anki_cards(card_store, anki_chunk_size, writeback_queue)
+    finally:
+        writeback_queue.close()
+        card_store.close()
+
+
+def review_and_generate_anki_cards(
+    card_store: CardStore, anki_chunk_size: int, writeback_queue: WritebackQueue
+):
+    # accepted cards are added to Anki in the background while the review goes
+    # on, starting with any left over from a previous run
+    anki_syncer = AnkiSyncer(card_store, writeback_queue, anki_chunk_size)
+    try:
+        for card in card_store.get_cards("accepted"):
+            anki_syncer.add(card)
+        # each decision is saved right away, so an interrupted review can be
+        # resumed by re-running generate_cards
+        ReviewSession(
+            card_store.get_cards("pending"), card_store, writeback_queue, anki_syncer
+        ).run()
+
+        if anki_syncer.buffer or anki_syncer.in_flight:
+            print("\nfinishing adding cards to Anki deck...")
+        anki_syncer.close()
+    finally:
+        # if the review was interrupted, the cards still in flight are left
+        # accepted and retried next time
+        anki_syncer.executor.shutdown()
+
+    if anki_syncer.num_synced > 0:
+        print(f"added {anki_syncer.num_synced} cards to the Anki deck")
+    if anki_syncer.num_failed > 0:
+        print(
+            f"{anki_syncer.num_failed} cards could not be added to Anki, "
+            "they will be retried the next time you run generate_cards"
+        )
+
+    num_pending = writeback_queue.drain()
+    if num_pending > 0:
+        print(
+            f"{num_pending} blocks could not be marked as processed in Notion, "
+            "they will be retried the next time you run generate_cards"
+        )
 
 
 # This makes it so you can run `python main.py` to run this file